@@ -8,78 +8,83 @@
 #
 
 import os
-import pytz
-
-from builtins import FileNotFoundError
-from datetime import datetime
 
 from django.conf import settings
-from django.core.exceptions import MultipleObjectsReturned
+from django.db import transaction
+from django.db.models import Case, DateTimeField, Min, Value, When
 from django.utils import timezone
 
-from .models import History, Pending
-
-tz = pytz.timezone(settings.TIME_ZONE)
-
-
-def update_on_sent_action(modeladmin, request, uploads):
-    for upload in uploads:
-        try:
-            filename = os.path.split(upload.filename)[1]
-            history = History.objects.get(filename=filename)
-            upload.sent = True
-            upload.sent_datetime = history.sent_datetime
-        except MultipleObjectsReturned:
-            history = History.objects.filter(filename=filename).order_by('sent_datetime')
-            upload.sent = True
-            upload.sent_datetime = history[0].sent_datetime
-        except History.DoesNotExist:
-            upload.sent = False
-            upload.sent_datetime = None
-        try:
-            upload.save()
-        except FileNotFoundError:
-            upload.file = None
-            upload.save()
+from .models import History, Upload
+from .rollups import remove_acks
+from .utils import sync_pending_files
+
+
+def update_on_sent_action(modeladmin, request, uploads, batch_size=None):
+    """Flags uploads as sent using the earliest sent_datetime in History for each filename.
+
+    Works in batches of filenames. For each batch, one aggregate query resolves the
+    earliest sent_datetime per filename and two updates flag the uploads."""
+    batch_size = batch_size or 1000
+    pks = list(uploads.values_list('pk', 'filename'))
+    with transaction.atomic():
+        for index in range(0, len(pks), batch_size):
+            batch = dict(pks[index:index + batch_size])
+            filenames = set(os.path.split(filename)[1] for filename in batch.values() if filename)
+            sent = dict(
+                History.objects.filter(filename__in=filenames).values('filename').annotate(
+                    first_sent_datetime=Min('sent_datetime')).values_list('filename', 'first_sent_datetime'))
+            Upload.objects.filter(pk__in=batch).exclude(filename__in=sent).update(
+                sent=False, sent_datetime=None)
+            if sent:
+                Upload.objects.filter(pk__in=batch, filename__in=sent).update(
+                    sent=True,
+                    sent_datetime=Case(
+                        *[When(filename=filename, then=Value(sent_datetime))
+                          for filename, sent_datetime in sent.items()],
+                        output_field=DateTimeField()))
 update_on_sent_action.short_description = "Check sent history"
 
 
+def audit_uploads(queryset, auditor):
+    """Flags sent uploads in the queryset as audited by auditor in one update.
+
+    Returns the number of uploads flagged."""
+    return queryset.filter(sent=True).update(
+        audited=True,
+        audited_datetime=timezone.now(),
+        auditor=str(auditor))
+
+
+def unaudit_uploads(queryset):
+    """Flags uploads in the queryset as not audited in one update.
+
+    Returns the number of uploads flagged."""
+    return queryset.update(
+        audited=False,
+        audited_datetime=None,
+        auditor=None)
+
+
 def upload_audit_action(modeladmin, request, queryset):
-    for obj in queryset:
-        if obj.sent:
-            obj.audited = True
-            obj.audited_datetime = timezone.now()
-            obj.auditer = request.user
-            obj.save()
+    audit_uploads(queryset, request.user)
 upload_audit_action.short_description = "Audit sent (flag uploads as audited if sent)"
 
 
 def upload_unaudit_action(modeladmin, request, queryset):
-    for obj in queryset:
-        obj.audited = False
-        obj.audited_datetime = None
-        obj.auditer = None
-        obj.save()
+    unaudit_uploads(queryset)
 upload_unaudit_action.short_description = "Undo audit (flag uploads as not audited)"
 
 
 def update_pending_files(modeladmin, request, queryset):
-    upload_path = os.path.join(settings.MEDIA_ROOT, settings.GRTX_UPLOAD_FOLDER)
-    Pending.objects.all().delete()
-    for filename in os.listdir(upload_path):
-        fileinfo = os.stat(os.path.join(upload_path, filename))
-        Pending.objects.create(
-            filename=filename,
-            filesize=fileinfo.st_size,
-            filetimestamp=tz.localize(datetime.fromtimestamp(fileinfo.st_mtime))
-        )
+    sync_pending_files(os.path.join(settings.MEDIA_ROOT, settings.GRTX_UPLOAD_FOLDER))
 update_pending_files.short_description = "Update the list of uploaded files pending delivery."
 
 
 def unacknowledge_action(modeladmin, request, queryset):
-    for obj in queryset:
-        obj.ack_datetime = None
-        obj.ack_user = None
-        obj.acknowledged = False
-        obj.save()
+    with transaction.atomic():
+        remove_acks(queryset)
+        queryset.update(
+            ack_datetime=None,
+            ack_user=None,
+            acknowledged=False)
 unacknowledge_action.short_description = "Undo an acknowledgement."
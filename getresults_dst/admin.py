@@ -13,7 +13,8 @@ from .actions import (update_on_sent_action, upload_audit_action,
                       upload_unaudit_action, update_pending_files,
                       unacknowledge_action)
 from .forms import UploadForm
-from .models import History, RemoteFolder, Upload, Pending, Acknowledgment, LogReaderHistory
+from .models import (History, RemoteFolder, Upload, Pending, Acknowledgment, LogReaderHistory,
+                     DeliveryRollup)
 
 
 @admin.register(History)
@@ -24,10 +25,10 @@ class HistoryAdmin(admin.ModelAdmin):
     list_display = ('filename', 'archive', 'filesize', 'filetimestamp',
                     'sent_datetime', 'ack_datetime', 'ack_user', 'mime_type',
                     'remote_hostname', 'remote_folder_tag',
-                    'remote_folder')
+                    'remote_folder', 'label')
     list_filter = ('sent_datetime', 'acknowledged', 'ack_datetime',
-                   'remote_folder', 'remote_folder_tag', 'ack_user')
-    search_fields = ('filename', 'ack_user')
+                   'remote_folder', 'remote_folder_tag', 'label', 'ack_user')
+    search_fields = ('filename', 'ack_user', 'content_hash')
     actions = [update_pending_files, unacknowledge_action]
 
 
@@ -47,7 +48,7 @@ class UploadAdmin(admin.ModelAdmin):
                     'audited', 'filesize', 'mime_type')
     search_fields = ('file', 'description')
     list_filter = ('upload_datetime', 'sent', 'sent_datetime', 'audited_datetime', 'upload_user', 'auditor')
-    search_fields = ('filename', )
+    search_fields = ('filename', 'content_hash')
     actions = [update_on_sent_action, upload_audit_action, upload_unaudit_action, update_pending_files]
 
     def get_readonly_fields(self, request, obj=None):
@@ -83,3 +84,11 @@ class LogReaderHistoryAdmin(admin.ModelAdmin):
     date_hierachy = 'started'
     list_display = ('lastpos', 'lines', 'matches', 'exceptions', 'started', 'ended')
     list_filter = ('started', 'ended')
+
+
+@admin.register(DeliveryRollup)
+class DeliveryRollupAdmin(admin.ModelAdmin):
+    date_hierarchy = 'day'
+    list_display = ('day', 'label', 'remote_folder', 'remote_folder_tag', 'sent', 'acknowledged',
+                    'ack_within_hour', 'ack_within_day', 'ack_within_week')
+    list_filter = ('day', 'label', 'remote_folder')
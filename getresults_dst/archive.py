@@ -0,0 +1,208 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2015 Erik van Widenfelt
+# All rights reserved.
+#
+# This software is licensed as described in the file COPYING, which
+# you should have received as part of this distribution.
+#
+
+import gzip
+import hashlib
+import io
+import json
+import os
+import random
+import shutil
+import string
+import tarfile
+
+from builtins import FileNotFoundError
+from datetime import date
+
+from django.conf import settings
+from django.utils import timezone
+
+from .utils import content_hash
+
+BUNDLE_EXT = '.tar'
+INDEX_EXT = '.idx'
+
+
+class ArchiveError(Exception):
+    pass
+
+
+class ArchiveStore(object):
+    """Archives sent files into one flat folder with a random suffix on each filename.
+
+    Like the folder handler, an archive store is set on the event handler. The archive
+    name returned by :func:`archive_name` is relative to the archive folder and is
+    recorded on History.archive."""
+
+    def archive_name(self, filename, content_hash=None, when=None):
+        shard = self.shard(filename, content_hash=content_hash, when=when)
+        return os.path.join(shard, self.archive_filename(filename)) if shard else self.archive_filename(filename)
+
+    def archive_filename(self, filename):
+        suffix = ''.join(random.SystemRandom().choice(string.ascii_uppercase + string.digits) for _ in range(5))
+        try:
+            f, ext = filename.split('.')
+        except ValueError:
+            f, ext = filename, ''
+        return '.'.join(['{}_{}'.format(f, suffix), ext])
+
+    def shard(self, filename, content_hash=None, when=None):
+        """Override to return the folder, relative to the archive folder, to archive into."""
+        return ''
+
+    def store(self, path, archive_dir, name, file_hash=None):
+        """Moves the file at path into the archive."""
+        archive_path = os.path.join(archive_dir, name)
+        try:
+            os.rename(path, archive_path)
+        except FileNotFoundError:
+            if not os.path.exists(path):
+                raise
+            os.makedirs(os.path.dirname(archive_path), exist_ok=True)
+            os.rename(path, archive_path)
+        return archive_path
+
+
+class DateShardedArchiveStore(ArchiveStore):
+    """Archives sent files into a folder per day, e.g. 2015/06/30/.
+
+    Old days can be bundled by :func:`bundle_shard` (see management command bundle_archive)."""
+
+    def shard(self, filename, content_hash=None, when=None):
+        return timezone.localtime(when or timezone.now()).strftime('%Y/%m/%d')
+
+    def shards_before(self, archive_dir, before):
+        """Yields the day folders in archive_dir before date `before`, oldest first."""
+        for year in sorted(self.listdir(archive_dir)):
+            for month in sorted(self.listdir(archive_dir, year)):
+                for day in sorted(self.listdir(archive_dir, year, month)):
+                    try:
+                        shard_date = date(int(year), int(month), int(day))
+                    except ValueError:
+                        continue
+                    if shard_date < before:
+                        yield os.path.join(year, month, day)
+
+    def listdir(self, *path):
+        path = os.path.join(*path)
+        return [name for name in os.listdir(path) if os.path.isdir(os.path.join(path, name))]
+
+
+class HashShardedArchiveStore(ArchiveStore):
+    """Archives sent files into a folder by the first characters of the content hash, e.g. 3f/a2/."""
+
+    def shard(self, filename, content_hash=None, when=None):
+        content_hash = content_hash or hashlib.sha256(filename.encode()).hexdigest()
+        return os.path.join(content_hash[0:2], content_hash[2:4])
+
+
+class ContentAddressedArchiveStore(ArchiveStore):
+    """Archives one copy of each content under its hash, e.g. 3f/a2/3fa2...c1.pdf.
+
+    A file with content already in the archive is not stored again, so
+    repeat sends only add a History row that references the same copy."""
+
+    def archive_name(self, filename, content_hash=None, when=None):
+        if not content_hash:
+            raise ArchiveError('A content hash is required. Got None for {}'.format(filename))
+        ext = os.path.splitext(filename)[1]
+        return os.path.join(content_hash[0:2], content_hash[2:4], content_hash + ext)
+
+    def store(self, path, archive_dir, name, file_hash=None):
+        """Moves the file at path into the archive, or removes it if the archive already
+        has its content. The file is never removed, or stored, under a hash that is not its own.
+
+        Pass :param:`file_hash`, the digest calculated while sending, so the file is not read
+        again. If None, the file is hashed."""
+        expected = os.path.splitext(os.path.basename(name))[0]
+        if (file_hash or content_hash(path=path)) != expected:
+            raise ArchiveError('Content of {} does not match its archive name. Got {}'.format(path, name))
+        archive_path = os.path.join(archive_dir, name)
+        if os.path.exists(archive_path):
+            if os.path.getsize(archive_path) != os.path.getsize(path):
+                raise ArchiveError('Archived copy differs in size. Got {}'.format(archive_path))
+            os.remove(path)
+            return archive_path
+        return super(ContentAddressedArchiveStore, self).store(path, archive_dir, name, file_hash=file_hash)
+
+
+ARCHIVE_STORES = {
+    'flat': ArchiveStore,
+    'date': DateShardedArchiveStore,
+    'hash': HashShardedArchiveStore,
+    'content': ContentAddressedArchiveStore,
+}
+
+
+def archive_store(layout=None):
+    """Returns an archive store for the layout or GRTX_ARCHIVE_LAYOUT (Default: 'flat')."""
+    layout = layout or getattr(settings, 'GRTX_ARCHIVE_LAYOUT', 'flat')
+    try:
+        return ARCHIVE_STORES[layout]()
+    except KeyError:
+        raise ArchiveError('Unknown archive layout. Expected one of {}. Got {}'.format(
+            ', '.join(ARCHIVE_STORES), layout))
+
+
+def bundle_shard(shard_dir):
+    """Bundles the files in shard_dir into shard_dir.tar with an index shard_dir.idx and
+    removes shard_dir.
+
+    Each file is gzipped separately into the uncompressed tar, so a single file can be
+    read from its offset in the index without unpacking the bundle. Returns the number
+    of files bundled."""
+    shard_dir = shard_dir.rstrip('/')
+    bundle, index_path = shard_dir + BUNDLE_EXT, shard_dir + INDEX_EXT
+    if os.path.exists(bundle):
+        raise ArchiveError('Bundle already exists. Got {}'.format(bundle))
+    filenames = sorted(
+        name for name in os.listdir(shard_dir) if os.path.isfile(os.path.join(shard_dir, name)))
+    tmp_bundle, tmp_index = bundle + '.tmp', index_path + '.tmp'
+    with tarfile.open(tmp_bundle, 'w') as tar:
+        for filename in filenames:
+            path = os.path.join(shard_dir, filename)
+            with open(path, 'rb') as f:
+                data = gzip.compress(f.read())
+            info = tarfile.TarInfo(filename + '.gz')
+            info.size = len(data)
+            info.mtime = os.stat(path).st_mtime
+            tar.addfile(info, fileobj=io.BytesIO(data))
+    with tarfile.open(tmp_bundle) as tar:
+        index = {member.name[:-3]: [member.offset_data, member.size] for member in tar}
+    with open(tmp_index, 'w') as f:
+        json.dump(index, f)
+    os.rename(tmp_bundle, bundle)
+    os.rename(tmp_index, index_path)
+    shutil.rmtree(shard_dir)
+    return len(filenames)
+
+
+def verify_archived(name, content_hash, media_root=None):
+    """Returns True if the content of the archived file matches content_hash."""
+    return hashlib.sha256(read_archived(name, media_root)).hexdigest() == content_hash
+
+
+def read_archived(name, media_root=None):
+    """Returns the content of an archived file by its History.archive name, reading
+    from the bundle of its shard if the shard was bundled."""
+    path = os.path.join(media_root or settings.MEDIA_ROOT, name)
+    try:
+        with open(path, 'rb') as f:
+            return f.read()
+    except FileNotFoundError:
+        pass
+    shard_dir, filename = os.path.split(path)
+    try:
+        with open(shard_dir + INDEX_EXT) as f:
+            offset, size = json.load(f)[filename]
+        with open(shard_dir + BUNDLE_EXT, 'rb') as f:
+            f.seek(offset)
+            return gzip.decompress(f.read(size))
+    except (FileNotFoundError, KeyError):
+        raise ArchiveError('Archived file not found. Got {}'.format(name))
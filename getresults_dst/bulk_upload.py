@@ -0,0 +1,198 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2015 Erik van Widenfelt
+# All rights reserved.
+#
+# This software is licensed as described in the file COPYING, which
+# you should have received as part of this distribution.
+#
+
+import fnmatch
+import os
+import tarfile
+import zipfile
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Q
+
+from .models import Upload, History
+from .upload_handlers import StreamedUploadedFile, upload_folder
+
+ARCHIVE_EXTENSIONS = ('.zip', '.tar', '.tar.gz', '.tgz', '.tar.bz2')
+
+
+class BulkUploadError(Exception):
+    pass
+
+
+def iter_entries(files):
+    """Yields (name, fileobj) for each uploaded file or, if it is a zip or tar
+    archive, for each file in the archive. Entries are read one at a time."""
+    for f in files:
+        name = f.name.lower()
+        if name.endswith('.zip'):
+            for entry in iter_zip_entries(f):
+                yield entry
+        elif name.endswith(ARCHIVE_EXTENSIONS):
+            for entry in iter_tar_entries(f):
+                yield entry
+        else:
+            f.seek(0)
+            yield f.name, f
+
+
+def iter_zip_entries(f):
+    try:
+        with zipfile.ZipFile(f) as archive:
+            for info in archive.infolist():
+                if not info.filename.endswith('/'):
+                    with archive.open(info) as entry:
+                        yield info.filename, entry
+    except zipfile.BadZipfile as e:
+        raise BulkUploadError('Invalid zip file {}. Got {}'.format(f.name, str(e)))
+
+
+def iter_tar_entries(f):
+    try:
+        with tarfile.open(fileobj=f, mode='r|*') as archive:
+            for member in archive:
+                if member.isfile():
+                    yield member.name, archive.extractfile(member)
+    except tarfile.TarError as e:
+        raise BulkUploadError('Invalid tar file {}. Got {}'.format(f.name, str(e)))
+
+
+class BulkUpload(object):
+    """Stages a batch of uploaded files, checks the batch for duplicates by filename
+    and content hash and creates the Upload rows in bulk.
+
+    Each file is copied to a hidden temp file in the upload folder, so accepted files
+    are renamed into place and the observer only sees complete files.
+
+    For example:
+
+        bulk_upload = BulkUpload(user=request.user)
+        uploads, rejected = bulk_upload.process(request.FILES.getlist('files'))
+    """
+
+    chunk_size = 64 * 2 ** 10
+
+    def __init__(self, upload_dir=None, user=None, file_patterns=None, mime_types=None):
+        self.upload_dir = upload_dir or upload_folder()
+        self.user = str(user) if user else None
+        self.file_patterns = file_patterns or settings.GRTX_FILE_PATTERNS
+        self.mime_types = mime_types or settings.GRTX_MIME_TYPES
+        self.filename_max_length = Upload._meta.get_field('filename').max_length
+        self.staged = {}
+        self.rejected = []
+
+    def process(self, files):
+        """Returns a tuple of (uploads, rejected) where rejected is a list of (filename, reason).
+
+        The request files are discarded once copied, including the temp files
+        streamed to the upload folder by :class:`UploadFolderFileHandler`."""
+        try:
+            for name, fileobj in iter_entries(files):
+                self.stage(name, fileobj)
+            self.reject_duplicates()
+            uploads = self.commit()
+        finally:
+            self.discard()
+            for f in files:
+                if isinstance(f, StreamedUploadedFile):
+                    f.discard()
+        return uploads, self.rejected
+
+    def stage(self, name, fileobj):
+        filename = os.path.basename(name)
+        reason = self.validate(filename)
+        if reason:
+            self.rejected.append((filename or name, reason))
+            return None
+        staged = StreamedUploadedFile(filename, None, None, dir=self.upload_dir)
+        try:
+            for chunk in iter(lambda: fileobj.read(self.chunk_size), b''):
+                staged.write_chunk(chunk)
+            staged.complete()
+        except Exception:
+            staged.discard()
+            raise
+        if staged.mime_type not in self.mime_types:
+            staged.discard()
+            self.rejected.append((filename, 'Unexpected mime type. Got {}'.format(staged.mime_type)))
+            return None
+        self.staged[filename] = staged
+        return staged
+
+    def validate(self, filename):
+        if not filename or filename.startswith('.'):
+            return 'Invalid filename'
+        if len(filename) > self.filename_max_length:
+            return 'Filename longer than {}'.format(self.filename_max_length)
+        if not [pattern for pattern in self.file_patterns if fnmatch.fnmatch(filename, pattern)]:
+            return 'Filename does not match {}'.format(', '.join(self.file_patterns))
+        if filename in self.staged:
+            return 'Duplicate in this upload'
+        return None
+
+    def reject_duplicates(self):
+        """Rejects staged files already uploaded or sent, by filename or content,
+        in one query against each model."""
+        filenames = list(self.staged)
+        if not filenames:
+            return None
+        hashes = {}
+        for filename, staged in sorted(self.staged.items()):
+            if staged.content_hash in hashes:
+                self.reject(filename, 'Same content as {} in this upload'.format(hashes[staged.content_hash]))
+            else:
+                hashes[staged.content_hash] = filename
+        q = Q(filename__in=filenames) | Q(content_hash__in=list(hashes))
+        duplicates = [
+            (Upload.objects.filter(q), 'File already uploaded'),
+            (History.objects.filter(q), 'File already uploaded and sent')]
+        for queryset, reason in duplicates:
+            for filename, content_hash in set(queryset.values_list('filename', 'content_hash')):
+                if filename in self.staged:
+                    self.reject(filename, reason)
+                if content_hash in hashes and hashes[content_hash] in self.staged:
+                    self.reject(hashes[content_hash], '{} as {}'.format(reason, filename))
+        for filename in list(self.staged):
+            if os.path.exists(os.path.join(self.upload_dir, filename)):
+                self.reject(filename, 'File is pending in the upload folder')
+
+    def reject(self, filename, reason):
+        self.staged.pop(filename).discard()
+        self.rejected.append((filename, reason))
+
+    def commit(self):
+        """Creates the Upload rows and renames the staged files into place."""
+        uploads = [
+            Upload(file=os.path.join(settings.GRTX_UPLOAD_FOLDER, filename), filename=filename,
+                   filesize=staged.size, mime_type=staged.mime_type, content_hash=staged.content_hash,
+                   upload_user=self.user)
+            for filename, staged in sorted(self.staged.items())]
+        moved = []
+        try:
+            with transaction.atomic():
+                Upload.objects.bulk_create(uploads)
+                for filename, staged in sorted(self.staged.items()):
+                    path = os.path.join(self.upload_dir, filename)
+                    os.rename(staged.temporary_file_path(), path)
+                    moved.append(path)
+                    staged.close()
+        except Exception:
+            for path in moved:
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+            raise
+        self.staged = {}
+        return uploads
+
+    def discard(self):
+        for staged in self.staged.values():
+            staged.discard()
+        self.staged = {}
@@ -0,0 +1,68 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2015 Erik van Widenfelt
+# All rights reserved.
+#
+# This software is licensed as described in the file COPYING, which
+# you should have received as part of this distribution.
+#
+
+import zlib
+
+ALWAYS = 'always'
+NEVER = 'never'
+ADAPTIVE = 'adaptive'
+
+
+class CompressionPolicy(object):
+    """Decides per file whether to send over a compressed or uncompressed SSH transport.
+
+    Known compressed formats are never compressed again and text is always compressed.
+    For other mime types, a sample from the start of the file is compressed with zlib
+    and the file is compressed if the sample shrinks below `min_ratio`."""
+
+    incompressible_mime_types = (
+        'application/pdf', 'application/zip', 'application/gzip', 'application/x-gzip',
+        'application/x-bzip2', 'application/x-xz', 'image/', 'audio/', 'video/')
+    compressible_mime_types = ('text/', 'application/json', 'application/xml')
+
+    def __init__(self, min_ratio=None, sample_size=None):
+        self.min_ratio = min_ratio or 0.9
+        self.sample_size = sample_size or 65536
+
+    def compress(self, path, mime_type=None):
+        mime_type = mime_type.decode() if isinstance(mime_type, bytes) else (mime_type or '')
+        if mime_type.startswith(self.incompressible_mime_types):
+            return False
+        if mime_type.startswith(self.compressible_mime_types):
+            return True
+        return self.ratio(path) < self.min_ratio
+
+    def ratio(self, path):
+        """Returns the compressed size of a sample over its size."""
+        with open(path, 'rb') as f:
+            sample = f.read(self.sample_size)
+        if not sample:
+            return 1.0
+        return len(zlib.compress(sample, 1)) / float(len(sample))
+
+
+class FixedCompressionPolicy(CompressionPolicy):
+    """Always or never compresses, e.g. for comparison in a benchmark."""
+
+    def __init__(self, compress, **kwargs):
+        super(FixedCompressionPolicy, self).__init__(**kwargs)
+        self.fixed = compress
+
+    def compress(self, path, mime_type=None):
+        return self.fixed
+
+
+def compression_policy(name=None):
+    """Returns a policy for 'always', 'never' or 'adaptive' or None (the default,
+    all traffic on one compressed transport)."""
+    if name == ADAPTIVE:
+        return CompressionPolicy()
+    elif name in (ALWAYS, NEVER):
+        return FixedCompressionPolicy(name == ALWAYS)
+    return None
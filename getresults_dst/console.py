@@ -0,0 +1,99 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2015 Erik van Widenfelt
+# All rights reserved.
+#
+# This software is licensed as described in the file COPYING, which
+# you should have received as part of this distribution.
+#
+
+import atexit
+import queue
+import sys
+import threading
+import time
+
+
+class ConsoleSink(object):
+    """Writes messages to the console from a background thread.
+
+    Callers put messages on a queue and return immediately so terminal I/O
+    never blocks the log reader or the event handlers.
+    """
+
+    def __init__(self, stream=None):
+        self.stream = stream
+        self.queue = queue.Queue()
+        self.thread = None
+        self.lock = threading.Lock()
+
+    def start(self):
+        with self.lock:
+            if not self.thread or not self.thread.is_alive():
+                self.thread = threading.Thread(target=self.run, name='console-sink')
+                self.thread.daemon = True
+                self.thread.start()
+
+    def write(self, msg, end='\n'):
+        """Queues msg for writing. Does not block."""
+        if not self.thread:
+            self.start()
+        self.queue.put(str(msg) + end)
+
+    def flush(self):
+        """Blocks until all queued messages are written."""
+        if self.thread:
+            self.queue.join()
+
+    def run(self):
+        while True:
+            msg = self.queue.get()
+            try:
+                stream = self.stream or sys.stdout
+                stream.write(msg)
+                if self.queue.empty():
+                    stream.flush()
+            finally:
+                self.queue.task_done()
+
+
+console = ConsoleSink()
+atexit.register(console.flush)
+
+
+class ProgressReporter(object):
+    """Writes a progress line to the console at most once every `interval` seconds.
+
+    The progress line includes the rate in lines/sec and bytes/sec since
+    the first update.
+    """
+
+    template = ('\rbytes: {bytes}    lines: {lines}    matches: {matches}    exceptions: {exceptions}'
+                '    ({lines_per_sec:.0f} lines/sec, {bytes_per_sec:.0f} bytes/sec)')
+
+    def __init__(self, interval=None, sink=None):
+        self.interval = 1.0 if interval is None else interval
+        self.sink = sink or console
+        self.started = None
+        self.last_reported = None
+
+    def update(self, lines, bytes_read, matches=None, exceptions=None, force=None):
+        now = time.time()
+        if self.started is None:
+            self.started = now
+        if force or self.last_reported is None or now - self.last_reported >= self.interval:
+            self.last_reported = now
+            elapsed = max(now - self.started, 0.001)
+            self.sink.write(self.template.format(
+                bytes=bytes_read,
+                lines=lines,
+                matches=matches or 0,
+                exceptions=exceptions or 0,
+                lines_per_sec=lines / elapsed,
+                bytes_per_sec=bytes_read / elapsed), end='')
+
+    def done(self, lines, bytes_read, matches=None, exceptions=None):
+        """Writes the final progress line."""
+        self.update(lines, bytes_read, matches, exceptions, force=True)
+        self.sink.write('')
+        self.sink.flush()
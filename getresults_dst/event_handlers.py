@@ -7,32 +7,47 @@
 # you should have received as part of this distribution.
 #
 
+import fnmatch
 import magic
 import os
 import pwd
 import pytz
-import random
+import shlex
 import shutil
 import socket
-import string
+import tarfile
+import threading
+import time
 
 from os.path import join, exists, isfile, expanduser, split
 from os import listdir
 
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from contextlib import contextmanager
 from builtins import (
     IsADirectoryError, FileNotFoundError, PermissionError, FileExistsError)
 from datetime import datetime
-from paramiko import SFTPClient, SSHClient
+from paramiko import SFTPClient, SSHClient, SSHException
 from scp import SCPClient, SCPException
 from watchdog.events import PatternMatchingEventHandler
 
 from django.conf import settings
+from django.db.models import Q
 from django.utils import timezone
 
+from .archive import ArchiveStore
+from .console import console
 from .file_handlers import BaseFileHandler
 from .folder_handlers import BaseLookupFolderHandler, BaseFolderHandler
-from .models import TX_SENT, History
-from .mixins import SSHConnectMixin
+from .models import TX_SENT, History, Upload
+from .mixins import CLOSED, OPEN, CircuitBreaker, SSHConnectMixin
+from .rollups import record_sent
+from .ssh_pool import ssh_pool
+from .transfers import HashingReader, TransferVerifier, remote_prefix_hash, resumable_put
+from .pending_state import (
+    PendingState, QUEUED, DETECTED, SELECTING, SENDING, ARCHIVING, FAILED, DUPLICATE, BATCHED, SCHEDULED,
+    PARKED)
+from .utils import content_hash
 
 tz = pytz.timezone(settings.TIME_ZONE)
 
@@ -84,9 +99,18 @@ class BaseEventHandler(PatternMatchingEventHandler):
     def on_moved(self, event):
         self.process(event)
 
+    def on_tick(self):
+        """Called periodically by the server while observing."""
+        pass
+
+    def close(self):
+        """Called by the server when it stops observing."""
+        pass
+
     def output_to_console(self, msg):
+        """Queues msg for the console sink, so does not block on terminal I/O."""
         if self.verbose:
-            print(msg)
+            console.write(msg)
 
 
 class FolderEventHandler(BaseEventHandler):
@@ -95,13 +119,15 @@ class FolderEventHandler(BaseEventHandler):
     :func:`on_created` and on :func:`on_modified` and handled.
     """
     folder_handler = BaseFolderHandler()
+    archive_store = ArchiveStore()
     file_handler = BaseFileHandler
+    upload_mtime_tolerance = 60  # seconds between an uploaded file's mtime and Upload.upload_datetime
     patterns = ['*.*']
 
     def __init__(
             self, file_handler=None, source_dir=None, destination_dir=None, archive_dir=None,
             mkdir_local=None, mkdir_destination=None, mime_types=None, file_patterns=None,
-            touch_existing=None, file_mode=None, **kwargs):
+            touch_existing=None, file_mode=None, pending_state=None, archive_store=None, **kwargs):
         """
         :param file_handler: Custom file handler. If omitted the :class:`BaseFileHandler`
                              will be used by default.
@@ -128,6 +154,12 @@ class FolderEventHandler(BaseEventHandler):
         :param mkdir_destination: if True will attempt to create the remote folder or folders.
                              See also model RemoteFolder. (Default: False)
         :type mkdir_destination: boolean
+
+        :param pending_state: instance of :class:`PendingState` to track the pipeline stage
+                              of queued and in-flight files. (Default: a new instance)
+
+        :param archive_store: instance of :class:`ArchiveStore` that decides the archive layout,
+                              e.g. :class:`DateShardedArchiveStore`. (Default: flat)
         """
 
         super(FolderEventHandler, self).__init__(**kwargs)
@@ -142,6 +174,8 @@ class FolderEventHandler(BaseEventHandler):
         except TypeError:
             raise EventHandlerError('No patterns defined. Nothing to do. Got {}'.format(file_patterns))
         self.filename_max_length = 50
+        self.pending_state = pending_state or PendingState()
+        self.archive_store = archive_store or self.archive_store
         if file_handler:
             self.file_handler = file_handler(**kwargs)
         else:
@@ -158,44 +192,110 @@ class FolderEventHandler(BaseEventHandler):
         if exists(event.src_path):
             self.process_on_added(event)
 
+    def on_moved(self, event):
+        """Handles a file renamed into source_dir, e.g. by the upload handler."""
+        if split(event.dest_path)[0] == self.source_dir and exists(event.dest_path):
+            MovedEvent = type('event', (object, ), {'event_type': 'moved', 'src_path': event.dest_path})
+            self.process_on_added(MovedEvent())
+
     def process_existing_files(self):
         """Process existing files on startup."""
         self.output_to_console(
             '{} {}.'.format(timezone.now(), 'processing existing files on start...'))
-        for src_path in self.matching_files:
+        matching_files = list(self.matching_files)
+        for src_path in matching_files:
+            self.pending_state.set_stage(split(src_path)[1], QUEUED)
+        for src_path in matching_files:
             FakeEvent = type('event', (object, ), {'event_type': 'exists', 'src_path': src_path})
             self.process_on_added(FakeEvent())
+        self.on_tick()
         self.output_to_console('{} done processing existing files.'.format(timezone.now()))
         self.output_to_console('{} waiting ...'.format(timezone.now()))
 
     @property
     def matching_files(self):
         for file_pattern in self.patterns:
-            for file in filter(listdir(self.source_dir), file_pattern):
-                yield join(self.source_dir, file)
+            for file in fnmatch.filter(listdir(self.source_dir), file_pattern):
+                if not file.startswith('.'):
+                    yield join(self.source_dir, file)
 
     def process_on_added(self, event):
         """Moves file from source_dir to the destination_dir as
         determined by :func:`folder_handler.select`."""
-        self.output_to_console('{} {} {}'.format(timezone.now(), event.event_type, event.src_path))
         filename = event.src_path.split('/')[-1:][0]
+        if filename.startswith('.'):
+            return None  # hidden, e.g. an upload still being streamed
+        self.output_to_console('{} {} {}'.format(timezone.now(), event.event_type, event.src_path))
         path = join(self.source_dir, filename)
+        self.pending_state.set_stage(filename, DETECTED)
         mime_type = magic.from_file(path, mime=True)
         if mime_type in self.mime_types:
+            self.pending_state.set_stage(filename, SELECTING)
             folder_selection = self.folder_handler.select(self, filename, mime_type, self.destination_dir)
             if not folder_selection.path:
+                self.pending_state.set_stage(filename, FAILED)
                 self.output_to_console('Copy failed. Unable to \'select\' remote folder for {}'.format(filename))
                 return None
+            content_hash = self.get_content_hash(filename)
+            if self.already_sent(content_hash, folder_selection.path):
+                self.pending_state.set_stage(filename, DUPLICATE)
+                self.output_to_console(
+                    'Not sent. Same content as {} already sent to {}'.format(filename, folder_selection.path))
+                return None
+            elif self.queue(filename, folder_selection, mime_type, content_hash):
+                return None
             else:
-                fileinfo = self.copy_to_folder(filename, folder_selection.path)
-                if fileinfo:
-                    path = join(self.source_dir, filename)
-                    if self.archive_dir:
-                        fileinfo['archive_filename'] = self.archive_filename(filename)
-                        self.update_history(fileinfo, TX_SENT, folder_selection, mime_type)
-                        os.rename(path, join(self.archive_dir, fileinfo['archive_filename']))
-                    else:
-                        os.remove(path)
+                self.send(filename, folder_selection, mime_type, content_hash)
+        else:
+            self.pending_state.remove(filename)
+
+    def send(self, filename, folder_selection, mime_type, content_hash):
+        """Copies the file to the selected folder and archives it."""
+        self.pending_state.set_stage(filename, SENDING)
+        fileinfo = self.copy_to_folder(filename, folder_selection.path)
+        if fileinfo:
+            fileinfo.setdefault('content_hash', content_hash)
+            self.archive_sent(filename, fileinfo, folder_selection, mime_type)
+        else:
+            self.pending_state.set_stage(filename, FAILED)
+
+    def archive_sent(self, filename, fileinfo, folder_selection, mime_type):
+        """Moves a sent file to the archive and updates History."""
+        self.pending_state.set_stage(filename, ARCHIVING)
+        path = join(self.source_dir, filename)
+        if self.archive_dir:
+            fileinfo['archive_filename'] = self.archive_store.archive_name(
+                filename, content_hash=fileinfo.get('content_hash'))
+            self.update_history(fileinfo, TX_SENT, folder_selection, mime_type)
+            self.archive_store.store(
+                path, self.archive_dir, fileinfo['archive_filename'], file_hash=fileinfo.get('content_hash'))
+        else:
+            os.remove(path)
+        self.pending_state.remove(filename)
+
+    def queue(self, filename, folder_selection, mime_type, content_hash):
+        """Override to queue the file to be sent later, e.g. in a batch. Returns True if queued."""
+        return False
+
+    def get_content_hash(self, filename):
+        """Returns the content hash calculated on upload if the latest Upload of filename
+        matches the file by size and modification time, otherwise calculates it from the
+        file, e.g. a file copied into the folder that reuses the name of an earlier upload."""
+        path = join(self.source_dir, filename)
+        upload = Upload.objects.filter(
+            filename=filename, content_hash__isnull=False).order_by(
+            '-upload_datetime').values('content_hash', 'filesize', 'upload_datetime').first()
+        if upload:
+            stat = os.stat(path)
+            if (upload['filesize'] == stat.st_size and
+                    abs(upload['upload_datetime'].timestamp() - stat.st_mtime) <= self.upload_mtime_tolerance):
+                return upload['content_hash']
+        return content_hash(path=path)
+
+    def already_sent(self, content_hash, remote_path):
+        """Returns True if the same content was already sent to remote_path on this host."""
+        return History.objects.filter(
+            content_hash=content_hash, remote_hostname=self.hostname, remote_path=remote_path).exists()
 
     def check_folders(self, source_dir, archive_dir, destination_dir):
         """Check that folders exist and create if mkdir is True."""
@@ -256,26 +356,24 @@ class FolderEventHandler(BaseEventHandler):
             remote_path=folder_selection.path,
             remote_folder=folder_selection.name,
             remote_folder_tag=folder_selection.tag,
+            label=folder_selection.label,
             archive_path=self.archive_dir,
             filename=fileinfo['filename'],
             filesize=fileinfo['size'],
             filetimestamp=fileinfo['timestamp'],
             mime_type=mime_type,
+            content_hash=fileinfo.get('content_hash'),
             status=status,
             sent_datetime=timezone.now(),
             user=self.remote_user,
         )
-        history.archive.name = 'archive/{}'.format(fileinfo['archive_filename'])
+        history.archive.name = join(settings.GRTX_ARCHIVE_FOLDER, fileinfo['archive_filename'])
         history.save()
+        record_sent(history)
         return history
 
     def archive_filename(self, filename):
-        suffix = ''.join(random.SystemRandom().choice(string.ascii_uppercase + string.digits) for _ in range(5))
-        try:
-            f, ext = filename.split('.')
-        except ValueError:
-            f, ext = filename, ''
-        return '.'.join(['{}_{}'.format(f, suffix), ext])
+        return self.archive_store.archive_filename(filename)
 
     def touch_files(self):
         for filename in self.filtered_listdir(os.listdir(self.source_dir), self.source_dir):
@@ -328,19 +426,426 @@ class RemoteFolderEventHandler(FolderEventHandler, SSHConnectMixin):
     """
     folder_handler = BaseLookupFolderHandler()
     patterns = ['*.*']
+    batch_command = (
+        'cd {destination_dir} && tmp=$(mktemp -d .batch-XXXXXX) && '
+        '{{ tar x -C "$tmp" && mv -f "$tmp"/* . ; status=$?; rm -rf "$tmp"; exit $status; }}')
+
+    def __init__(self, timeout=None, banner_timeout=None, verify_transfer=None, verify_batch_size=None,
+                 resumable=None, transfer_retries=None, compression_policy=None, batch_window=None,
+                 batch_size=None, batch_retries=None, bandwidth=None, scheduler=None, keepalive_interval=None,
+                 connect_retries=None, circuit_breaker=None, health_interval=None, **kwargs):
+        """
+        :param keepalive_interval: seconds between SSH keepalive messages. (Default: 30)
+
+        :param connect_retries: number of times to retry a dropped connection, with exponential
+                                backoff, before the file is parked. (Default: 3)
+
+        :param circuit_breaker: instance of :class:`CircuitBreaker`. While it is open, new files
+                                are parked instead of waiting on the connection, and parked files
+                                are sent once the host is back. (Default: opens after 3 failures,
+                                half-opens after 60 seconds)
+
+        :param health_interval: seconds between probes of the transport on the server tick. (Default: 30)
+
+        :param bandwidth: instance of :class:`TokenBucket` to cap the rate files are read
+                          for sending. Share one instance to cap several handlers together.
+                          (Default: None, no cap)
+
+        :param scheduler: instance of :class:`TransferScheduler`. If set, files are sent on the
+                          scheduler's workers in order of priority class, the routing label
+                          or folder name. Not used if `batch_window` is set. (Default: None)
+
+        :param batch_window: if set, files are queued per remote folder and sent as one tar stream
+                             per folder once the oldest queued file has waited `batch_window` seconds
+                             or `batch_size` files are queued. (Default: None, send each file now)
+
+        :param batch_size: maximum number of files per batch. (Default: 500)
 
-    def __init__(self, timeout=None, banner_timeout=None, **kwargs):
+        :param batch_retries: number of times a file not confirmed on the remote host is queued
+                              for another batch before it is marked failed. (Default: 3)
+
+        :param compression_policy: instance of :class:`CompressionPolicy`. If set, files the policy
+                                   compresses are sent over a second, compressed, transport and other
+                                   files over `ssh` without compression. (Default: None, compress all)
+
+        :param resumable: if True, files are sent over SFTP to a hidden temp name in the remote
+                          folder, resumed from the remote size after a dropped connection and
+                          renamed into place when complete.
+        :type resumable: boolean
+
+        :param transfer_retries: number of times to reconnect and resume a resumable transfer. (Default: 5)
+
+        :param verify_transfer: if True, sent files are verified against the digest calculated
+                                while sending with one remote `sha256sum` per folder per batch.
+        :type verify_transfer: boolean
+
+        :param verify_batch_size: number of sent files per remote folder to verify at once. Pending
+                                  files are also verified on each server tick. (Default: 50)
+        """
         self.timeout = timeout or 5.0
         self.banner_timeout = banner_timeout or 45
         self.ssh = None
+        self.connection = None
+        self.local = threading.local()
+        self.verifier = TransferVerifier(verify_batch_size) if verify_transfer else None
+        self.resumable = resumable
+        self.transfer_retries = 5 if transfer_retries is None else transfer_retries
+        self.compression_policy = compression_policy
+        self.compress = False if compression_policy else True
+        self.ssh_compressed = None
+        self.batch_window = batch_window
+        self.batch_size = batch_size or 500
+        self.batch_retries = 3 if batch_retries is None else batch_retries
+        self.batch_attempts = {}
+        self.batches = {}
+        self.batch_lock = threading.Lock()
+        self.bandwidth = bandwidth
+        self.scheduler = scheduler
+        self.connect_lock = threading.RLock()
+        self.keepalive_interval = keepalive_interval or self.keepalive_interval
+        self.connect_retries = 3 if connect_retries is None else connect_retries
+        self.circuit_breaker = circuit_breaker or CircuitBreaker()
+        self.health_interval = health_interval or 30
+        self.health_checked = None
+        self.parked = {}
+        self.parked_lock = threading.Lock()
         super(RemoteFolderEventHandler, self).__init__(**kwargs)
+        if self.scheduler and not self.scheduler.pending_state:
+            self.scheduler.pending_state = self.pending_state
+
+    def on_tick(self):
+        self.check_connection()
+        self.send_batches()
+        self.verify_transfers()
+
+    def close(self):
+        if self.scheduler:
+            self.scheduler.stop()
+        if self.ssh_compressed:
+            self.ssh_compressed.close()
+            self.ssh_compressed = None
+
+    @contextmanager
+    def leased(self):
+        """Opens the channels of the calling thread on its own leases from :data:`ssh_pool`
+        until the block exits, so the scheduler's workers, the verifier and batches do not
+        share one lease and `GRTX_SSH_MAX_CHANNELS` bounds the channels open on a transport.
+
+        Does nothing if the handler's connection is not from the pool, e.g. in tests."""
+        if not self.connection or getattr(self.local, 'leases', None) is not None:
+            yield
+            return
+        self.local.leases = {}
+        try:
+            yield
+        finally:
+            leases, self.local.leases = self.local.leases, None
+            for connection in leases.values():
+                ssh_pool.release(connection)
+
+    def thread_ssh(self, compress=None):
+        """Returns the client the calling thread opens channels on, leased on first use
+        if in :func:`leased`, else `self.ssh` or, if compress, `self.ssh_compressed`."""
+        compress = self.compress if compress is None else compress
+        leases = getattr(self.local, 'leases', None)
+        if leases is not None:
+            if compress not in leases:
+                leases[compress] = ssh_pool.acquire(self, compress=compress, retries=self.connect_retries)
+            return leases[compress].ssh
+        elif compress == self.compress:
+            return self.ssh
+        with self.connect_lock:
+            if not self.ssh_compressed:
+                self.ssh_compressed = SSHClient()
+                self.connect(ssh=self.ssh_compressed, compress=True, retries=self.connect_retries)
+        return self.ssh_compressed
+
+    def is_connected(self):
+        """Returns True if the clients of the calling thread answer a probe."""
+        leases = getattr(self.local, 'leases', None)
+        clients = [connection.ssh for connection in leases.values()] if leases else [self.ssh]
+        return all(self.is_healthy(ssh, probe=True) for ssh in clients)
+
+    def ssh_for(self, filename):
+        """Returns the connection to send filename over, as decided by the compression policy."""
+        path = join(self.source_dir, filename)
+        compress = self.compress
+        if self.compression_policy:
+            compress = bool(self.compression_policy.compress(path, magic.from_file(path, mime=True)))
+        ssh = self.thread_ssh(compress)
+        if not self.is_healthy(ssh):
+            return self.reconnect(ssh)
+        return ssh
+
+    def reconnect(self, ssh=None, force=None, retries=None):
+        """Reconnects ssh unless its transport is active, e.g. another transfer thread already
+        reconnected, and returns the client to use from now on.
+
+        If ssh is the handler's lease from :data:`ssh_pool`, other handlers may share its
+        transport, so the lease is replaced with a lease on a new connection instead.
+
+        Raises :class:`ConnectionUnavailable` after `connect_retries` or if the circuit breaker is open."""
+        ssh = ssh or self.ssh
+        retries = self.connect_retries if retries is None else retries
+        leases = getattr(self.local, 'leases', None) or {}
+        with self.connect_lock:
+            if not force and self.is_healthy(ssh):
+                return ssh
+            for compress, connection in leases.items():
+                if ssh is connection.ssh:
+                    leases[compress] = ssh_pool.replace(connection, self, retries=retries)
+                    return leases[compress].ssh
+            if self.connection and ssh is self.connection.ssh:
+                self.connection = ssh_pool.replace(self.connection, self, retries=retries)
+                self.ssh = self.connection.ssh
+                return self.ssh
+            self.connect(ssh=ssh, compress=True if ssh is self.ssh_compressed else None, retries=retries)
+        return ssh
+
+    def check_connection(self):
+        """Probes the connection at most every `health_interval` seconds, reconnects a dead
+        transport once the circuit breaker allows and then sends parked files.
+
+        If the transport is up but the circuit is not closed, e.g. the failures were on the
+        compressed or another pooled connection, the half-open trial is a probe instead."""
+        if not self.ssh:
+            return None
+        probe = not self.health_checked or time.time() - self.health_checked >= self.health_interval
+        if probe:
+            self.health_checked = time.time()
+        if not self.is_healthy(self.ssh, probe=probe):
+            if self.circuit_breaker.state == OPEN:
+                return None
+            try:
+                self.reconnect(self.ssh, retries=0)
+            except (SSHException, socket.error) as e:
+                self.output_to_console('{} {}. {} files parked.'.format(
+                    timezone.now(), str(e) or e.__class__.__name__, len(self.parked)))
+                return None
+        elif self.circuit_breaker.state != CLOSED and not self.probe_half_open():
+            return None
+        self.send_parked()
+
+    def probe_half_open(self):
+        """Runs the half-open trial as a probe of the transport. Returns True if the circuit closed."""
+        if not self.circuit_breaker.allow():
+            return False
+        try:
+            if self.is_healthy(self.ssh, probe=True):
+                self.circuit_breaker.record_success()
+                return True
+            self.circuit_breaker.record_failure()
+            return False
+        finally:
+            self.circuit_breaker.end_trial()
+
+    def park(self, filename, folder_selection, mime_type, content_hash):
+        """Keeps the file until the host is back instead of waiting on the connection."""
+        with self.parked_lock:
+            self.parked[filename] = (folder_selection, mime_type, content_hash)
+        self.pending_state.set_stage(filename, PARKED)
+
+    def send_parked(self):
+        with self.parked_lock:
+            parked, self.parked = self.parked, {}
+        if parked:
+            self.output_to_console('{} sending {} parked files.'.format(timezone.now(), len(parked)))
+        for filename, (folder_selection, mime_type, file_hash) in sorted(parked.items()):
+            if not isfile(join(self.source_dir, filename)):
+                self.pending_state.remove(filename)
+            elif not self.queue(filename, folder_selection, mime_type, file_hash):
+                self.send(filename, folder_selection, mime_type, file_hash)
+
+    def queue(self, filename, folder_selection, mime_type, content_hash):
+        if self.circuit_breaker.state != CLOSED:
+            self.park(filename, folder_selection, mime_type, content_hash)
+            return True
+        elif self.batch_window:
+            return self.queue_for_batch(filename, folder_selection, mime_type, content_hash)
+        elif self.scheduler:
+            self.pending_state.set_stage(filename, SCHEDULED)
+            self.scheduler.submit(
+                self.send_scheduled, (filename, folder_selection, mime_type, content_hash),
+                priority_class=self.priority_class(folder_selection),
+                destination='{}:{}'.format(self.hostname, folder_selection.path),
+                key=filename)  # skipped if the file is already queued or in flight
+            return True
+        return False
+
+    def priority_class(self, folder_selection):
+        """Returns the routing label of the folder selection or, if none, the folder name."""
+        return folder_selection.label or os.path.basename(folder_selection.path.rstrip('/'))
+
+    def send_scheduled(self, filename, folder_selection, mime_type, content_hash):
+        """Sends a file on a scheduler worker. The file may have been removed while queued."""
+        if not isfile(join(self.source_dir, filename)):
+            self.pending_state.remove(filename)
+            return None
+        elif self.circuit_breaker.state != CLOSED:
+            self.park(filename, folder_selection, mime_type, content_hash)
+            return None
+        try:
+            self.send(filename, folder_selection, mime_type, content_hash)
+        except SCPException as e:
+            self.pending_state.set_stage(filename, FAILED)
+            self.output_to_console('{} {} sending {}.'.format(timezone.now(), str(e), filename))
+
+    def send(self, filename, folder_selection, mime_type, content_hash):
+        """Sends the file or, if the connection is down, parks it."""
+        with self.leased():
+            try:
+                super(RemoteFolderEventHandler, self).send(filename, folder_selection, mime_type, content_hash)
+            except (SSHException, EOFError, socket.error) as e:
+                if self.is_connected():
+                    self.pending_state.set_stage(filename, FAILED)
+                else:
+                    self.park(filename, folder_selection, mime_type, content_hash)
+                self.output_to_console('{} {} sending {}.'.format(
+                    timezone.now(), str(e) or e.__class__.__name__, filename))
+
+    def queue_for_batch(self, filename, folder_selection, mime_type, content_hash):
+        with self.batch_lock:
+            batch = self.batches.setdefault(folder_selection.path, {'opened': time.time(), 'files': {}})
+            batch['files'][filename] = (folder_selection, mime_type, content_hash)
+        self.pending_state.set_stage(filename, BATCHED)
+        return True
+
+    def send_batches(self, force=None):
+        """Sends each batch that is full or has waited batch_window seconds."""
+        if not self.batch_window or self.circuit_breaker.state != CLOSED:
+            return None
+        with self.batch_lock:
+            due = [path for path, batch in self.batches.items()
+                   if force or len(batch['files']) >= self.batch_size or
+                   time.time() - batch['opened'] >= self.batch_window]
+            batches = [(path, self.batches.pop(path)['files']) for path in due]
+        for path, files in batches:
+            filenames = sorted(files)
+            for start in range(0, len(filenames), self.batch_size):
+                items = [(filename, ) + files[filename] for filename in filenames[start:start + self.batch_size]]
+                with self.leased():
+                    try:
+                        self.send_batch(path, items)
+                    except (SSHException, EOFError, socket.error) as e:
+                        self.output_to_console('{} {} sending batch to {}. Will retry.'.format(
+                            timezone.now(), str(e) or e.__class__.__name__, path))
+                        self.requeue_batch(items)
+                        if not self.is_connected():
+                            self.circuit_breaker.record_failure()
+                            self.health_checked = None
+
+    def requeue_batch(self, items, unconfirmed=None):
+        """Queues the files of a batch that are still in the upload folder for the next batch.
+
+        If :param:`unconfirmed`, the files were sent but not confirmed, and a file is marked
+        failed instead once it was not confirmed `batch_retries` times."""
+        for filename, folder_selection, mime_type, file_hash in items:
+            attempts = self.batch_attempts.get(filename, 0) + (1 if unconfirmed else 0)
+            if not isfile(join(self.source_dir, filename)):
+                self.batch_attempts.pop(filename, None)
+                self.pending_state.remove(filename)
+            elif attempts > self.batch_retries:
+                self.batch_attempts.pop(filename, None)
+                self.pending_state.set_stage(filename, FAILED)
+                self.output_to_console('{} {} not confirmed after {} batches, not retrying.'.format(
+                    timezone.now(), filename, attempts))
+            else:
+                self.batch_attempts[filename] = attempts
+                self.queue_for_batch(filename, folder_selection, mime_type, file_hash)
+
+    def send_batch(self, destination_dir, items):
+        """Streams the files as one tar to `tar x` into a hidden temp folder in destination_dir
+        on the remote host, then moves them into place, so remote readers never see a partial
+        file. Archives and updates History for each file confirmed by size on the remote host.
+        If tar fails, no file is confirmed. Unconfirmed files are queued again, see :func:`requeue_batch`.
+
+        :param items: list of (filename, folder_selection, mime_type, content_hash)"""
+        sent = {}
+        ssh = self.thread_ssh()
+        for filename, _, _, _ in items:
+            self.pending_state.set_stage(filename, SENDING)
+        _, stdout, stderr = ssh.exec_command(
+            self.batch_command.format(destination_dir=shlex.quote(destination_dir)))
+        channel = stdout.channel
+        with tarfile.open(fileobj=ChannelWriter(channel), mode='w|') as tar:
+            for filename, _, _, _ in items:
+                path = join(self.source_dir, filename)
+                if not isfile(path):
+                    continue
+                fileinfo = self.statinfo(self.source_dir, filename)
+                tarinfo = tarfile.TarInfo(filename)
+                tarinfo.size = fileinfo['size']
+                tarinfo.mtime = fileinfo['timestamp'].timestamp()
+                tarinfo.mode = 0o644
+                with open(path, 'rb') as f:
+                    reader = HashingReader(f, bandwidth=self.bandwidth)
+                    tar.addfile(tarinfo, fileobj=reader)
+                fileinfo['content_hash'] = reader.hexdigest()
+                sent[filename] = fileinfo
+        channel.shutdown_write()
+        if channel.recv_exit_status():
+            self.output_to_console('{} tar x into {} failed. Got {}'.format(
+                timezone.now(), destination_dir, stderr.read().decode().strip()))
+            remote_sizes = {}
+        else:
+            remote_sizes = self.remote_sizes(ssh, destination_dir, list(sent))
+        confirmed, unconfirmed = 0, []
+        for item in items:
+            filename, folder_selection, mime_type, _ = item
+            fileinfo = sent.get(filename)
+            if fileinfo and remote_sizes.get(filename) == fileinfo['size']:
+                self.batch_attempts.pop(filename, None)
+                self.archive_sent(filename, fileinfo, folder_selection, mime_type)
+                confirmed += 1
+            else:
+                unconfirmed.append(item)
+                self.output_to_console('{} not confirmed on remote host: {}'.format(timezone.now(), filename))
+        self.requeue_batch(unconfirmed, unconfirmed=True)
+        self.output_to_console('{} sent batch of {} of {} files to {}'.format(
+            timezone.now(), confirmed, len(items), destination_dir))
+        return confirmed
+
+    def remote_sizes(self, ssh, remote_path, filenames):
+        """Returns a dictionary of {filename: size} of the files in remote_path from one exec.
+
+        Files missing on the remote host are not in the dictionary."""
+        if not filenames:
+            return {}
+        command = 'cd {} && stat -c \'%s %n\' -- {}'.format(
+            shlex.quote(remote_path), ' '.join(shlex.quote(filename) for filename in filenames))
+        _, stdout, _ = ssh.exec_command(command)
+        remote_sizes = {}
+        for line in stdout.read().decode().splitlines():
+            try:
+                size, filename = line.split(' ', 1)
+                remote_sizes[filename] = int(size)
+            except ValueError:
+                continue
+        return remote_sizes
+
+    def update_history(self, fileinfo, status, folder_selection, mime_type):
+        history = super(RemoteFolderEventHandler, self).update_history(
+            fileinfo, status, folder_selection, mime_type)
+        if self.verifier and self.verifier.add(history):
+            self.verify_transfers(history.remote_path)
+        return history
+
+    def verify_transfers(self, remote_path=None):
+        """Verifies pending sent files of remote_path or of all remote folders."""
+        if not self.verifier or not self.ssh:
+            return None
+        with self.leased():
+            verified, mismatched = self.verifier.flush(self.thread_ssh(), remote_path)
+        if verified:
+            self.output_to_console('{} verified {} sent files.'.format(timezone.now(), len(verified)))
+        for filename in mismatched:
+            self.output_to_console('{} checksum mismatch on remote host for {}'.format(timezone.now(), filename))
 
     def check_folders(self, source_dir, archive_dir, destination_dir):
         """Checks that all working folders, source, destination (on remote) and archive exist."""
         self.source_dir = self.check_local_path(source_dir)
         self.archive_dir = self.check_local_path(archive_dir)
-        with SSHClient() as ssh:
-            self.connect(ssh=ssh)
+        with ssh_pool.lease(self) as ssh:
             self.destination_dir = self.check_destination_path(destination_dir, ssh=ssh)
 
     def copy_to_folder(self, filename, destination_dir):
@@ -351,18 +856,25 @@ class RemoteFolderEventHandler(FolderEventHandler, SSHConnectMixin):
         @type filename: str
 
         @return fileinfo dict"""
-        with SCPClient(self.ssh.get_transport()) as scp_client:
-            try:
-                fileinfo = self.put(filename, destination_dir, scp_client)
-            except SCPException as e:
-                if 'No response from server' in str(e):
-                    self.reconnect()
+        if not isfile(join(self.source_dir, filename)):
+            return None
+        with self.leased():
+            ssh = self.ssh_for(filename)
+            if self.resumable:
+                return self.put_resumable(filename, destination_dir, ssh=ssh)
+            with SCPClient(ssh.get_transport()) as scp_client:
+                try:
                     fileinfo = self.put(filename, destination_dir, scp_client)
-                elif 'Permission denied' in str(e):
-                    self.output_to_console('{}, skipping ...'.format(str(e)))
-                    fileinfo = None  # skip
-                else:
-                    raise
+                except SCPException as e:
+                    if 'No response from server' in str(e):
+                        ssh = self.reconnect(ssh, force=True)
+                        with SCPClient(ssh.get_transport()) as scp_client:
+                            fileinfo = self.put(filename, destination_dir, scp_client)
+                    elif 'Permission denied' in str(e):
+                        self.output_to_console('{}, skipping ...'.format(str(e)))
+                        fileinfo = None  # skip
+                    else:
+                        raise
         return fileinfo
 
     def put(self, filename, destination_dir, scp_client):
@@ -383,12 +895,53 @@ class RemoteFolderEventHandler(FolderEventHandler, SSHConnectMixin):
             return None
         fileinfo = self.statinfo(self.source_dir, filename)
         try:
-            scp_client.put(
-                source_filename,
-                destination_filename,
-            )
+            with open(source_filename, 'rb') as f:
+                reader = HashingReader(f, bandwidth=self.bandwidth)
+                scp_client.putfo(
+                    reader,
+                    destination_filename,
+                    mode='0{:o}'.format(os.fstat(f.fileno()).st_mode & 0o777),
+                    size=fileinfo['size'],
+                )
         except IsADirectoryError:
             fileinfo = None
+        else:
+            fileinfo['content_hash'] = reader.hexdigest()
+        return fileinfo
+
+    def put_resumable(self, filename, destination_dir, ssh=None):
+        """Sends the file over SFTP to `.<filename>.part` in destination_dir and renames
+        it into place when complete, so remote readers never see a partial file.
+
+        If the connection drops, reconnects and resumes from the size of the partial file.
+
+        @return fileinfo dict"""
+        source_filename = join(self.source_dir, filename)
+        if not isfile(source_filename):
+            return None
+        fileinfo = self.statinfo(self.source_dir, filename)
+        part_filename = join(destination_dir, '.{}.part'.format(filename))
+        ssh = ssh or self.ssh
+        attempts = 0
+        while True:
+            try:
+                with SFTPClient.from_transport(ssh.get_transport()) as sftp:
+                    digest, offset = resumable_put(
+                        sftp, source_filename, part_filename, fileinfo['size'], bandwidth=self.bandwidth,
+                        remote_digest=lambda path, size: remote_prefix_hash(ssh, path, size))
+                    sftp.posix_rename(part_filename, join(destination_dir, filename))
+                break
+            except (SSHException, EOFError, socket.error) as e:
+                transport = ssh.get_transport()
+                if (transport and transport.is_active()) or attempts >= self.transfer_retries:
+                    raise
+                attempts += 1
+                self.output_to_console('{} {} sending {}. Reconnecting to resume ...'.format(
+                    timezone.now(), str(e) or e.__class__.__name__, filename))
+                ssh = self.reconnect(ssh)
+        if offset:
+            self.output_to_console('{} resumed {} from byte {}.'.format(timezone.now(), filename, offset))
+        fileinfo['content_hash'] = digest
         return fileinfo
 
     def check_destination_path(self, path, mkdir_destination=None, ssh=None):
@@ -438,3 +991,226 @@ class RemoteFolderEventHandler(FolderEventHandler, SSHConnectMixin):
                 sftp.mkdir(basename)  # sub-directory missing, so created it
                 sftp.chdir(basename)
                 return True
+
+
+class Destination(object):
+    """A remote destination of :class:`FanOutEventHandler` with its own event handler and connection."""
+
+    def __init__(self, name, handler, required=None):
+        self.name = name
+        self.handler = handler
+        self.required = True if required is None else required
+
+    def __repr__(self):
+        return '{}({}, {}@{})'.format(
+            self.__class__.__name__, self.name, self.handler.remote_user, self.handler.hostname)
+
+
+class FanOutEventHandler(FolderEventHandler):
+
+    """A folder handler that sends each file to several remote destinations at once.
+
+    Each destination is a :class:`RemoteFolderEventHandler` (or `handler_class`) with its own
+    hostname, connection and folder handler. The file is archived once all required destinations
+    have it and a History row is written per destination. If a required destination fails, the
+    file stays in the upload folder and is retried every `retry_interval` seconds, sending only to
+    destinations that do not have it yet.
+
+    For example:
+
+        FanOutEventHandler(
+            destinations=[
+                {'name': 'clinic', 'hostname': 'edc.example.com', 'destination_dir': '~/viral_load'},
+                {'name': 'warehouse', 'hostname': 'dw.example.com', 'destination_dir': '~/results',
+                 'required': False}],
+            source_dir=source_dir, archive_dir=archive_dir, ...)
+    """
+    patterns = ['*.*']
+
+    def __init__(self, destinations=None, handler_class=None, retry_interval=None, **kwargs):
+        """
+        :param destinations: list of dictionaries of `name`, `required` (Default: True) and the
+                             keyword arguments of `handler_class` for each destination,
+                             e.g. hostname, remote_user, destination_dir.
+
+        :param handler_class: the event handler class of each destination. (Default: RemoteFolderEventHandler)
+
+        :param retry_interval: seconds before retrying a file a required destination did not get. (Default: 60)
+        """
+        if not destinations:
+            raise EventHandlerError('No destinations defined. Nothing to do. Got {}'.format(destinations))
+        super(FanOutEventHandler, self).__init__(**kwargs)
+        handler_class = handler_class or RemoteFolderEventHandler
+        self.retry_interval = 60 if retry_interval is None else retry_interval
+        self.deliveries = {}
+        self.archive_names = {}
+        self.retry_at = {}
+        self.lock = threading.RLock()
+        self.destinations = []
+        for options in destinations:
+            options = dict(options)
+            name, required = options.pop('name'), options.pop('required', None)
+            for key in ['source_dir', 'archive_dir', 'mkdir_local', 'mkdir_destination']:
+                options.setdefault(key, getattr(self, key, None))
+            options.setdefault('mime_types', [s.decode() for s in self.mime_types])
+            options.setdefault('file_patterns', self.file_patterns)
+            options.setdefault('trusted_host', self.trusted_host)
+            options.setdefault('verbose', self.verbose)
+            options['pending_state'] = self.pending_state
+            self.destinations.append(Destination(name, handler_class(**options), required))
+        self.executor = ThreadPoolExecutor(max_workers=len(self.destinations))
+
+    def check_folders(self, source_dir, archive_dir, destination_dir):
+        """Checks the local folders. Each destination checks its own remote folder."""
+        self.source_dir = self.check_local_path(source_dir)
+        self.archive_dir = self.check_local_path(archive_dir)
+        self.destination_dir = None
+
+    def connect(self):
+        """Leases a connection from the pool for each destination. Destinations on the
+        same host and account share a transport."""
+        for destination in self.destinations:
+            if not destination.handler.connection:
+                destination.handler.connection = ssh_pool.acquire(destination.handler)
+            destination.handler.ssh = destination.handler.connection.ssh
+
+    def close(self):
+        for destination in self.destinations:
+            destination.handler.close()
+            destination.handler.ssh = None
+            if destination.handler.connection:
+                ssh_pool.release(destination.handler.connection)
+                destination.handler.connection = None
+        self.executor.shutdown()
+
+    def on_tick(self):
+        for destination in self.destinations:
+            destination.handler.on_tick()
+        now = time.time()
+        for filename, retry_at in list(self.retry_at.items()):
+            if retry_at <= now:
+                src_path = join(self.source_dir, filename)
+                if not isfile(src_path):
+                    self.retry_at.pop(filename, None)
+                    self.deliveries.pop(filename, None)
+                    self.archive_names.pop(filename, None)
+                    continue
+                RetryEvent = type('event', (object, ), {'event_type': 'retry', 'src_path': src_path})
+                self.process_on_added(RetryEvent())
+
+    def process_on_added(self, event):
+        """Sends the file to each destination that does not have it yet, concurrently, and
+        archives it once all required destinations have it.
+
+        The History row of each destination is written as soon as it has the file, so a
+        destination that has the file is not sent it again after a restart."""
+        filename = split(event.src_path)[1]
+        if filename.startswith('.'):
+            return None  # hidden, e.g. an upload still being streamed
+        with self.lock:
+            path = join(self.source_dir, filename)
+            if not isfile(path):
+                return None
+            self.output_to_console('{} {} {}'.format(timezone.now(), event.event_type, event.src_path))
+            self.pending_state.set_stage(filename, DETECTED)
+            mime_type = magic.from_file(path, mime=True)
+            if mime_type not in self.mime_types:
+                self.pending_state.remove(filename)
+                return None
+            file_hash = self.get_content_hash(filename)
+            self.pending_state.set_stage(filename, SELECTING)
+            pending = self.select_destinations(filename, mime_type, file_hash)
+            self.pending_state.set_stage(filename, SENDING)
+            self.deliver(filename, mime_type, file_hash, pending)
+            deliveries = self.deliveries[filename]
+            missing = [d.name for d in self.destinations if d.required and d.name not in deliveries]
+            if missing:
+                self.pending_state.set_stage(filename, FAILED)
+                self.retry_at[filename] = time.time() + self.retry_interval
+                self.output_to_console('{} {} not sent to {}. Will retry.'.format(
+                    timezone.now(), filename, ', '.join(missing)))
+                return None
+            self.archive_delivered(filename, file_hash)
+
+    def select_destinations(self, filename, mime_type, file_hash):
+        """Returns a list of (destination, folder_selection) of the destinations that do not have
+        the file. Destinations with History of the same content are recorded as delivered."""
+        deliveries = self.deliveries.setdefault(filename, {})
+        pending = []
+        for destination in self.destinations:
+            if destination.name in deliveries:
+                continue
+            handler = destination.handler
+            folder_selection = handler.folder_handler.select(handler, filename, mime_type, handler.destination_dir)
+            if not folder_selection.path:
+                self.output_to_console('Copy failed. Unable to \'select\' remote folder on {} for {}'.format(
+                    destination.name, filename))
+            elif handler.already_sent(file_hash, folder_selection.path):
+                deliveries[destination.name] = folder_selection.path
+            else:
+                pending.append((destination, folder_selection))
+        return pending
+
+    def deliver(self, filename, mime_type, file_hash, pending):
+        """Sends the file to the pending destinations concurrently and writes the History
+        row of each destination that got it."""
+        deliveries = self.deliveries[filename]
+        futures = {
+            self.executor.submit(destination.handler.copy_to_folder, filename, folder_selection.path): (
+                destination, folder_selection) for destination, folder_selection in pending}
+        for future in as_completed(futures):
+            destination, folder_selection = futures[future]
+            try:
+                fileinfo = future.result()
+            except (SSHException, SCPException, EOFError, OSError) as e:
+                fileinfo = None
+                self.output_to_console('{} {} sending {} to {}'.format(
+                    timezone.now(), str(e) or e.__class__.__name__, filename, destination.name))
+            if fileinfo:
+                fileinfo.setdefault('content_hash', file_hash)
+                if self.archive_dir:
+                    fileinfo['archive_filename'] = self.archive_name(filename, file_hash)
+                    destination.handler.update_history(fileinfo, TX_SENT, folder_selection, mime_type)
+                deliveries[destination.name] = folder_selection.path
+
+    def archive_name(self, filename, file_hash):
+        """Returns the archive name of the file, the same for all destinations."""
+        if filename not in self.archive_names:
+            self.archive_names[filename] = self.archive_store.archive_name(filename, content_hash=file_hash)
+        return self.archive_names[filename]
+
+    def archive_delivered(self, filename, file_hash):
+        """Moves the file to the archive. If the file was delivered before a restart, the
+        History rows written then are updated to the archive name used now."""
+        deliveries = self.deliveries.pop(filename, {})
+        self.retry_at.pop(filename, None)
+        self.pending_state.set_stage(filename, ARCHIVING)
+        path = join(self.source_dir, filename)
+        if self.archive_dir:
+            archive_filename = self.archive_name(filename, file_hash)
+            delivered = Q()
+            for destination in self.destinations:
+                if destination.name in deliveries:
+                    delivered |= Q(
+                        remote_hostname=destination.handler.hostname, remote_path=deliveries[destination.name])
+            if deliveries:
+                History.objects.filter(
+                    delivered, filename=filename, content_hash=file_hash).exclude(
+                    archive=join(settings.GRTX_ARCHIVE_FOLDER, archive_filename)).update(
+                    archive=join(settings.GRTX_ARCHIVE_FOLDER, archive_filename))
+            self.archive_store.store(path, self.archive_dir, archive_filename, file_hash=file_hash)
+        else:
+            os.remove(path)
+        self.archive_names.pop(filename, None)
+        self.pending_state.remove(filename)
+
+
+class ChannelWriter(object):
+    """A file-like object that writes to the stdin of a remote command."""
+
+    def __init__(self, channel):
+        self.channel = channel
+
+    def write(self, data):
+        self.channel.sendall(data)
+        return len(data)
@@ -0,0 +1,107 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2015 Erik van Widenfelt
+# All rights reserved.
+#
+# This software is licensed as described in the file COPYING, which
+# you should have received as part of this distribution.
+#
+
+import csv
+import json
+import zlib
+
+from .models import Acknowledgment, History
+
+CSV = 'csv'
+JSONL = 'jsonl'
+FORMATS = (CSV, JSONL)
+
+EXPORTS = {
+    'history': (History, [
+        'id', 'filename', 'filesize', 'filetimestamp', 'mime_type', 'content_hash', 'status', 'sent_datetime',
+        'hostname', 'path', 'remote_hostname', 'remote_path', 'remote_folder', 'remote_folder_tag',
+        'label', 'archive', 'acknowledged', 'ack_datetime', 'ack_user', 'user']),
+    'acknowledgment': (Acknowledgment, [
+        'id', 'filename', 'ack_user', 'ack_datetime', 'in_sent_history', 'created', 'ack_string']),
+}
+
+
+class ExportError(Exception):
+    pass
+
+
+class Echo(object):
+    """A file-like object for csv.writer that returns what is written."""
+    def write(self, value):
+        return value
+
+
+def iter_rows(queryset, fields, chunk_size=None):
+    """Yields rows of the queryset as tuples of values in chunks ordered by pk.
+
+    Each chunk is a separate query that seeks from the last pk of the previous
+    chunk, so memory use is constant regardless of the number of rows."""
+    chunk_size = chunk_size or 2000
+    last_pk = None
+    while True:
+        chunk = queryset.order_by('pk')
+        if last_pk is not None:
+            chunk = chunk.filter(pk__gt=last_pk)
+        count = 0
+        for row in chunk.values_list('pk', *fields)[:chunk_size].iterator():
+            count += 1
+            last_pk = row[0]
+            yield row[1:]
+        if count < chunk_size:
+            break
+
+
+def serialize(value):
+    try:
+        return value.isoformat()
+    except AttributeError:
+        return value
+
+
+def export_lines(name, fmt, queryset=None, chunk_size=None):
+    """Yields lines of CSV (with a header) or JSONL for the export `name`."""
+    try:
+        model, fields = EXPORTS[name]
+    except KeyError:
+        raise ExportError('Unknown export. Expected one of {}. Got {}'.format(', '.join(EXPORTS), name))
+    if fmt not in FORMATS:
+        raise ExportError('Unknown format. Expected one of {}. Got {}'.format(', '.join(FORMATS), fmt))
+    queryset = model.objects.all() if queryset is None else queryset
+    rows = iter_rows(queryset, fields, chunk_size)
+    if fmt == CSV:
+        writer = csv.writer(Echo())
+        yield writer.writerow(fields)
+        for row in rows:
+            yield writer.writerow([serialize(value) for value in row])
+    else:
+        for row in rows:
+            yield json.dumps(dict(zip(fields, [serialize(value) for value in row]))) + '\n'
+
+
+def export_stream(name, fmt, queryset=None, compress=None, buffer_size=None):
+    """Yields the export as blocks of bytes, gzipped if compress is True."""
+    buffer_size = buffer_size or 65536
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS) if compress else None
+    block = []
+    size = 0
+    for line in export_lines(name, fmt, queryset):
+        data = line.encode()
+        block.append(data)
+        size += len(data)
+        if size >= buffer_size:
+            data = b''.join(block)
+            block, size = [], 0
+            data = compressor.compress(data) if compressor else data
+            if data:
+                yield data
+    data = b''.join(block)
+    if compressor:
+        data = compressor.compress(data) + compressor.flush()
+    if data:
+        yield data
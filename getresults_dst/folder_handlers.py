@@ -23,13 +23,14 @@ class FolderHandlerError(Exception):
 class FolderSelection(object):
     """A class of the attributes of the folder to be returned to the event handler."""
 
-    def __init__(self, folder_name=None, full_path=None, tag=None):
+    def __init__(self, folder_name=None, full_path=None, tag=None, label=None):
         self.name = folder_name
         try:
             self.path = os.path.expanduser(full_path)
         except AttributeError:
             self.path = None
         self.tag = tag
+        self.label = label
 
     def __repr__(self):
         return '{}({} {})'.format(self.__class__.__name__, self.name, self.tag)
@@ -44,11 +45,12 @@ class BaseFolderHandler(object):
 
     def select(self, instance, filename, mime_type, base_path):
         """Called by the event handler."""
-        folder_name, full_path, tag = self.select_folder(instance, filename, mime_type, base_path)
-        return self.folder_selection(folder_name, full_path, tag)
+        return self.folder_selection(*self.select_folder(instance, filename, mime_type, base_path))
 
     def select_folder(self, instance, filename, mime_type, base_path):
-        """Override to select a folder"""
+        """Override to select a folder.
+
+        Returns a tuple of (folder_name, full_path, tag) or (folder_name, full_path, tag, label)."""
         folder_name, full_path, tag = os.path.split(base_path)[1], base_path, None
         return folder_name, full_path, tag
 
@@ -114,7 +116,8 @@ class BaseLookupFolderHandler(BaseFolderHandler):
             folder_name = None
             full_path = None
             tag = None
-        return folder_name, full_path, tag
+            label = None
+        return folder_name, full_path, tag, label
 
     @property
     def folder_tags(self):
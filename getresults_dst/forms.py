@@ -1,7 +1,16 @@
-from django.core.exceptions import MultipleObjectsReturned
-from django.forms import ModelForm, ValidationError
+from django.db.models import Q
+from django.forms import ClearableFileInput, FileField, Form, ModelForm, ValidationError
 
 from .models import Upload, History
+from .utils import content_hash
+
+
+def duplicate_q(filename, content_hash=None):
+    """Returns a Q matching rows with the filename or the content hash."""
+    q = Q(filename=filename)
+    if content_hash:
+        q = q | Q(content_hash=content_hash)
+    return q
 
 
 class UploadForm (ModelForm):
@@ -11,44 +20,60 @@ class UploadForm (ModelForm):
         file = cleaned_data.get('file', None)
         try:
             filename = file.name
-            self.raise_if_upload(filename)
-            self.raise_if_history(filename)
         except AttributeError:
-            pass
+            return self.cleaned_data
+        # calculated while streaming by upload_handlers.UploadFolderFileHandler
+        content_hash = getattr(file, 'content_hash', None) or self.content_hash(file)
+        mime_type = getattr(file, 'mime_type', None) or cleaned_data.get('mime_type')
+        self.raise_if_upload(filename, content_hash)
+        self.raise_if_history(filename, content_hash)
+        cleaned_data['content_hash'] = self.instance.content_hash = content_hash
+        cleaned_data['mime_type'] = self.instance.mime_type = mime_type
         return self.cleaned_data
 
-    def raise_if_upload(self, filename):
-        try:
-            upload = Upload.objects.get(filename=filename)
+    def content_hash(self, file):
+        file.seek(0)
+        value = content_hash(file)
+        file.seek(0)
+        return value
+
+    def raise_if_upload(self, filename, content_hash=None):
+        """Raises if an upload has the same filename or content, in one query."""
+        uploads = list(Upload.objects.filter(
+            duplicate_q(filename, content_hash)).order_by('upload_datetime'))
+        if len(uploads) == 1:
             raise ValidationError(
                 'File already uploaded. Got \'{}\' uploaded on \'{}\'.'.format(
-                    filename, upload.upload_datetime.strftime('%Y-%m-%d %H:%M')))
-        except MultipleObjectsReturned:
-            upload_dates = []
-            for upload in Upload.objects.filter(filename=filename).order_by('upload_datetime'):
-                upload_dates.append(upload.upload_datetime.strftime('%Y-%m-%d %H:%M'))
+                    uploads[0].filename, uploads[0].upload_datetime.strftime('%Y-%m-%d %H:%M')))
+        elif uploads:
             raise ValidationError(
                 'File uploaded more than once already. Got  \'{}\' uploaded on {}.'.format(
-                    filename, ', '.join(upload_dates)))
-        except Upload.DoesNotExist:
-            pass
+                    filename, ', '.join(
+                        ['{} ({})'.format(upload.upload_datetime.strftime('%Y-%m-%d %H:%M'), upload.filename)
+                         for upload in uploads])))
 
-    def raise_if_history(self, filename):
-        try:
-            history = History.objects.get(filename=filename)
+    def raise_if_history(self, filename, content_hash=None):
+        """Raises if a sent file has the same filename or content, in one query."""
+        histories = list(History.objects.filter(
+            duplicate_q(filename, content_hash)).order_by('sent_datetime'))
+        if len(histories) == 1:
             raise ValidationError(
                 'File already uploaded and sent. Got \'{}\' sent on \'{}\'.'.format(
-                    filename, history.sent_datetime.strftime('%Y-%m-%d %H:%M')))
-        except MultipleObjectsReturned:
-            sent_dates = []
-            for history in History.objects.filter(filename=filename).order_by('sent_datetime'):
-                sent_dates.append(history.sent_datetime.strftime('%Y-%m-%d %H:%M'))
+                    histories[0].filename, histories[0].sent_datetime.strftime('%Y-%m-%d %H:%M')))
+        elif histories:
             raise ValidationError(
                 'File uploaded and sent more than once already. Got  \'{}\' sent on {}.'.format(
-                    filename, ', '.join(sent_dates)))
-        except History.DoesNotExist:
-            pass
+                    filename, ', '.join(
+                        ['{} ({})'.format(history.sent_datetime.strftime('%Y-%m-%d %H:%M'), history.filename)
+                         for history in histories])))
 
     class Meta:
         model = Upload
         fields = '__all__'
+
+
+class BulkUploadForm(Form):
+
+    files = FileField(
+        widget=ClearableFileInput(attrs={'multiple': True}),
+        help_text='Select many files or a single zip or tar archive.')
@@ -9,12 +9,14 @@
 
 import pytz
 import re
-import sys
 
 from apache_log_parser import make_parser, LineDoesntMatchException
 from dateutil.parser import parse
 from django.conf import settings
+from django.utils import timezone
+from getresults_dst.console import ProgressReporter
 from getresults_dst.models import Acknowledgment, History
+from getresults_dst.rollups import record_ack
 from django.core.exceptions import MultipleObjectsReturned
 
 tz = pytz.timezone(settings.TIME_ZONE)
@@ -24,17 +26,16 @@ class BaseLineReader(object):
 
     regexes = [r'\.pdf|\.txt|\.csv']
 
-    def __init__(self):
+    def __init__(self, progress_interval=None):
         if not isinstance(self.regexes, (list, tuple)):
             self.regexes = [self.regexes]
         self.patterns = [re.compile(regex) for regex in self.regexes]
+        self.progress = ProgressReporter(interval=progress_interval)
 
     def read(self, ln, lastpos, line_number, log_reader_history):
         """Read the line into the values dictionary and call on_match if there is a match."""
         self.on_newline(ln)
-        sys.stdout.write("\rbytes: {}    lines: {}    matches: {}    exceptions: {}".format(
-            lastpos, line_number, self.match_count, self.exception_count))
-        sys.stdout.flush()
+        self.progress.update(line_number, lastpos, self.match_count, self.exception_count)
         log_reader_history.matches = self.match_count
         log_reader_history.exceptions = self.exception_count
         return log_reader_history
@@ -63,11 +64,53 @@ class RegexApacheLineReader(BaseLineReader):
     line_parser = make_parser('%a %b %B %t %m %q %H %X %P %r %R')
     regexes = [r'\.pdf']
     search_field = 'query_string'
+    use_unacknowledged_index = True
 
     def __init__(self):
         super(RegexApacheLineReader, self).__init__()
         self.match_count = 0
         self.exception_count = 0
+        self.unacknowledged = None
+        self.sent = set()
+        self.not_sent = set()
+        self.index_datetime = None
+        if self.use_unacknowledged_index:
+            self.build_unacknowledged_index()
+
+    def build_unacknowledged_index(self):
+        """Builds the set of filenames sent but not yet acknowledged.
+
+        Most matching lines are repeat downloads of files already acknowledged. A line
+        whose filename is not in the set cannot change History and skips the History
+        queries. Files sent after the index was built are not in the set, so lines
+        received after that time always go to the database."""
+        self.index_datetime = timezone.now()
+        self.unacknowledged = set(
+            History.objects.filter(
+                ack_datetime__isnull=True,
+                ack_user__isnull=True,
+                acknowledged=False).values_list('filename', flat=True).distinct())
+        return self.unacknowledged
+
+    def may_acknowledge(self, filename, time_received):
+        """Returns False if acknowledging filename cannot update History."""
+        if self.unacknowledged is None or filename in self.unacknowledged:
+            return True
+        return time_received >= self.index_datetime
+
+    def in_sent_history(self, filename):
+        """Returns True if filename was sent, remembering for the run whether each filename
+        was sent. A filename not sent is looked up again only if it is acknowledged later,
+        see :func:`acknowledge`."""
+        if filename in self.sent or (self.unacknowledged and filename in self.unacknowledged):
+            return True
+        elif filename in self.not_sent:
+            return False
+        elif History.objects.filter(filename=filename).exists():
+            self.sent.add(filename)
+            return True
+        self.not_sent.add(filename)
+        return False
 
     def on_newline(self, ln):
         """Calls match and updates a match as an acknowledgement."""
@@ -99,9 +142,23 @@ class RegexApacheLineReader(BaseLineReader):
         time_received = time_received.replace('[', '').replace(']', '').replace('/', ' ')
         time_received = time_received[0:11] + ' ' + time_received[12:]
         time_received = parse(time_received)
+        if self.may_acknowledge(match_string, time_received):
+            self.acknowledge(match_string, remote_ip, time_received)
+        acknowledgement = Acknowledgment.objects.create(
+            filename=match_string,
+            ack_user=remote_ip,
+            ack_datetime=time_received,
+            ack_string=ln[0:500],
+            in_sent_history=self.in_sent_history(match_string),
+        )
+        return acknowledgement
+
+    def acknowledge(self, filename, remote_ip, time_received):
+        """Flags unacknowledged History for filename as acknowledged and removes
+        filename from the unacknowledged index."""
         try:
             history = History.objects.get(
-                filename=match_string,
+                filename=filename,
                 ack_datetime__isnull=True,
                 ack_user__isnull=True,
                 acknowledged=False,
@@ -110,11 +167,12 @@ class RegexApacheLineReader(BaseLineReader):
             history.ack_user = remote_ip
             history.acknowledged = True
             history.save()
+            record_ack(history)
         except History.DoesNotExist:
             history = None
         except MultipleObjectsReturned:
             for history in History.objects.filter(
-                    filename=match_string,
+                    filename=filename,
                     ack_datetime__isnull=True,
                     ack_user__isnull=True,
                     acknowledged=False):
@@ -122,12 +180,10 @@ class RegexApacheLineReader(BaseLineReader):
                 history.ack_user = remote_ip
                 history.acknowledged = True
                 history.save()
-        in_sent_history = History.objects.filter(filename=match_string).exists()
-        acknowledgement = Acknowledgment.objects.create(
-            filename=match_string,
-            ack_user=remote_ip,
-            ack_datetime=time_received,
-            ack_string=ln[0:500],
-            in_sent_history=in_sent_history,
-        )
-        return acknowledgement
+                record_ack(history)
+        if history:
+            self.sent.add(filename)
+            self.not_sent.discard(filename)
+        if self.unacknowledged is not None:
+            self.unacknowledged.discard(filename)
+        return history
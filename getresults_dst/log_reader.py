@@ -7,22 +7,41 @@
 # you should have received as part of this distribution.
 #
 
-import sys
+import gzip
+import shlex
 
 from django.utils import timezone
-from paramiko import SFTPClient, SSHClient
+from paramiko import SFTPClient
 
+from .console import console, ProgressReporter
 from .log_line_readers import BaseLineReader
 from .models import LogReaderHistory
 from .mixins import SSHConnectMixin
+from .ssh_pool import ssh_pool
+
+
+class LogReaderError(Exception):
+    pass
 
 
 class LogReader (SSHConnectMixin):
 
-    def __init__(self, line_reader, hostname, user, path, timeout=None):
+    """Reads an apache log on a remote host from where the last read left off.
+
+    If remote_filter is True the log is filtered on the remote host (tail | grep | gzip)
+    and only candidate lines, those that match one of the line reader's regexes, are
+    sent back. Each candidate line comes with its byte offset so the checkpoint
+    (lastpos) is still exact.
+    """
+
+    remote_filter_command = 'tail -c +{start} {path} | head -c {length} | grep -a -b -P -e {pattern} | gzip -c'
+
+    def __init__(self, line_reader, hostname, user, path, timeout=None, remote_filter=None,
+                 progress_interval=None):
         self.last_read = None
         self.hostname = hostname or 'localhost'
         self.timeout = timeout or 5.0
+        self.banner_timeout = 45
         self.remote_user = user
         self.line_reader = line_reader() or BaseLineReader()
         self.path = path  # basedir + filename
@@ -30,46 +49,95 @@ class LogReader (SSHConnectMixin):
         self.filestat = None
         self.exception_count = 0
         self.match_count = 0
+        self.remote_filter = remote_filter
+        self.progress = ProgressReporter(interval=progress_interval)
 
     def read(self, lastpos=None):
         line_number = 0
         if not lastpos:
             lastpos = self.get_lastpos()
         log_reader_history = self.update_history(lastpos)
+        startpos = lastpos or 0
         try:
-            with SSHClient() as self.ssh:
-                self.connect()
+            with ssh_pool.lease(self) as self.ssh:
                 lastpos = lastpos or 0
                 with SFTPClient.from_transport(self.ssh.get_transport()) as sftp:
                     self.filestat = sftp.stat(self.path)
-                    sys.stdout.write('Reading log {}@{}:{}\n\n'.format(
+                    console.write('Reading log {}@{}:{}\n'.format(
                         self.remote_user, self.hostname, self.path))
-                    sys.stdout.write('Lastpos={}.\n'.format(lastpos))
-                    sys.stdout.flush()
-                    if lastpos == sftp.stat(self.path).st_size:
-                        sys.stdout.write('No changes since last read.\n')
-                        sys.stdout.write('Done.\n')
+                    console.write('Lastpos={}.'.format(lastpos))
+                    if lastpos == self.filestat.st_size:
+                        console.write('No changes since last read.')
+                        console.write('Done.')
+                        console.flush()
                         return None
-                    with sftp.open(self.path) as f:
-                        f.seek(lastpos)
-                        for line_number, line in enumerate(f):
+                    # with remote_filter, line_number counts the candidate lines only
+                    if self.remote_filter:
+                        for line_number, (lastpos, line) in enumerate(
+                                self.filtered_lines(lastpos, self.filestat.st_size), 1):
                             self.last_read = self.line_reader.on_newline(line)
-                            lastpos = f.tell()
+                            self.update_progress(line_number, lastpos - startpos)
+                        lastpos = self.filestat.st_size
+                    else:
+                        with sftp.open(self.path) as f:
+                            f.seek(lastpos)
+                            for line_number, line in enumerate(f, 1):
+                                self.last_read = self.line_reader.on_newline(line)
+                                lastpos = f.tell()
+                                self.update_progress(line_number, lastpos - startpos)
         except KeyboardInterrupt:
-            sys.stdout.write('Stopped at {} for {}@{}:{}\n'.format(
+            console.write('\nStopped at {} for {}@{}:{}'.format(
                 lastpos, self.remote_user, self.hostname, self.path))
-            sys.stdout.flush()
-        sys.stdout.write("\n")
-        sys.stdout.flush()
+        self.update_progress(line_number, lastpos - startpos, done=True)
         log_reader_history.lastpos = lastpos
         log_reader_history.lines = line_number
+        log_reader_history.matches = getattr(self.line_reader, 'match_count', 0)
+        log_reader_history.exceptions = getattr(self.line_reader, 'exception_count', 0)
         log_reader_history.ended = timezone.now()
         log_reader_history.save()
-        sys.stdout.write('Done. Lastpos={}.\nSee LogReaderHistory id={}.\n'.format(
+        console.write('Done. Lastpos={}.\nSee LogReaderHistory id={}.'.format(
             lastpos, log_reader_history.id))
-        sys.stdout.flush()
+        console.flush()
         return lastpos
 
+    def update_progress(self, lines, bytes_read, done=None):
+        """Updates the throttled progress line."""
+        method = self.progress.done if done else self.progress.update
+        method(lines, bytes_read,
+               matches=getattr(self.line_reader, 'match_count', 0),
+               exceptions=getattr(self.line_reader, 'exception_count', 0))
+
+    def filtered_lines(self, lastpos, endpos):
+        """Yields a tuple of (offset, line) for each candidate line between lastpos and endpos.
+
+        The filter runs on the remote host so only lines matching the line reader's
+        regexes cross the wire (gzipped). The offset is the absolute byte offset just past
+        the end of the line, e.g. the lastpos to resume from. Reading stops at endpos, the
+        size of the log when the read started, so lines appended during the read are left
+        for the next read."""
+        command = self.remote_filter_command.format(
+            start=lastpos + 1,
+            length=endpos - lastpos,
+            path=shlex.quote(self.path),
+            pattern=shlex.quote(self.remote_pattern))
+        _, stdout, stderr = self.ssh.exec_command(command)
+        with gzip.GzipFile(fileobj=stdout, mode='rb') as f:
+            for line in f:
+                offset, line = line.split(b':', 1)
+                yield lastpos + int(offset) + len(line), line.decode(errors='replace')
+        error = stderr.read().decode(errors='replace').strip()
+        if error:
+            raise LogReaderError('Remote filter failed for {}@{}:{}. Got {}'.format(
+                self.remote_user, self.hostname, self.path, error))
+
+    @property
+    def remote_pattern(self):
+        """Returns the line reader's regexes as one perl regex for grep.
+
+        The regexes are applied to the whole line so this is a superset of what
+        the line reader will match. Each line is still read by the line reader."""
+        return '|'.join(['(?:{})'.format(regex) for regex in self.line_reader.regexes])
+
     def update_history(self, lastpos):
         return LogReaderHistory.objects.create(lastpos=lastpos or 0)
 
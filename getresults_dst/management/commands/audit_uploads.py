@@ -0,0 +1,48 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2015 Erik van Widenfelt
+# All rights reserved.
+#
+# This software is licensed as described in the file COPYING, which
+# you should have received as part of this distribution.
+#
+
+import os
+import pwd
+
+from datetime import datetime, time, timedelta
+
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+
+from getresults_dst.actions import audit_uploads, unaudit_uploads
+from getresults_dst.models import Upload
+
+
+class Command(BaseCommand):
+    help = ('Flags sent uploads in a date range (of upload_datetime) as audited. '
+            'Dates are YYYY-MM-DD, end date inclusive.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('start_date', type=str)
+        parser.add_argument('end_date', type=str)
+        parser.add_argument('--auditor', type=str, default=None, help='(Default: the current user)')
+        parser.add_argument('--undo', action='store_true', default=False,
+                            help='flag uploads in the date range as not audited.')
+
+    def handle(self, *args, **options):
+        try:
+            start_date = datetime.strptime(options['start_date'], '%Y-%m-%d').date()
+            end_date = datetime.strptime(options['end_date'], '%Y-%m-%d').date()
+        except ValueError as e:
+            raise CommandError(str(e))
+        queryset = Upload.objects.filter(
+            upload_datetime__gte=timezone.make_aware(datetime.combine(start_date, time.min)),
+            upload_datetime__lt=timezone.make_aware(datetime.combine(end_date + timedelta(days=1), time.min)))
+        if options['undo']:
+            count = unaudit_uploads(queryset)
+            self.stdout.write('{} uploads flagged as not audited.'.format(count))
+        else:
+            auditor = options['auditor'] or pwd.getpwuid(os.getuid()).pw_name
+            count = audit_uploads(queryset, auditor)
+            self.stdout.write('{} sent uploads flagged as audited by {}.'.format(count, auditor))
@@ -0,0 +1,124 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2015 Erik van Widenfelt
+# All rights reserved.
+#
+# This software is licensed as described in the file COPYING, which
+# you should have received as part of this distribution.
+#
+
+import magic
+import os
+import socket
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from paramiko import SSHClient
+from scp import SCPClient
+
+from getresults_dst.compression import compression_policy, ADAPTIVE, ALWAYS, NEVER
+from getresults_dst.mixins import SSHConnectMixin
+
+
+class CountingSocket(object):
+    """Wraps a socket and counts the bytes sent and received."""
+
+    def __init__(self, sock):
+        self.sock = sock
+        self.bytes_sent = 0
+        self.bytes_received = 0
+
+    def send(self, data):
+        sent = self.sock.send(data)
+        self.bytes_sent += sent
+        return sent
+
+    def sendall(self, data):
+        self.sock.sendall(data)
+        self.bytes_sent += len(data)
+
+    def recv(self, size):
+        data = self.sock.recv(size)
+        self.bytes_received += len(data)
+        return data
+
+    def __getattr__(self, name):
+        return getattr(self.sock, name)
+
+
+class Connection(SSHConnectMixin):
+
+    def __init__(self, hostname, remote_user, compress):
+        self.hostname = hostname
+        self.remote_user = remote_user
+        self.trusted_host = True
+        self.timeout = 5.0
+        self.banner_timeout = 45
+        self.compress = compress
+        self.ssh = SSHClient()
+        self.sock = CountingSocket(socket.create_connection((hostname, 22), timeout=self.timeout))
+        self.connect(sock=self.sock)
+
+    @property
+    def bytes_on_wire(self):
+        return self.sock.bytes_sent + self.sock.bytes_received
+
+
+class Command(BaseCommand):
+    help = ('Sends the files in a folder to a temp folder on the remote host under each compression '
+            'policy and reports local CPU seconds, elapsed time and bytes on the wire.')
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            'folder', nargs='?', default=None,
+            help='folder of sample files. (Default: the archive folder)')
+        parser.add_argument('--limit', type=int, default=200, help='maximum number of files to send.')
+
+    def handle(self, *args, **options):
+        folder = options['folder'] or os.path.join(settings.MEDIA_ROOT, settings.GRTX_ARCHIVE_FOLDER)
+        paths = []
+        for dirpath, _, filenames in os.walk(folder):
+            paths.extend(os.path.join(dirpath, filename) for filename in sorted(filenames)
+                         if not filename.startswith('.'))
+            if len(paths) >= options['limit']:
+                break
+        paths = paths[:options['limit']]
+        if not paths:
+            raise CommandError('No files found in {}'.format(folder))
+        files = [(path, magic.from_file(path, mime=True)) for path in paths]
+        size = sum(os.path.getsize(path) for path in paths)
+        self.stdout.write('{} files, {} bytes, to {}@{}.\n'.format(
+            len(files), size, settings.GRTX_REMOTE_USERNAME, settings.GRTX_REMOTE_HOSTNAME))
+        self.stdout.write('{:<10} {:>12} {:>12} {:>16} {:>10}'.format(
+            'policy', 'cpu secs', 'elapsed', 'bytes on wire', 'ratio'))
+        for name in [NEVER, ALWAYS, ADAPTIVE]:
+            cpu, elapsed, on_wire = self.run_policy(name, files)
+            self.stdout.write('{:<10} {:>12.3f} {:>12.3f} {:>16} {:>10.3f}'.format(
+                name, cpu, elapsed, on_wire, on_wire / float(size)))
+        self.stdout.write('\ncpu secs is local process CPU time; remote CPU is not measured.')
+
+    def run_policy(self, name, files):
+        """Sends the files under the policy. Uncompressed and compressed traffic use
+        separate connections, as the observer does."""
+        policy = compression_policy(name)
+        connections = {
+            False: Connection(settings.GRTX_REMOTE_HOSTNAME, settings.GRTX_REMOTE_USERNAME, False),
+            True: Connection(settings.GRTX_REMOTE_HOSTNAME, settings.GRTX_REMOTE_USERNAME, True)}
+        try:
+            _, stdout, _ = connections[False].ssh.exec_command('mktemp -d')
+            remote_dir = stdout.read().decode().strip()
+            before = {compress: c.bytes_on_wire for compress, c in connections.items()}
+            started, cpu_started = time.time(), time.process_time()
+            clients = {compress: SCPClient(c.ssh.get_transport()) for compress, c in connections.items()}
+            for path, mime_type in files:
+                clients[policy.compress(path, mime_type)].put(path, os.path.join(remote_dir, os.path.basename(path)))
+            for client in clients.values():
+                client.close()
+            elapsed, cpu = time.time() - started, time.process_time() - cpu_started
+            on_wire = sum(c.bytes_on_wire - before[compress] for compress, c in connections.items())
+            connections[False].ssh.exec_command('rm -rf {}'.format(remote_dir))[1].read()
+        finally:
+            for connection in connections.values():
+                connection.ssh.close()
+        return cpu, elapsed, on_wire
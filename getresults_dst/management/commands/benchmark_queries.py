@@ -0,0 +1,144 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2015 Erik van Widenfelt
+# All rights reserved.
+#
+# This software is licensed as described in the file COPYING, which
+# you should have received as part of this distribution.
+#
+
+import random
+import time
+
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+from django.utils import timezone
+
+from getresults_dst.models import Acknowledgment, History, Upload, TX_SENT
+
+# single-column indexes. The `index_together` indexes of each model, e.g. History
+# ('filename', 'acknowledged') and ('filename', 'sent_datetime'), are dropped with them.
+INDEXED_FIELDS = {
+    History: ['sent_datetime'],
+    Upload: ['filename'],
+    Acknowledgment: ['filename', 'ack_datetime'],
+}
+
+
+class Rollback(Exception):
+    pass
+
+
+class Command(BaseCommand):
+    help = ('Seeds N rows of History, Upload and Acknowledgment and reports the timing of the hot '
+            'filename and status queries. Seeded rows are rolled back unless --keep.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--rows', type=int, default=100000, help='rows to seed per model.')
+        parser.add_argument('--repeat', type=int, default=100, help='number of lookups per query.')
+        parser.add_argument('--batch-size', type=int, default=5000, dest='batch_size')
+        parser.add_argument(
+            '--compare', action='store_true', default=False,
+            help='also time each query after dropping the indexes (rolled back, '
+                 'requires a database that can roll back DDL, e.g. postgres).')
+        parser.add_argument('--keep', action='store_true', default=False, help='do not roll back seeded rows.')
+
+    def handle(self, *args, **options):
+        if options['compare'] and not connection.features.can_rollback_ddl:
+            raise CommandError('--compare requires a database that can roll back DDL.')
+        if options['compare'] and options['keep']:
+            raise CommandError('--compare cannot be used with --keep.')
+        try:
+            with transaction.atomic():
+                filenames = self.seed(options['rows'], options['batch_size'])
+                sample = [random.choice(filenames) for _ in range(options['repeat'])]
+                indexed = self.run_queries(sample)
+                without = None
+                if options['compare']:
+                    self.drop_indexes()
+                    without = self.run_queries(sample)
+                self.report(indexed, without, options['rows'], options['repeat'])
+                if not options['keep']:
+                    raise Rollback()
+        except Rollback:
+            self.stdout.write('Seeded rows rolled back.')
+
+    def seed(self, rows, batch_size):
+        self.stdout.write('Seeding {} rows per model ...'.format(rows))
+        now = timezone.now()
+        filenames = ['{:07d}-benchmark.pdf'.format(n) for n in range(rows)]
+        for start in range(0, rows, batch_size):
+            histories, uploads, acks = [], [], []
+            for n, filename in enumerate(filenames[start:start + batch_size], start):
+                sent_datetime = now - timedelta(minutes=rows - n)
+                acknowledged = n % 10 != 0
+                histories.append(History(
+                    hostname='localhost', remote_hostname='localhost', path='/benchmark',
+                    remote_path='/benchmark', archive_path='/benchmark', filename=filename,
+                    filesize=1000, filetimestamp=sent_datetime, mime_type='application/pdf',
+                    status=TX_SENT, sent_datetime=sent_datetime, acknowledged=acknowledged,
+                    ack_datetime=sent_datetime if acknowledged else None,
+                    ack_user='127.0.0.1' if acknowledged else None, user='benchmark'))
+                uploads.append(Upload(
+                    filename=filename, filesize=1000, mime_type='application/pdf',
+                    upload_datetime=sent_datetime, upload_user='benchmark'))
+                if acknowledged:
+                    acks.append(Acknowledgment(
+                        filename=filename, ack_user='127.0.0.1', ack_datetime=sent_datetime,
+                        ack_string='benchmark', in_sent_history=True))
+            History.objects.bulk_create(histories)
+            Upload.objects.bulk_create(uploads)
+            Acknowledgment.objects.bulk_create(acks)
+        return filenames
+
+    @property
+    def queries(self):
+        """Returns a list of (name, func) where func runs the hot query for a filename."""
+        return [
+            ('update_ack_history (unacknowledged by filename)', lambda f: list(History.objects.filter(
+                filename=f, ack_datetime__isnull=True, ack_user__isnull=True, acknowledged=False))),
+            ('update_ack_history (in_sent_history)', lambda f: History.objects.filter(filename=f).exists()),
+            ('raise_if_upload', lambda f: list(Upload.objects.filter(filename=f))),
+            ('raise_if_history', lambda f: list(History.objects.filter(filename=f))),
+            ('update_on_sent_action', lambda f: list(
+                History.objects.filter(filename=f).order_by('sent_datetime')[:1])),
+            ('acknowledgments by filename', lambda f: list(Acknowledgment.objects.filter(filename=f))),
+        ]
+
+    def run_queries(self, sample):
+        timings = []
+        for name, func in self.queries:
+            started = time.time()
+            for filename in sample:
+                func(filename)
+            timings.append((name, (time.time() - started) / len(sample)))
+        started = time.time()
+        len(History.objects.filter(
+            acknowledged=False, ack_datetime__isnull=True).values_list('filename', flat=True))
+        timings.append(('unacknowledged index (acknowledged, ack_datetime)', time.time() - started))
+        return timings
+
+    def drop_indexes(self):
+        with connection.schema_editor() as schema_editor:
+            for model, field_names in INDEXED_FIELDS.items():
+                schema_editor.alter_index_together(model, model._meta.index_together, [])
+                for field_name in field_names:
+                    old_field = model._meta.get_field(field_name)
+                    new_field = old_field.clone()
+                    new_field.db_index = False
+                    new_field.set_attributes_from_name(field_name)
+                    new_field.model = model
+                    schema_editor.alter_field(model, old_field, new_field)
+
+    def report(self, indexed, without, rows, repeat):
+        self.stdout.write('\n{} rows per model, {} lookups per query (ms per query).\n'.format(rows, repeat))
+        if without:
+            self.stdout.write('{:<55} {:>12} {:>12}'.format('query', 'indexed', 'no index'))
+            for (name, seconds), (_, seconds_without) in zip(indexed, without):
+                self.stdout.write('{:<55} {:>12.3f} {:>12.3f}'.format(name, seconds * 1000, seconds_without * 1000))
+        else:
+            self.stdout.write('{:<55} {:>12}'.format('query', 'indexed'))
+            for name, seconds in indexed:
+                self.stdout.write('{:<55} {:>12.3f}'.format(name, seconds * 1000))
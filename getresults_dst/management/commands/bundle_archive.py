@@ -0,0 +1,52 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2015 Erik van Widenfelt
+# All rights reserved.
+#
+# This software is licensed as described in the file COPYING, which
+# you should have received as part of this distribution.
+#
+
+import os
+
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+
+from getresults_dst.archive import archive_store, bundle_shard, ArchiveError, DateShardedArchiveStore
+
+
+class Command(BaseCommand):
+    help = ('Bundles the day folders of a date sharded archive older than --days into a tar of '
+            'gzipped files with an index. Archived files can still be read from the bundle.')
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--days', type=int, default=getattr(settings, 'GRTX_ARCHIVE_RETENTION_DAYS', 90),
+            help='bundle day folders older than this many days. (Default: GRTX_ARCHIVE_RETENTION_DAYS or 90)')
+        parser.add_argument('--dry-run', action='store_true', default=False, dest='dry_run')
+
+    def handle(self, *args, **options):
+        store = archive_store()
+        if not isinstance(store, DateShardedArchiveStore):
+            raise CommandError('Only a date sharded archive can be bundled. Set GRTX_ARCHIVE_LAYOUT = \'date\'.')
+        archive_dir = os.path.join(settings.MEDIA_ROOT, settings.GRTX_ARCHIVE_FOLDER)
+        before = timezone.localtime(timezone.now()).date() - timedelta(days=options['days'])
+        shards = list(store.shards_before(archive_dir, before))
+        if options['dry_run']:
+            for shard in shards:
+                self.stdout.write(shard)
+            self.stdout.write('{} day folders to bundle.'.format(len(shards)))
+            return None
+        total = 0
+        for shard in shards:
+            try:
+                count = bundle_shard(os.path.join(archive_dir, shard))
+            except ArchiveError as e:
+                self.stderr.write(str(e))
+                continue
+            total += count
+            self.stdout.write('{} {} files.'.format(shard, count))
+        self.stdout.write('Bundled {} files from {} day folders.'.format(total, len(shards)))
@@ -0,0 +1,39 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2015 Erik van Widenfelt
+# All rights reserved.
+#
+# This software is licensed as described in the file COPYING, which
+# you should have received as part of this distribution.
+#
+
+import sys
+
+from django.core.management.base import BaseCommand, CommandError
+
+from getresults_dst.exports import EXPORTS, FORMATS, CSV, ExportError, export_stream
+
+
+class Command(BaseCommand):
+    help = 'Exports all of History or Acknowledgment as CSV or JSONL using constant memory.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--model', choices=sorted(EXPORTS), default='history')
+        parser.add_argument('--format', choices=FORMATS, default=CSV, dest='fmt')
+        parser.add_argument('--gzip', action='store_true', default=False)
+        parser.add_argument('--output', type=str, default=None, help='filename (Default: stdout)')
+
+    def handle(self, *args, **options):
+        try:
+            if options['output']:
+                with open(options['output'], 'wb') as f:
+                    self.write(f, options)
+            else:
+                self.write(sys.stdout.buffer, options)
+        except (ExportError, IOError) as e:
+            raise CommandError(str(e))
+
+    def write(self, f, options):
+        for data in export_stream(options['model'], options['fmt'], compress=options['gzip']):
+            f.write(data)
+        f.flush()
@@ -24,8 +24,8 @@ class Command(BaseCommand):
 
     def handle(self, *args, **options):
         try:
-            recs, added, updated = load_remote_folders_from_csv(options['csv_filename'][0])
-            print('{} records (added {}, updated {}).'.format(recs, added, updated))
+            recs, added, updated, unchanged = load_remote_folders_from_csv(options['csv_filename'][0])
+            print('{} records (added {}, updated {}, unchanged {}).'.format(recs, added, updated, unchanged))
         except (FileNotFoundError, ) as e:
             sys.stdout.write('\n')
             raise CommandError(e)
@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2015 Erik van Widenfelt
+# All rights reserved.
+#
+# This software is licensed as described in the file COPYING, which
+# you should have received as part of this distribution.
+#
+
+from django.core.management.base import BaseCommand
+
+from getresults_dst.rollups import rebuild_rollups
+
+
+class Command(BaseCommand):
+    help = 'Rebuilds the daily delivery and acknowledgment rollups from History.'
+
+    def handle(self, *args, **options):
+        count = rebuild_rollups()
+        self.stdout.write('Rebuilt {} rollups.'.format(count))
@@ -17,12 +17,20 @@ from getresults_dst.log_reader import LogReader
 class Command(BaseCommand):
     help = ''
 
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--remote-filter',
+            action='store_true',
+            dest='remote_filter',
+            default=getattr(settings, 'GRTX_REMOTE_LOG_FILTER', False),
+            help='Filter the log on the remote host and only transfer candidate lines.')
+
     def handle(self, *args, **options):
 
         hostname = settings.GRTX_REMOTE_HOSTNAME
         user = settings.GRTX_REMOTE_USERNAME
         logfile = settings.GRTX_REMOTE_LOGFILE
-        reader = LogReader(GrLogLineReader, hostname, user, logfile)
+        reader = LogReader(GrLogLineReader, hostname, user, logfile, remote_filter=options['remote_filter'])
         try:
             reader.read()
         except Exception as e:
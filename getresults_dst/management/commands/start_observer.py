@@ -16,7 +16,11 @@ from django.conf import settings
 from django.core.management.base import BaseCommand, CommandError
 from paramiko import SSHException
 
-from getresults_dst.getresults import GrRemoteFolderEventHandler
+from getresults_dst.archive import archive_store
+from getresults_dst.compression import compression_policy
+from getresults_dst.event_handlers import FanOutEventHandler
+from getresults_dst.getresults import GrRemoteFolderEventHandler, GrFileHandler
+from getresults_dst.scheduler import TokenBucket, TransferScheduler
 from getresults_dst.server import Server
 
 
@@ -32,29 +36,64 @@ class Command(BaseCommand):
         file_patterns = settings.GRTX_FILE_PATTERNS
         mime_types = settings.GRTX_MIME_TYPES
 
-        event_handler = GrRemoteFolderEventHandler(
-            hostname=hostname,
-            remote_user=remote_user,
-            trusted_host=True,
-            source_dir=source_dir,
-            destination_dir=destination_dir,
-            archive_dir=archive_dir,
-            file_patterns=file_patterns,
-            mime_types=mime_types,
-            touch_existing=True,
-            mkdir_destination=True)
+        bandwidth_limit = getattr(settings, 'GRTX_BANDWIDTH_LIMIT', None)
+        transfer_options = dict(
+            bandwidth=TokenBucket(bandwidth_limit) if bandwidth_limit else None,
+            keepalive_interval=getattr(settings, 'GRTX_SSH_KEEPALIVE', None),
+            verify_transfer=getattr(settings, 'GRTX_VERIFY_TRANSFERS', False),
+            resumable=getattr(settings, 'GRTX_RESUMABLE_TRANSFERS', False),
+            compression_policy=compression_policy(getattr(settings, 'GRTX_COMPRESSION_POLICY', None)))
+        destinations = getattr(settings, 'GRTX_DESTINATIONS', None)
+
+        if destinations:
+            event_handler = FanOutEventHandler(
+                destinations=[dict(transfer_options, **destination) for destination in destinations],
+                handler_class=GrRemoteFolderEventHandler,
+                file_handler=GrFileHandler,
+                trusted_host=True,
+                source_dir=source_dir,
+                archive_dir=archive_dir,
+                archive_store=archive_store(),
+                file_patterns=file_patterns,
+                mime_types=mime_types,
+                touch_existing=True,
+                mkdir_destination=True)
+        else:
+            transfer_workers = getattr(settings, 'GRTX_TRANSFER_WORKERS', None)
+            scheduler = TransferScheduler(
+                workers=transfer_workers,
+                priorities=getattr(settings, 'GRTX_TRANSFER_PRIORITIES', None),
+                max_per_destination=getattr(settings, 'GRTX_MAX_PER_DESTINATION', None),
+            ) if transfer_workers else None
+            event_handler = GrRemoteFolderEventHandler(
+                hostname=hostname,
+                remote_user=remote_user,
+                trusted_host=True,
+                source_dir=source_dir,
+                destination_dir=destination_dir,
+                archive_dir=archive_dir,
+                archive_store=archive_store(),
+                file_patterns=file_patterns,
+                mime_types=mime_types,
+                touch_existing=True,
+                mkdir_destination=True,
+                batch_window=getattr(settings, 'GRTX_BATCH_WINDOW', None),
+                scheduler=scheduler,
+                **transfer_options)
 
         try:
-            server = Server(event_handler)
+            server = Server(
+                event_handler,
+                pending_interval=getattr(settings, 'GRTX_PENDING_INTERVAL', 60))
         except (ConnectionResetError, SSHException, ConnectionRefusedError, socket.gaierror) as e:
             raise CommandError(str(e))
         sys.stdout.write('\n' + str(server) + '\n')
         sys.stdout.write('File patterns: {}\n'.format(','.join([x for x in server.event_handler.file_patterns])))
         sys.stdout.write('Mime: {}\n'.format(','.join([x.decode() for x in server.event_handler.mime_types])))
         sys.stdout.write('Upload folder: {}\n'.format(server.event_handler.source_dir))
-        sys.stdout.write(
-            'Remote folder: {}@{}:{}\n'.format(
-                server.event_handler.remote_user, server.event_handler.hostname, server.event_handler.destination_dir))
+        for handler in [d.handler for d in getattr(server.event_handler, 'destinations', [])] or [server.event_handler]:
+            sys.stdout.write(
+                'Remote folder: {}@{}:{}\n'.format(handler.remote_user, handler.hostname, handler.destination_dir))
         sys.stdout.write('Archive folder: {}\n'.format(server.event_handler.archive_dir))
         sys.stdout.write('\npress CTRL-C to stop.\n\n')
         server.observe()
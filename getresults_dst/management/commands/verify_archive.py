@@ -0,0 +1,43 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2015 Erik van Widenfelt
+# All rights reserved.
+#
+# This software is licensed as described in the file COPYING, which
+# you should have received as part of this distribution.
+#
+
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from getresults_dst.archive import verify_archived, ArchiveError
+from getresults_dst.models import History
+
+
+class Command(BaseCommand):
+    help = ('Checks that archived files match the content hash recorded on History. '
+            'Each archived copy is read once, however many History rows reference it.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--days', type=int, default=None, help='only files sent in the last N days.')
+
+    def handle(self, *args, **options):
+        histories = History.objects.exclude(content_hash__isnull=True).exclude(archive='')
+        if options['days']:
+            histories = histories.filter(sent_datetime__gte=timezone.now() - timedelta(days=options['days']))
+        checked, missing, mismatched = set(), 0, 0
+        for name, content_hash in histories.values_list('archive', 'content_hash').iterator():
+            if name in checked:
+                continue
+            checked.add(name)
+            try:
+                if not verify_archived(name, content_hash):
+                    mismatched += 1
+                    self.stderr.write('Content does not match hash: {}'.format(name))
+            except ArchiveError:
+                missing += 1
+                self.stderr.write('Missing: {}'.format(name))
+        self.stdout.write('Checked {} archived files. {} missing, {} do not match.'.format(
+            len(checked), missing, mismatched))
@@ -1,53 +1,182 @@
+import random
 import socket
+import threading
 import time
 
 from builtins import ConnectionRefusedError, ConnectionResetError
 from django.utils import timezone
 from paramiko import AutoAddPolicy
-from paramiko.ssh_exception import BadHostKeyException, AuthenticationException, SSHException
+from paramiko.ssh_exception import (
+    BadHostKeyException, AuthenticationException, NoValidConnectionsError, SSHException)
+
+from .console import console
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half-open'
+
+
+class ConnectionUnavailable(SSHException):
+    pass
+
+
+def backoff(attempt, base=None, cap=None):
+    """Returns seconds to wait before retry `attempt` (0, 1, 2, ...), exponential up to `cap`
+    with full jitter so many clients do not retry in step."""
+    base = base or 1.0
+    cap = cap or 60.0
+    return random.uniform(0, min(cap, base * 2 ** attempt))
+
+
+class CircuitBreaker(object):
+    """Tracks connection failures to a host.
+
+    After `failure_threshold` failures in a row the circuit opens and connecting fails
+    immediately. After `reset_timeout` seconds the circuit is half-open and one trial
+    attempt is allowed; other attempts are refused until the trial ends. A success
+    closes the circuit, a failure opens it again."""
+
+    def __init__(self, failure_threshold=None, reset_timeout=None):
+        self.failure_threshold = failure_threshold or 3
+        self.reset_timeout = 60 if reset_timeout is None else reset_timeout
+        self.failures = 0
+        self.opened = None
+        self.trial = False
+        self.lock = threading.Lock()
+
+    @property
+    def state(self):
+        if self.opened is None:
+            return CLOSED
+        elif time.time() - self.opened >= self.reset_timeout:
+            return HALF_OPEN
+        return OPEN
+
+    def allow(self):
+        """Returns True if a connection may be attempted. Call :func:`end_trial` when the
+        attempt is done, whatever the outcome."""
+        with self.lock:
+            state = self.state
+            if state == HALF_OPEN and not self.trial:
+                self.trial = True
+                return True
+            return state == CLOSED
+
+    def end_trial(self):
+        with self.lock:
+            self.trial = False
+
+    def record_success(self):
+        with self.lock:
+            self.failures = 0
+            self.opened = None
+
+    def record_failure(self):
+        with self.lock:
+            self.failures += 1
+            if self.opened is not None or self.failures >= self.failure_threshold:
+                self.opened = time.time()
 
 
 class SSHConnectMixin(object):
 
-    def connect(self, ssh=None):
+    keepalive_interval = 30
+
+    def connect(self, ssh=None, compress=None, sock=None, retries=None):
         """Connects the ssh instance.
 
         If :param:`ssh` is not provided will connect `self.ssh`.
+
+        If :param:`compress` is not provided uses `self.compress` (Default: True).
+
+        Timeouts and refused connections are retried with exponential backoff, up to
+        :param:`retries` times or, if None, until connected. If `self.circuit_breaker`
+        is set, failures are recorded on it and :class:`ConnectionUnavailable` is
+        raised without connecting while it is open or while another attempt is
+        trying the half-open circuit.
         """
         ssh = ssh if ssh else self.ssh
+        compress = getattr(self, 'compress', True) if compress is None else compress
+        circuit_breaker = getattr(self, 'circuit_breaker', None)
+        if circuit_breaker and not circuit_breaker.allow():
+            raise ConnectionUnavailable('Host {} is unavailable. Not connecting for {}@{}'.format(
+                self.hostname, self.remote_user, self.hostname))
         ssh.load_system_host_keys()
         if self.trusted_host:
             ssh.set_missing_host_key_policy(AutoAddPolicy())
+        try:
+            self.connect_with_backoff(ssh, compress, sock, retries)
+        finally:
+            if circuit_breaker:
+                circuit_breaker.end_trial()
+
+    def connect_with_backoff(self, ssh, compress, sock, retries):
+        attempt = 0
         while True:
             try:
-                ssh.connect(
-                    self.hostname,
-                    username=self.remote_user,
-                    timeout=self.timeout,
-                    banner_timeout=self.banner_timeout,
-                    compress=True,
-                )
-                print('Connected to host {}. '.format(self.hostname))
-                break
-            except (socket.timeout, ConnectionRefusedError) as e:
-                print('{}. {} for {}@{}. Retrying ...'.format(
-                    timezone.now(), str(e), self.remote_user, self.hostname)
+                return self.connect_once(ssh, compress, sock)
+            except (socket.timeout, ConnectionRefusedError, NoValidConnectionsError) as e:
+                self.record_connect(success=False)
+                if retries is not None and attempt >= retries:
+                    raise ConnectionUnavailable('{} for {}@{}'.format(str(e), self.remote_user, self.hostname))
+                delay = backoff(attempt)
+                attempt += 1
+                console.write('{}. {} for {}@{}. Retrying in {:.1f}s ...'.format(
+                    timezone.now(), str(e), self.remote_user, self.hostname, delay)
                 )
-                time.sleep(5)
-            except AuthenticationException as e:
-                raise AuthenticationException(
-                    'Got {} for user {}@{}'.format(
-                        str(e)[0:-1], self.remote_user, self.hostname))
-            except BadHostKeyException as e:
-                raise BadHostKeyException(
-                    'Add server to known_hosts on host {}.'
-                    ' Got {}.'.format(e, self.hostname))
-            except socket.gaierror:
-                raise socket.gaierror('Hostname {} not known or not available'.format(self.hostname))
-            except ConnectionResetError as e:
-                raise ConnectionResetError('{} for {}@{}'.format(str(e), self.remote_user, self.hostname))
-            except SSHException as e:
-                raise SSHException('{} for {}@{}'.format(str(e), self.remote_user, self.hostname))
-
-    def reconnect(self):
-        self.connect()
+                time.sleep(delay)
+
+    def connect_once(self, ssh, compress, sock):
+        try:
+            ssh.connect(
+                self.hostname,
+                username=self.remote_user,
+                timeout=self.timeout,
+                banner_timeout=self.banner_timeout,
+                compress=compress,
+                sock=sock,
+            )
+            ssh.get_transport().set_keepalive(self.keepalive_interval)
+        except AuthenticationException as e:
+            raise AuthenticationException(
+                'Got {} for user {}@{}'.format(
+                    str(e)[0:-1], self.remote_user, self.hostname))
+        except BadHostKeyException as e:
+            raise BadHostKeyException(
+                'Add server to known_hosts on host {}.'
+                ' Got {}.'.format(e, self.hostname))
+        except socket.gaierror:
+            raise socket.gaierror('Hostname {} not known or not available'.format(self.hostname))
+        except ConnectionResetError as e:
+            self.record_connect(success=False)
+            raise ConnectionResetError('{} for {}@{}'.format(str(e), self.remote_user, self.hostname))
+        except SSHException as e:
+            self.record_connect(success=False)
+            raise SSHException('{} for {}@{}'.format(str(e), self.remote_user, self.hostname))
+        self.record_connect(success=True)
+        console.write('Connected to host {}. '.format(self.hostname))
+
+    def record_connect(self, success):
+        """Records the outcome of a connection attempt on `self.circuit_breaker`, if set."""
+        circuit_breaker = getattr(self, 'circuit_breaker', None)
+        if circuit_breaker and success:
+            circuit_breaker.record_success()
+        elif circuit_breaker:
+            circuit_breaker.record_failure()
+
+    def reconnect(self, ssh=None):
+        self.connect(ssh=ssh)
+
+    def is_healthy(self, ssh=None, probe=None):
+        """Returns True if the transport of ssh is active and, if :param:`probe`, answers
+        an SSH ignore message, so a dead link is found before a transfer fails on it."""
+        ssh = ssh if ssh else self.ssh
+        transport = ssh.get_transport() if ssh else None
+        if not transport or not transport.is_active():
+            return False
+        if probe:
+            try:
+                transport.send_ignore()
+            except (SSHException, EOFError, socket.error):
+                return False
+        return True
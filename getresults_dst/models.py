@@ -14,14 +14,20 @@ from django.core.files.storage import FileSystemStorage
 from django.db import models
 from django.utils import timezone
 
+from .upload_handlers import move_into_place
+
 upload_fs = FileSystemStorage(location=settings.GRTX_UPLOAD_FOLDER)
 
 TX_SENT = 'sent'
 TX_ACK = 'ack'
+TX_VERIFIED = 'verified'
+TX_MISMATCH = 'mismatch'
 
 STATUS = (
     (TX_SENT, 'sent'),
     (TX_ACK, 'acknowledged'),
+    (TX_VERIFIED, 'sent and verified'),
+    (TX_MISMATCH, 'sent, checksum mismatch'),
 )
 
 
@@ -50,6 +56,12 @@ class History(models.Model):
         null=True,
         help_text='e.g. a value in the filename suggestive of the remote folder ...')
 
+    label = models.CharField(
+        max_length=10,
+        null=True,
+        blank=True,
+        help_text='label of the RemoteFolder configuration used to select the remote folder')
+
     archive_path = models.CharField(
         max_length=100,
         null=True)
@@ -64,11 +76,18 @@ class History(models.Model):
     mime_type = models.CharField(
         max_length=25)
 
+    content_hash = models.CharField(
+        max_length=64,
+        null=True,
+        blank=True,
+        help_text='sha256 of the file content')
+
     status = models.CharField(
         max_length=15,
         choices=STATUS)
 
-    sent_datetime = models.DateTimeField()
+    sent_datetime = models.DateTimeField(
+        db_index=True)
 
     acknowledged = models.BooleanField(
         default=False,
@@ -90,6 +109,12 @@ class History(models.Model):
     class Meta:
         app_label = 'getresults_dst'
         ordering = ('-sent_datetime', )
+        index_together = (
+            ('filename', 'acknowledged'),
+            ('filename', 'sent_datetime'),
+            ('acknowledged', 'ack_datetime'),
+            ('content_hash', 'remote_path'),
+        )
         verbose_name = 'Sent History'
         verbose_name_plural = 'Sent History'
 
@@ -133,7 +158,8 @@ class Upload(models.Model):
     filename = models.CharField(
         max_length=50,
         null=True,
-        blank=True)
+        blank=True,
+        db_index=True)
 
     filesize = models.FloatField(
         null=True,
@@ -144,6 +170,13 @@ class Upload(models.Model):
         null=True,
         blank=True)
 
+    content_hash = models.CharField(
+        max_length=64,
+        null=True,
+        blank=True,
+        db_index=True,
+        help_text='sha256 of the file content')
+
     upload_user = models.CharField(
         max_length=50,
         null=True,
@@ -181,6 +214,7 @@ class Upload(models.Model):
     def save(self, *args, **kwargs):
         if not self.id:
             if self.file:
+                move_into_place(self.file)
                 self.filename = os.path.split(self.file.name)[1]
                 self.filesize = self.file.size
         super(Upload, self).save(*args, **kwargs)
@@ -197,7 +231,8 @@ class Pending(models.Model):
     )
 
     filename = models.CharField(
-        max_length=50
+        max_length=50,
+        unique=True
     )
 
     filesize = models.FloatField()
@@ -214,14 +249,16 @@ class Pending(models.Model):
 class Acknowledgment(models.Model):
 
     filename = models.CharField(
-        max_length=50
+        max_length=50,
+        db_index=True
     )
 
     ack_user = models.CharField(
         max_length=50
     )
 
-    ack_datetime = models.DateTimeField()
+    ack_datetime = models.DateTimeField(
+        db_index=True)
 
     ack_string = models.TextField(
         max_length=500
@@ -278,3 +315,46 @@ class LogReaderHistory(models.Model):
         app_label = 'getresults_dst'
         ordering = ('-started', )
         verbose_name_plural = 'Log Reader History'
+
+
+class DeliveryRollup(models.Model):
+    """Daily totals of files sent and acknowledged per remote folder.
+
+    Rows are keyed on the day the files were sent. The observer and the log reader
+    update the totals as they write History, see module rollups. Rebuild from
+    History with management command `rebuild_rollups`.
+    """
+
+    day = models.DateField()
+
+    remote_folder = models.CharField(
+        max_length=50)
+
+    remote_folder_tag = models.CharField(
+        max_length=25,
+        default='',
+        blank=True)
+
+    label = models.CharField(
+        max_length=10)
+
+    sent = models.IntegerField(default=0)
+
+    filesize = models.FloatField(default=0)
+
+    acknowledged = models.IntegerField(default=0)
+
+    ack_seconds = models.FloatField(
+        default=0,
+        help_text='total seconds from sent to acknowledged')
+
+    ack_within_hour = models.IntegerField(default=0)
+
+    ack_within_day = models.IntegerField(default=0)
+
+    ack_within_week = models.IntegerField(default=0)
+
+    class Meta:
+        app_label = 'getresults_dst'
+        unique_together = (('day', 'remote_folder', 'remote_folder_tag', 'label'), )
+        ordering = ('-day', 'label', 'remote_folder')
@@ -0,0 +1,118 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2015 Erik van Widenfelt
+# All rights reserved.
+#
+# This software is licensed as described in the file COPYING, which
+# you should have received as part of this distribution.
+#
+
+import json
+import os
+import socket
+import tempfile
+import threading
+import time
+
+from django.conf import settings
+
+QUEUED = 'queued'
+DETECTED = 'detected'
+SELECTING = 'selecting folder'
+SENDING = 'sending'
+ARCHIVING = 'archiving'
+FAILED = 'failed'
+DUPLICATE = 'duplicate'
+BATCHED = 'waiting for batch'
+SCHEDULED = 'scheduled'
+PARKED = 'waiting for connection'
+
+
+def pending_state_file():
+    return getattr(
+        settings, 'GRTX_PENDING_STATE_FILE',
+        os.path.join(tempfile.gettempdir(), 'getresults_dst_pending.json'))
+
+
+class PendingState(object):
+    """The observer's in-memory view of queued and in-flight files.
+
+    The event handler sets the pipeline stage of each file as it goes and the state is
+    published to a small JSON file that :class:`PendingView` reads, so pending status is
+    current without a rescan of the upload folder. The server publishes a heartbeat.
+    """
+
+    def __init__(self, path=None, interval=None, heartbeat=None):
+        self.path = path or pending_state_file()
+        self.interval = 1 if interval is None else interval
+        self.heartbeat = heartbeat or 10
+        self.files = {}
+        self.extra = {}
+        self.lock = threading.Lock()
+        self.changed = True
+        self.published = None
+
+    def set_stage(self, filename, stage):
+        with self.lock:
+            since = self.files[filename]['since'] if filename in self.files else time.time()
+            self.files[filename] = {'stage': stage, 'since': since, 'updated': time.time()}
+            self.changed = True
+        self.publish_quietly()
+
+    def remove(self, filename):
+        with self.lock:
+            if self.files.pop(filename, None):
+                self.changed = True
+        self.publish_quietly()
+
+    def set_extra(self, **extra):
+        """Sets values published with the files, e.g. the queue depth of the transfer scheduler."""
+        with self.lock:
+            self.extra.update(extra)
+            self.changed = True
+        self.publish_quietly()
+
+    def publish(self, force=None, **extra):
+        """Writes the state to the JSON file, at most once per interval if it changed
+        and at least once per heartbeat so readers know the observer is running.
+
+        The file is written to a temp file and renamed into place so readers never
+        see a partial file."""
+        now = time.time()
+        due = (not self.published or now - self.published >= self.heartbeat or
+               (self.changed and now - self.published >= self.interval))
+        if not (force or due):
+            return False
+        with self.lock:
+            files = [dict(filename=filename, **item) for filename, item in sorted(self.files.items())]
+            extra = dict(self.extra, **extra)
+            self.changed = False
+        state = dict(hostname=socket.gethostname(), published=now, files=files, **extra)
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(self.path), prefix='.pending')
+        with os.fdopen(fd, 'w') as f:
+            json.dump(state, f)
+        os.chmod(tmp, 0o644)
+        os.rename(tmp, self.path)
+        self.published = now
+        return True
+
+    def publish_quietly(self):
+        """Publishes if due, ignoring errors so file transfers are never interrupted."""
+        try:
+            return self.publish()
+        except OSError:
+            return False
+
+
+def read_pending_state(path=None, max_age=None):
+    """Returns the state published by the observer or None if there is
+    none or it is older than max_age seconds (e.g. the observer is not running)."""
+    max_age = max_age or getattr(settings, 'GRTX_PENDING_STATE_MAX_AGE', 60)
+    try:
+        with open(path or pending_state_file()) as f:
+            state = json.load(f)
+    except (IOError, ValueError):
+        return None
+    if time.time() - state.get('published', 0) > max_age:
+        return None
+    return state
@@ -0,0 +1,112 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2015 Erik van Widenfelt
+# All rights reserved.
+#
+# This software is licensed as described in the file COPYING, which
+# you should have received as part of this distribution.
+#
+
+from datetime import timedelta
+
+from django.db import transaction
+from django.db.models import F
+from django.utils import timezone
+
+from .models import DeliveryRollup, History, RemoteFolder
+
+HOUR = timedelta(hours=1).total_seconds()
+DAY = timedelta(days=1).total_seconds()
+WEEK = timedelta(days=7).total_seconds()
+
+
+def folder_labels():
+    """Returns a dictionary of {(folder, folder_tag): label} from model RemoteFolder."""
+    return {(folder, folder_tag): label for folder, folder_tag, label in RemoteFolder.objects.values_list(
+        'folder', 'folder_tag', 'label')}
+
+
+def rollup_key(sent_datetime, remote_folder, remote_folder_tag, label, labels=None):
+    """Returns the rollup key for a sent file.
+
+    If label is None, e.g. History sent before History.label was added,
+    the label is looked up in labels (see :func:`folder_labels`)."""
+    if not label:
+        label = (labels or {}).get((remote_folder, remote_folder_tag), 'default')
+    return (timezone.localtime(sent_datetime).date(), remote_folder, remote_folder_tag or '', label)
+
+
+def ack_counts(sent_datetime, ack_datetime):
+    """Returns a dictionary of the acknowledgment totals for one file."""
+    seconds = max((ack_datetime - sent_datetime).total_seconds(), 0)
+    return {
+        'acknowledged': 1,
+        'ack_seconds': seconds,
+        'ack_within_hour': 1 if seconds <= HOUR else 0,
+        'ack_within_day': 1 if seconds <= DAY else 0,
+        'ack_within_week': 1 if seconds <= WEEK else 0,
+    }
+
+
+def increment(key, **counts):
+    day, remote_folder, remote_folder_tag, label = key
+    rollup, _ = DeliveryRollup.objects.get_or_create(
+        day=day, remote_folder=remote_folder, remote_folder_tag=remote_folder_tag, label=label)
+    DeliveryRollup.objects.filter(pk=rollup.pk).update(
+        **{name: F(name) + value for name, value in counts.items()})
+
+
+def record_sent(history):
+    """Adds a sent file to the rollups. Called by the observer."""
+    labels = None if history.label else folder_labels()
+    key = rollup_key(history.sent_datetime, history.remote_folder, history.remote_folder_tag,
+                     history.label, labels)
+    increment(key, sent=1, filesize=history.filesize)
+
+
+def record_ack(history):
+    """Adds an acknowledged file to the rollups of the day it was sent. Called by the log reader."""
+    labels = None if history.label else folder_labels()
+    key = rollup_key(history.sent_datetime, history.remote_folder, history.remote_folder_tag,
+                     history.label, labels)
+    increment(key, **ack_counts(history.sent_datetime, history.ack_datetime))
+
+
+def remove_acks(histories):
+    """Removes acknowledgments from the rollups for a queryset of History
+    about to be unacknowledged."""
+    labels = folder_labels()
+    totals = {}
+    for sent_datetime, remote_folder, remote_folder_tag, label, ack_datetime in histories.filter(
+            acknowledged=True, ack_datetime__isnull=False).values_list(
+            'sent_datetime', 'remote_folder', 'remote_folder_tag', 'label', 'ack_datetime'):
+        key = rollup_key(sent_datetime, remote_folder, remote_folder_tag, label, labels)
+        counts = totals.setdefault(key, {})
+        for name, value in ack_counts(sent_datetime, ack_datetime).items():
+            counts[name] = counts.get(name, 0) - value
+    for key, counts in totals.items():
+        increment(key, **counts)
+
+
+def rebuild_rollups():
+    """Replaces the rollups with totals calculated from all of History.
+
+    Returns the number of rollups."""
+    labels = folder_labels()
+    rollups = {}
+    for (sent_datetime, remote_folder, remote_folder_tag, label, filesize, acknowledged,
+         ack_datetime) in History.objects.values_list(
+            'sent_datetime', 'remote_folder', 'remote_folder_tag', 'label', 'filesize',
+            'acknowledged', 'ack_datetime').order_by().iterator():
+        key = rollup_key(sent_datetime, remote_folder, remote_folder_tag, label, labels)
+        rollup = rollups.setdefault(key, DeliveryRollup(
+            day=key[0], remote_folder=key[1], remote_folder_tag=key[2], label=key[3]))
+        rollup.sent += 1
+        rollup.filesize += filesize
+        if acknowledged and ack_datetime:
+            for name, value in ack_counts(sent_datetime, ack_datetime).items():
+                setattr(rollup, name, getattr(rollup, name) + value)
+    with transaction.atomic():
+        DeliveryRollup.objects.all().delete()
+        DeliveryRollup.objects.bulk_create(rollups.values(), batch_size=1000)
+    return len(rollups)
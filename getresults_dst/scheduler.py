@@ -0,0 +1,161 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2015 Erik van Widenfelt
+# All rights reserved.
+#
+# This software is licensed as described in the file COPYING, which
+# you should have received as part of this distribution.
+#
+
+import heapq
+import itertools
+import threading
+import time
+
+from django.db import connection
+from django.utils import timezone
+
+from .console import console
+
+DEFAULT_CLASS = 'default'
+
+
+class TokenBucket(object):
+    """Limits the rate of bytes read, shared by all threads reading through it.
+
+    `rate` is in bytes per second and `burst` is the most that can be read at once
+    without waiting. (Default: one second at `rate`)"""
+
+    def __init__(self, rate, burst=None):
+        self.rate = float(rate)
+        self.capacity = float(burst or rate)
+        self.tokens = self.capacity
+        self.updated = time.time()
+        self.lock = threading.Lock()
+
+    def consume(self, amount):
+        """Takes amount tokens, sleeping until the bucket has refilled if it is in debt."""
+        with self.lock:
+            now = time.time()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= amount
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0
+        if wait:
+            time.sleep(wait)
+
+
+class TransferScheduler(object):
+    """Runs transfer jobs on worker threads in order of priority class.
+
+    The priority class of a job is the routing label (e.g. bhs, cdc1, cdc2) or folder.
+    `priorities` maps a class to a number, lower first. Unknown classes come last. Jobs
+    of the same class run in the order submitted. At most `max_per_destination` jobs
+    run at once for one destination. A job submitted with the `key` of a job that is
+    queued or running, e.g. the same file, is skipped.
+
+    For example:
+
+        scheduler = TransferScheduler(workers=4, priorities={'cdc1': 0, 'bhs': 1}, max_per_destination=2)
+        scheduler.submit(func, args, priority_class='cdc1', destination='host:/path', key=filename)
+    """
+
+    def __init__(self, workers=None, priorities=None, max_per_destination=None, pending_state=None):
+        self.workers = workers or 2
+        self.priorities = priorities or {}
+        self.max_per_destination = max_per_destination or self.workers
+        self.pending_state = pending_state
+        self.heap = []
+        self.counter = itertools.count()
+        self.running = {}
+        self.depth = {}
+        self.keys = set()
+        self.condition = threading.Condition()
+        self.stopped = False
+        self.threads = []
+        for n in range(self.workers):
+            thread = threading.Thread(target=self.work, name='transfer-{}'.format(n))
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+
+    def priority(self, priority_class):
+        return self.priorities.get(priority_class, max(list(self.priorities.values()) + [0]) + 1)
+
+    def submit(self, func, args=None, priority_class=None, destination=None, key=None):
+        """Queues the job. Returns False if a job with the same key is already queued or running."""
+        priority_class = priority_class or DEFAULT_CLASS
+        with self.condition:
+            if key is not None:
+                if key in self.keys:
+                    return False
+                self.keys.add(key)
+            heapq.heappush(self.heap, (
+                self.priority(priority_class), next(self.counter), priority_class, destination, key, func,
+                args or ()))
+            self.depth[priority_class] = self.depth.get(priority_class, 0) + 1
+            self.condition.notify()
+        self.publish_depth()
+        return True
+
+    def queue_depth(self):
+        """Returns a dictionary of {priority class: number of jobs waiting}."""
+        with self.condition:
+            return {priority_class: depth for priority_class, depth in self.depth.items() if depth}
+
+    def next_job(self):
+        """Returns the first job by priority whose destination is below its limit, waiting if there is none."""
+        with self.condition:
+            while not self.stopped:
+                skipped, job = [], None
+                while self.heap:
+                    item = heapq.heappop(self.heap)
+                    if self.running.get(item[3], 0) < self.max_per_destination:
+                        job = item
+                        break
+                    skipped.append(item)
+                for item in skipped:
+                    heapq.heappush(self.heap, item)
+                if job:
+                    self.running[job[3]] = self.running.get(job[3], 0) + 1
+                    self.depth[job[2]] -= 1
+                    return job
+                self.condition.wait()
+            return None
+
+    def work(self):
+        while True:
+            job = self.next_job()
+            if not job:
+                break
+            _, _, priority_class, destination, key, func, args = job
+            self.publish_depth()
+            try:
+                func(*args)
+            except Exception as e:
+                console.write('{} transfer job failed. Got {}: {}'.format(timezone.now(), e.__class__.__name__, e))
+            finally:
+                with self.condition:
+                    self.running[destination] -= 1
+                    self.keys.discard(key)
+                    self.condition.notify_all()
+        connection.close()
+
+    def publish_depth(self):
+        if self.pending_state:
+            self.pending_state.set_extra(queue_depth=self.queue_depth())
+
+    def join(self, timeout=None):
+        """Waits until no jobs are queued or running. Returns False on timeout."""
+        with self.condition:
+            return self.condition.wait_for(
+                lambda: not self.heap and not any(self.running.values()), timeout)
+
+    def stop(self):
+        """Stops the workers once their running jobs finish. Queued jobs are dropped,
+        their files stay in the upload folder."""
+        with self.condition:
+            self.stopped = True
+            self.condition.notify_all()
+        for thread in self.threads:
+            thread.join()
@@ -13,6 +13,10 @@ from django.utils import timezone
 from paramiko import SSHClient
 from watchdog.observers import Observer
 
+from .mixins import SSHConnectMixin
+from .ssh_pool import ssh_pool
+from .utils import sync_pending_files
+
 
 class ServerError(Exception):
     pass
@@ -20,27 +24,84 @@ class ServerError(Exception):
 
 class Server(object):
 
-    def __init__(self, event_handler):
+    def __init__(self, event_handler, pending_interval=None):
         """
         See management command :func:`start_observer` or tests for usage.
 
         :param event_handler: an instance of :class:`BaseEventHandler`.
+        :param pending_interval: if set, model Pending is synced with the source folder
+                                 every `pending_interval` seconds while observing.
         """
         self.event_handler = event_handler
+        self.pending_interval = pending_interval
+        self.pending_synced = None
 
     def __str__(self):
         return 'Server started on {}'.format(timezone.now())
 
     def observe(self, sleep=None):
-        with SSHClient() as self.event_handler.ssh:
-            observer = Observer()
-            observer.schedule(self.event_handler, path=self.event_handler.source_dir)
-            self.event_handler.connect()
-            self.event_handler.process_existing_files()
-            observer.start()
+        """Observes the source folder until interrupted.
+
+        An event handler that connects over SSH leases its connection from the pool,
+        reusing the connection :func:`check_folders` opened. The handler may replace
+        the lease if the connection drops, see :func:`RemoteFolderEventHandler.reconnect`."""
+        try:
+            if isinstance(self.event_handler, SSHConnectMixin):
+                self.event_handler.connection = ssh_pool.acquire(self.event_handler)
+                self.event_handler.ssh = self.event_handler.connection.ssh
+                try:
+                    self.run(sleep)
+                finally:
+                    ssh_pool.release(self.event_handler.connection)
+                    self.event_handler.connection = None
+            else:
+                with SSHClient() as self.event_handler.ssh:
+                    self.event_handler.connect()
+                    self.run(sleep)
+        finally:
+            ssh_pool.close()
+
+    def run(self, sleep=None):
+        observer = Observer()
+        observer.schedule(self.event_handler, path=self.event_handler.source_dir)
+        self.event_handler.process_existing_files()
+        observer.start()
+        try:
+            while True:
+                time.sleep(sleep or 1)
+                self.on_tick()
+        except KeyboardInterrupt:
+            observer.stop()
+        observer.join()
+        self.event_handler.close()
+
+    def on_tick(self):
+        """Called by :func:`observe` after each sleep."""
+        self.event_handler.on_tick()
+        ssh_pool.evict_idle()
+        self.publish_pending_state()
+        if self.pending_interval and (
+                not self.pending_synced or time.time() - self.pending_synced >= self.pending_interval):
+            self.sync_pending()
+
+    def sync_pending(self):
+        self.pending_synced = time.time()
+        try:
+            added, deleted, updated = sync_pending_files(self.event_handler.source_dir)
+        except OSError as e:
+            self.event_handler.output_to_console('{} Unable to sync pending files. Got {}'.format(
+                timezone.now(), str(e)))
+        else:
+            if added or deleted or updated:
+                self.event_handler.output_to_console(
+                    '{} pending files: added {}, deleted {}, updated {}.'.format(
+                        timezone.now(), added, deleted, updated))
+
+    def publish_pending_state(self):
+        pending_state = getattr(self.event_handler, 'pending_state', None)
+        if pending_state:
             try:
-                while True:
-                    time.sleep(sleep or 1)
-            except KeyboardInterrupt:
-                observer.stop()
-            observer.join()
+                pending_state.publish()
+            except OSError as e:
+                self.event_handler.output_to_console('{} Unable to publish pending state. Got {}'.format(
+                    timezone.now(), str(e)))
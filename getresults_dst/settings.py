@@ -156,6 +156,10 @@ GIT_DIR = BASE_DIR.ancestor(1)
 MEDIA_ROOT = os.path.expanduser('~/getresults_files/')
 MEDIA_URL = '/media/'
 FILE_UPLOAD_PERMISSIONS = 0o664
+FILE_UPLOAD_HANDLERS = (
+    'getresults_dst.upload_handlers.UploadFolderFileHandler',
+    'django.core.files.uploadhandler.MemoryFileUploadHandler',
+    'django.core.files.uploadhandler.TemporaryFileUploadHandler')
 
 # local folders are relative to MEDIA_ROOT
 GRTX_REMOTE_HOSTNAME = 'localhost'
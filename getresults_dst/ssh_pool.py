@@ -0,0 +1,158 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2015 Erik van Widenfelt
+# All rights reserved.
+#
+# This software is licensed as described in the file COPYING, which
+# you should have received as part of this distribution.
+#
+
+import threading
+import time
+
+from contextlib import contextmanager
+
+from django.conf import settings
+from paramiko import SSHClient
+
+
+class PooledConnection(object):
+
+    def __init__(self, key):
+        self.key = key
+        self.ssh = SSHClient()
+        self.leases = 0
+        self.last_used = time.time()
+        self.retired = False
+
+    def is_active(self):
+        transport = self.ssh.get_transport()
+        return bool(transport and transport.is_active())
+
+    def __repr__(self):
+        return 'PooledConnection({}@{}, leases={})'.format(self.key[1], self.key[0], self.leases)
+
+
+class SSHPool(object):
+    """A process-wide pool of SSH connections keyed by (hostname, remote_user, compress).
+
+    A lease hands out a connected `SSHClient` whose transport is shared with other leases,
+    so each lease opens its channels (SCP, SFTP, exec) on an existing transport instead of
+    paying for a new key exchange. A transport takes at most `max_channels` leases, kept
+    below the server's MaxSessions (OpenSSH default 10); another connection is opened for
+    more. Connections without leases for `idle_timeout` seconds are closed by :func:`evict_idle`.
+
+    The pool counts leases, not channels. A lessee that opens more than one channel at a time
+    on its lease must take more leases, as :func:`RemoteFolderEventHandler.leased` does per thread.
+
+    A lessee never reconnects the shared client in place. It calls :func:`replace` to swap its
+    lease on a dropped connection for a lease on a new one, and other lessees do the same when
+    they find the connection dropped, so they share the replacement.
+
+    The owner of a lease is an :class:`SSHConnectMixin` instance that connects new
+    connections, e.g. an event handler or log reader. For example:
+
+        with ssh_pool.lease(event_handler) as ssh:
+            with SFTPClient.from_transport(ssh.get_transport()) as sftp:
+                ...
+    """
+
+    def __init__(self, max_channels=None, idle_timeout=None):
+        self.max_channels = max_channels or 8
+        self.idle_timeout = 300 if idle_timeout is None else idle_timeout
+        self.connections = {}
+        self.lock = threading.Lock()
+        self.key_locks = {}
+
+    @contextmanager
+    def lease(self, owner, compress=None):
+        connection = self.acquire(owner, compress=compress)
+        try:
+            yield connection.ssh
+        finally:
+            self.release(connection)
+
+    def acquire(self, owner, compress=None, retries=None):
+        """Returns a connection with a free channel, connecting a new one if there is none.
+
+        Call :func:`release` when done, or use :func:`lease`."""
+        compress = getattr(owner, 'compress', True) if compress is None else compress
+        key = (owner.hostname, owner.remote_user, compress)
+        with self.lock:
+            for connection in self.connections.get(key, []):
+                if connection.leases < self.max_channels and connection.is_active():
+                    connection.leases += 1
+                    return connection
+            connection = PooledConnection(key)
+            connection.leases = 1
+            self.connections.setdefault(key, []).append(connection)
+        try:
+            owner.connect(ssh=connection.ssh, compress=compress, retries=retries)
+        except BaseException:
+            self.discard(connection)
+            raise
+        return connection
+
+    def release(self, connection):
+        with self.lock:
+            connection.leases -= 1
+            connection.last_used = time.time()
+            close = connection.retired and not connection.leases
+        if close:
+            connection.ssh.close()
+
+    def discard(self, connection):
+        """Removes the connection from the pool so it takes no new leases. It is closed now
+        if it has no leases or is no longer active, else when its last lease is released."""
+        with self.lock:
+            connections = self.connections.get(connection.key, [])
+            if connection in connections:
+                connections.remove(connection)
+            connection.retired = True
+            close = not connection.leases or not connection.is_active()
+        if close:
+            connection.ssh.close()
+
+    def replace(self, connection, owner, retries=None):
+        """Returns a lease on a connected connection in place of the caller's lease on
+        `connection`, e.g. after its transport dropped, and releases the old lease.
+
+        Replacements of connections with the same key are serialised, so lessees of a
+        dropped connection share the one the first of them connects. If connecting fails
+        the caller keeps its old lease."""
+        with self.lock:
+            key_lock = self.key_locks.setdefault(connection.key, threading.Lock())
+        with key_lock:
+            self.discard(connection)
+            replacement = self.acquire(owner, compress=connection.key[2], retries=retries)
+        self.release(connection)
+        return replacement
+
+    def evict_idle(self, idle_timeout=None):
+        """Closes connections without leases that are idle or no longer active. Returns the number closed."""
+        idle_timeout = self.idle_timeout if idle_timeout is None else idle_timeout
+        now = time.time()
+        evicted = []
+        with self.lock:
+            for key, connections in self.connections.items():
+                for connection in list(connections):
+                    if not connection.leases and (
+                            now - connection.last_used >= idle_timeout or not connection.is_active()):
+                        connections.remove(connection)
+                        evicted.append(connection)
+        for connection in evicted:
+            connection.ssh.close()
+        return len(evicted)
+
+    def close(self):
+        """Closes all connections, e.g. on shutdown."""
+        with self.lock:
+            connections = [connection for connections in self.connections.values() for connection in connections]
+            self.connections = {}
+        for connection in connections:
+            connection.ssh.close()
+
+
+ssh_pool = SSHPool(
+    max_channels=getattr(settings, 'GRTX_SSH_MAX_CHANNELS', None),
+    idle_timeout=getattr(settings, 'GRTX_SSH_IDLE_TIMEOUT', None))
@@ -10,6 +10,7 @@
 import magic
 import os
 from django.conf import settings
+from django.utils import timezone
 
 from getresults_dst.getresults import GrRemoteFolderEventHandler
 from getresults_dst.server import Server
@@ -18,7 +19,7 @@ from getresults_dst.file_handlers import BaseFileHandler
 from paramiko.client import SSHClient
 from getresults_dst.getresults import GrLogLineReader, GrFileHandler
 from getresults_dst.getresults.file_handlers import GrBhsFileHandler, GrCdc1FileHandler, GrCdc2FileHandler
-from getresults_dst.models import History, Upload
+from getresults_dst.models import Acknowledgment, History, Upload, LogReaderHistory
 from getresults_dst.actions import update_on_sent_action
 from getresults_dst.log_reader import LogReader
 
@@ -485,7 +486,60 @@ class TestGetresults(BaseTestCase):
         lastpos = log_reader.read()
         self.assertEquals(log_reader.last_read[0], '12-34-567-89.pdf')
         self.assertEquals(lastpos, len(txt))
+        self.assertEquals(LogReaderHistory.objects.get(lastpos=lastpos).lines, 3)
         try:
             os.remove(log_filename)
         except IOError:
             pass
+
+    def test_gr_log_reader_remote_filter(self):
+        txt = ('192.168.125.1 - - [03/Jul/2015:08:42:27 +0200] "GET /owncloud/index.php/apps/files/ajax'
+               '/download.php?dir=%2FViral_Loads%2Fsefophe&files=066-22220024-0.pdf HTTP/1.1" 200 4294 "http'
+               '://10.15.15.2/owncloud/apps/files_pdfviewer/vendor/pdfjs/build/pdf.worker.js?v=0.7" "Mozilla'
+               '/5.0 (Windows NT 6.1; WOW64; Trident/7.0; rv:11.0) like Gecko"\n'
+               '192.168.125.1 - - [03/Jul/2015:08:42:27 +0200] "GET /owncloud/index.php/apps/files/ajax'
+               '/download.php?dir=%2FViral_Loads%2Fsefophe&files=erik.txt HTTP/1.1" 200 4294 "http'
+               '://10.15.15.2/owncloud/apps/files_pdfviewer/vendor/pdfjs/build/pdf.worker.js?v=0.7" "Mozilla'
+               '/5.0 (Windows NT 6.1; WOW64; Trident/7.0; rv:11.0) like Gecko"\n'
+               '192.168.125.1 - - [03/Jul/2015:08:42:27 +0200] "GET /owncloud/index.php/apps/files/ajax'
+               '/download.php?dir=%2FViral_Loads%2Fsefophe&files=12-34-567-89.pdf HTTP/1.1" 200 4294 "http'
+               '://10.15.15.2/owncloud/apps/files_pdfviewer/vendor/pdfjs/build/pdf.worker.js?v=0.7" "Mozilla'
+               '/5.0 (Windows NT 6.1; WOW64; Trident/7.0; rv:11.0) like Gecko"\n'
+               )
+        log_filename = os.path.join(settings.MEDIA_ROOT, 'test.log')
+        self.create_temp_txt(log_filename, txt)
+        log_reader = LogReader(GrLogLineReader, None, None, log_filename, remote_filter=True)
+        lastpos = log_reader.read()
+        self.assertEquals(log_reader.last_read[0], '12-34-567-89.pdf')
+        self.assertEquals(lastpos, len(txt))
+        self.assertEquals(LogReaderHistory.objects.get(lastpos=lastpos).lines, 2)
+        try:
+            os.remove(log_filename)
+        except IOError:
+            pass
+
+    def test_gr_line_reader_unacknowledged_index(self):
+        History.objects.create(
+            hostname='localhost', remote_hostname='localhost', path='/tmp', remote_path='/tmp',
+            filename='066-22220024-0.pdf', filesize=1000, filetimestamp=timezone.now(),
+            mime_type='application/pdf', status='sent', sent_datetime=timezone.now(), user='erikvw')
+        ln = ('192.168.125.1 - - [03/Jul/2015:08:42:27 +0200] "GET /owncloud/index.php/apps/files/ajax'
+              '/download.php?dir=%2FViral_Loads%2Fsefophe&files=066-22220024-0.pdf HTTP/1.1" 200 4294 "http'
+              '://10.15.15.2/owncloud/apps/files_pdfviewer/vendor/pdfjs/build/pdf.worker.js?v=0.7" "Mozilla'
+              '/5.0 (Windows NT 6.1; WOW64; Trident/7.0; rv:11.0) like Gecko"')
+        line_reader = GrLogLineReader()
+        self.assertEquals(line_reader.unacknowledged, {'066-22220024-0.pdf'})
+        line_reader.on_newline(ln)
+        self.assertEquals(line_reader.unacknowledged, set())
+        self.assertTrue(History.objects.get(filename='066-22220024-0.pdf').acknowledged)
+        with self.assertNumQueries(1):
+            line_reader.on_newline(ln)
+        self.assertEquals(Acknowledgment.objects.filter(
+            filename='066-22220024-0.pdf', in_sent_history=True).count(), 2)
+        not_sent_ln = ln.replace('066-22220024-0.pdf', '066-22220025-0.pdf')
+        with self.assertNumQueries(2):
+            line_reader.on_newline(not_sent_ln)
+        with self.assertNumQueries(1):
+            line_reader.on_newline(not_sent_ln)
+        self.assertEquals(Acknowledgment.objects.filter(
+            filename='066-22220025-0.pdf', in_sent_history=False).count(), 2)
@@ -7,27 +7,54 @@
 # you should have received as part of this distribution.
 #
 
+import gzip
+import hashlib
+import io
+import json
 import magic
 import os
 import pwd
+import shutil
+import threading
+import time
 import watchdog
+import zipfile
+
+from datetime import timedelta
 
 from django.conf import settings
 from django.core.files import File
 from django.forms import ValidationError
 from django.test.testcases import TestCase
+from django.utils import timezone
 
 from paramiko import AuthenticationException, SSHClient
 from reportlab.pdfgen import canvas
 
-from getresults_dst.event_handlers import RemoteFolderEventHandler, LocalFolderEventHandler
+from getresults_dst.actions import audit_uploads, unaudit_uploads
+from getresults_dst.archive import (
+    ArchiveError, ContentAddressedArchiveStore, DateShardedArchiveStore, bundle_shard, read_archived,
+    verify_archived)
+from getresults_dst.bulk_upload import BulkUpload
+from getresults_dst.compression import CompressionPolicy
+from getresults_dst.console import ProgressReporter
+from getresults_dst.pending_state import PendingState, read_pending_state, FAILED, SENDING
+from getresults_dst.exports import export_lines, export_stream
+from getresults_dst.event_handlers import FanOutEventHandler, RemoteFolderEventHandler, LocalFolderEventHandler
 from getresults_dst.folder_handlers import BaseLookupFolderHandler, BaseFolderHandler
+from getresults_dst.scheduler import TokenBucket, TransferScheduler
 from getresults_dst.server import Server
-from getresults_dst.utils import load_remote_folders_from_csv
+from getresults_dst.ssh_pool import SSHPool, ssh_pool
+from getresults_dst.transfers import HashingReader, TransferVerifier, resumable_put
+from getresults_dst.upload_handlers import StreamedUploadedFile, upload_folder
+from getresults_dst.utils import content_hash, load_remote_folders_from_csv, sync_pending_files
 from getresults_dst.log_line_readers import BaseLineReader
 from getresults_dst.log_reader import LogReader
+from getresults_dst.mixins import CircuitBreaker, backoff
 from getresults_dst.forms import UploadForm
-from getresults_dst.models import Upload, History
+from getresults_dst.models import (
+    Upload, History, Pending, DeliveryRollup, RemoteFolder, TX_VERIFIED, TX_MISMATCH)
+from getresults_dst.rollups import record_ack, record_sent, rebuild_rollups
 
 
 class BaseTestCase(TestCase):
@@ -490,3 +517,609 @@ class Tests(BaseTestCase):
         upload.save()
         self.assertEquals(upload.filename, filename)
         self.remove_temp_files([filename], server)
+
+    def test_progress_reporter_throttles(self):
+        class Sink(list):
+            def write(self, msg, end='\n'):
+                self.append(msg + end)
+
+            def flush(self):
+                pass
+        sink = Sink()
+        progress = ProgressReporter(interval=60, sink=sink)
+        for line_number in range(1000):
+            progress.update(line_number, line_number * 100)
+        self.assertEquals(len(sink), 1)
+        progress.done(1000, 100000)
+        self.assertEquals(len(sink), 3)
+        self.assertIn('lines: 1000', sink[1])
+        self.assertIn('lines/sec', sink[1])
+
+    def test_sync_pending_files(self):
+        source_dir = os.path.join(settings.BASE_DIR, 'testdata/upload')
+        for filename in ['tmp1.txt', 'tmp2.txt']:
+            self.create_temp_txt(os.path.join(source_dir, filename))
+        sync_pending_files(source_dir)
+        self.assertEquals(Pending.objects.filter(filename__in=['tmp1.txt', 'tmp2.txt']).count(), 2)
+        pk = Pending.objects.get(filename='tmp1.txt').pk
+        self.assertEquals(sync_pending_files(source_dir), (0, 0, 0))
+        os.remove(os.path.join(source_dir, 'tmp2.txt'))
+        self.create_temp_txt(os.path.join(source_dir, 'tmp3.txt'))
+        added, deleted, updated = sync_pending_files(source_dir)
+        self.assertEquals((added, deleted), (1, 1))
+        self.assertEquals(Pending.objects.get(filename='tmp1.txt').pk, pk)
+        self.assertFalse(Pending.objects.filter(filename='tmp2.txt').exists())
+        for filename in ['tmp1.txt', 'tmp3.txt']:
+            os.remove(os.path.join(source_dir, filename))
+
+    def test_pending_state_published(self):
+        path = '/tmp/getresults_dst_test_pending.json'
+        pending_state = PendingState(path=path)
+        pending_state.set_stage('tmp.txt', SENDING)
+        state = read_pending_state(path)
+        self.assertEquals([item['filename'] for item in state['files']], ['tmp.txt'])
+        self.assertEquals(state['files'][0]['stage'], SENDING)
+        pending_state.remove('tmp.txt')
+        pending_state.publish(force=True)
+        self.assertEquals(read_pending_state(path)['files'], [])
+        self.assertIsNone(read_pending_state(path, max_age=-1))
+        os.remove(path)
+
+    def test_audit_uploads(self):
+        Upload.objects.create(filename='sent.pdf', sent=True)
+        Upload.objects.create(filename='not_sent.pdf', sent=False)
+        self.assertEquals(audit_uploads(Upload.objects.all(), 'erikvw'), 1)
+        upload = Upload.objects.get(filename='sent.pdf')
+        self.assertTrue(upload.audited)
+        self.assertEquals(upload.auditor, 'erikvw')
+        self.assertIsNotNone(upload.audited_datetime)
+        self.assertFalse(Upload.objects.get(filename='not_sent.pdf').audited)
+        self.assertEquals(unaudit_uploads(Upload.objects.all()), 2)
+        self.assertFalse(Upload.objects.filter(audited=True).exists())
+
+    def test_rollups(self):
+        for filename in ['066-12000001-3.pdf', '066-12000002-3.pdf']:
+            history = History.objects.create(
+                hostname='localhost', remote_hostname='localhost', path='/tmp', remote_path='/tmp',
+                remote_folder='digawana', remote_folder_tag='12', label='bhs',
+                filename=filename, filesize=1000, filetimestamp=timezone.now(),
+                mime_type='application/pdf', status='sent', sent_datetime=timezone.now(), user='erikvw')
+            record_sent(history)
+        history.acknowledged = True
+        history.ack_datetime = history.sent_datetime + timedelta(hours=2)
+        history.save()
+        record_ack(history)
+        rollup = DeliveryRollup.objects.get(remote_folder='digawana', label='bhs')
+        self.assertEquals((rollup.sent, rollup.acknowledged), (2, 1))
+        self.assertEquals((rollup.ack_within_hour, rollup.ack_within_day), (0, 1))
+        self.assertEquals(rollup.ack_seconds, 7200)
+        self.assertEquals(rebuild_rollups(), 1)
+        rebuilt = DeliveryRollup.objects.get(remote_folder='digawana', label='bhs')
+        self.assertEquals(
+            (rebuilt.sent, rebuilt.acknowledged, rebuilt.ack_seconds, rebuilt.ack_within_day),
+            (rollup.sent, rollup.acknowledged, rollup.ack_seconds, rollup.ack_within_day))
+
+    def test_export(self):
+        for filename in ['066-12000001-3.pdf', '066-12000002-3.pdf', '066-12000003-3.pdf']:
+            History.objects.create(
+                hostname='localhost', remote_hostname='localhost', path='/tmp', remote_path='/tmp',
+                filename=filename, filesize=1000, filetimestamp=timezone.now(),
+                mime_type='application/pdf', status='sent', sent_datetime=timezone.now(), user='erikvw')
+        lines = list(export_lines('history', 'jsonl', chunk_size=2))
+        self.assertEquals(
+            [json.loads(line)['filename'] for line in lines],
+            ['066-12000001-3.pdf', '066-12000002-3.pdf', '066-12000003-3.pdf'])
+        lines = list(export_lines('history', 'csv', chunk_size=2))
+        self.assertEquals(len(lines), 4)
+        self.assertTrue(lines[0].startswith('id,filename'))
+        data = gzip.decompress(b''.join(export_stream('history', 'csv', compress=True)))
+        self.assertEquals(data.decode(), ''.join(lines))
+
+    def test_load_remote_folders_from_csv(self):
+        records, added, updated, unchanged = load_remote_folders_from_csv()
+        self.assertEquals((added, updated, unchanged), (RemoteFolder.objects.count(), 0, 0))
+        remote_folder = RemoteFolder.objects.get(folder='digawana', label='bhs')
+        remote_folder.folder_tag = '99'
+        remote_folder.save()
+        self.assertEquals(load_remote_folders_from_csv(), (records, 0, 1, added - 1))
+        self.assertEquals(RemoteFolder.objects.get(folder='digawana', label='bhs').folder_tag, '12')
+
+    def test_streamed_upload(self):
+        upload_dir = upload_folder()
+        if not os.path.exists(upload_dir):
+            os.makedirs(upload_dir)
+        filename = os.path.join(settings.BASE_DIR, 'testdata/upload/066-12000009-3.pdf')
+        self.create_temp_pdf(filename, '066-12000009-3')
+        with open(filename, 'rb') as f:
+            data = f.read()
+        os.remove(filename)
+        uploaded = StreamedUploadedFile('066-12000009-3.pdf', 'application/pdf', None, dir=upload_dir)
+        for start in range(0, len(data), 100):
+            uploaded.write_chunk(data[start:start + 100])
+        uploaded.complete()
+        temporary_file_path = uploaded.temporary_file_path()
+        self.assertTrue(os.path.split(temporary_file_path)[1].startswith('.'))
+        self.assertEquals(uploaded.size, len(data))
+        self.assertEquals(uploaded.content_hash, hashlib.sha256(data).hexdigest())
+        self.assertEquals(uploaded.mime_type, 'application/pdf')
+        inode = os.stat(temporary_file_path).st_ino
+        upload = Upload(file=uploaded)
+        upload.save()
+        path = os.path.join(upload_dir, upload.filename)
+        self.assertEquals(os.stat(path).st_ino, inode)
+        self.assertFalse(os.path.exists(temporary_file_path))
+        self.assertEquals(upload.filesize, len(data))
+        with open(path, 'rb') as f:
+            self.assertEquals(f.read(), data)
+        rejected = StreamedUploadedFile('066-12000010-3.pdf', 'application/pdf', None, dir=upload_dir)
+        rejected.write_chunk(data)
+        rejected.complete()
+        rejected.close()
+        self.assertFalse(os.path.exists(rejected.temporary_file_path()))
+        os.remove(path)
+
+    def test_content_hash_reused_filename(self):
+        source_dir = os.path.join(settings.BASE_DIR, 'testdata/upload')
+        event_handler = LocalFolderEventHandler(
+            source_dir=source_dir,
+            destination_dir=os.path.join(settings.BASE_DIR, 'testdata/outbox'),
+            archive_dir=os.path.join(settings.BASE_DIR, 'testdata/archive'),
+            file_patterns=['*.txt'],
+            mime_types=['text/plain'])
+        filename = 'tmp1.txt'
+        path = os.path.join(source_dir, filename)
+        self.create_temp_txt(path, 'results of a later run')
+        upload = Upload.objects.create(
+            filename=filename, filesize=os.path.getsize(path), content_hash='a' * 64,
+            upload_datetime=timezone.now() - timedelta(days=1))
+        self.assertEquals(event_handler.get_content_hash(filename), content_hash(path=path))
+        upload.upload_datetime = timezone.now()
+        upload.save()
+        self.assertEquals(event_handler.get_content_hash(filename), 'a' * 64)
+        os.remove(path)
+
+    def test_bulk_upload_zip(self):
+        source_dir = os.path.join(settings.BASE_DIR, 'testdata/upload')
+        filenames = ['066-12000011-3.pdf', '066-12000012-3.pdf', '066-12000013-3.pdf']
+        for filename in filenames:
+            self.create_temp_pdf(os.path.join(source_dir, filename), filename)
+        self.create_temp_txt(os.path.join(source_dir, 'tmp1.pdf'))
+        History.objects.create(
+            hostname='localhost', remote_hostname='localhost', path='/tmp', remote_path='/tmp',
+            filename=filenames[2], filesize=1000, filetimestamp=timezone.now(),
+            mime_type='application/pdf', status='sent', sent_datetime=timezone.now(), user='erikvw')
+        data = io.BytesIO()
+        with zipfile.ZipFile(data, 'w') as archive:
+            for filename in filenames + ['tmp1.pdf']:
+                archive.write(os.path.join(source_dir, filename), 'results/' + filename)
+                os.remove(os.path.join(source_dir, filename))
+        uploaded = StreamedUploadedFile('results.zip', 'application/zip', None, dir=source_dir)
+        uploaded.write_chunk(data.getvalue())
+        uploaded.complete()
+        uploads, rejected = BulkUpload(upload_dir=source_dir, user='erikvw').process([uploaded])
+        self.assertEquals([upload.filename for upload in uploads], filenames[:2])
+        self.assertEquals(sorted(filename for filename, _ in rejected), [filenames[2], 'tmp1.pdf'])
+        self.assertEquals(Upload.objects.filter(filename__in=filenames).count(), 2)
+        self.assertEquals([f for f in os.listdir(source_dir) if f.startswith('.upload')], [])
+        for filename in filenames[:2]:
+            os.remove(os.path.join(source_dir, filename))
+
+    def test_upload_form_duplicate_content(self):
+        History.objects.create(
+            hostname='localhost', remote_hostname='localhost', path='/tmp', remote_path='/tmp',
+            filename='066-12000021-3.pdf', filesize=1000, filetimestamp=timezone.now(),
+            mime_type='application/pdf', content_hash='a' * 64, status='sent',
+            sent_datetime=timezone.now(), user='erikvw')
+        self.assertRaises(ValidationError, UploadForm().raise_if_history, '066-12000022-3.pdf', 'a' * 64)
+        UploadForm().raise_if_history('066-12000022-3.pdf', 'b' * 64)
+        UploadForm().raise_if_upload('066-12000022-3.pdf', 'a' * 64)
+
+    def test_archive_bundle(self):
+        media_root = os.path.join(settings.BASE_DIR, 'testdata')
+        store = DateShardedArchiveStore()
+        when = timezone.now() - timedelta(days=400)
+        names = []
+        for text in ['one', 'two']:
+            path = os.path.join(media_root, 'upload', 'tmp_{}.txt'.format(text))
+            self.create_temp_txt(path, text)
+            name = store.archive_name('tmp_{}.txt'.format(text), when=when)
+            self.assertEquals(os.path.dirname(name), timezone.localtime(when).strftime('%Y/%m/%d'))
+            store.store(path, os.path.join(media_root, 'archive'), name)
+            names.append(name)
+        shards = list(store.shards_before(os.path.join(media_root, 'archive'), timezone.now().date()))
+        self.assertEquals(shards, [os.path.dirname(names[0])])
+        self.assertEquals(bundle_shard(os.path.join(media_root, 'archive', shards[0])), 2)
+        self.assertEquals(read_archived(os.path.join('archive', names[1]), media_root=media_root), b'two')
+        self.assertRaises(ArchiveError, read_archived, os.path.join('archive', shards[0], 'x.txt'), media_root)
+        shutil.rmtree(os.path.join(media_root, 'archive', shards[0][:4]))
+
+    def test_content_addressed_archive(self):
+        media_root = os.path.join(settings.BASE_DIR, 'testdata')
+        archive_dir = os.path.join(media_root, 'archive')
+        store = ContentAddressedArchiveStore()
+        names = []
+        for filename in ['tmp1.txt', 'tmp2.txt']:
+            path = os.path.join(media_root, 'upload', filename)
+            self.create_temp_txt(path, 'same content')
+            names.append(store.archive_name(filename, content_hash=content_hash(path=path)))
+            store.store(path, archive_dir, names[-1])
+            self.assertFalse(os.path.exists(path))
+        self.assertEquals(names[0], names[1])
+        path = os.path.join(media_root, 'upload', 'tmp3.txt')
+        self.create_temp_txt(path, 'different content')
+        self.assertRaises(ArchiveError, store.store, path, archive_dir, names[0])
+        self.assertRaises(ArchiveError, store.store, path, archive_dir, names[0], file_hash=content_hash(path=path))
+        self.assertTrue(os.path.exists(path))
+        os.remove(path)
+        self.assertTrue(verify_archived(
+            os.path.join('archive', names[0]), os.path.basename(names[0])[:-4], media_root=media_root))
+        shutil.rmtree(os.path.join(archive_dir, names[0][:2]))
+
+    def test_transfer_verifier(self):
+        reader = HashingReader(io.BytesIO(b'hello world'))
+        while reader.read(4):
+            pass
+        self.assertEquals(reader.hexdigest(), hashlib.sha256(b'hello world').hexdigest())
+        histories = []
+        for n, content_hash in enumerate([reader.hexdigest(), 'b' * 64]):
+            histories.append(History.objects.create(
+                hostname='localhost', remote_hostname='localhost', path='/tmp', remote_path='/tmp/dst',
+                filename='tmp{}.pdf'.format(n), filesize=11, filetimestamp=timezone.now(),
+                mime_type='application/pdf', content_hash=content_hash, status='sent',
+                sent_datetime=timezone.now(), user='erikvw'))
+
+        class SSH(object):
+            def exec_command(self, command):
+                self.command = command
+                return None, io.BytesIO('{}  tmp0.pdf\n{}  tmp1.pdf\n'.format(
+                    reader.hexdigest(), 'c' * 64).encode()), None
+        ssh = SSH()
+        verifier = TransferVerifier(batch_size=2)
+        self.assertFalse(verifier.add(histories[0]))
+        self.assertTrue(verifier.add(histories[1]))
+        self.assertEquals(verifier.flush(ssh), (['tmp0.pdf'], ['tmp1.pdf']))
+        self.assertEquals(ssh.command, 'cd /tmp/dst && sha256sum -- tmp0.pdf tmp1.pdf')
+        self.assertEquals(History.objects.get(filename='tmp0.pdf').status, TX_VERIFIED)
+        self.assertEquals(History.objects.get(filename='tmp1.pdf').status, TX_MISMATCH)
+
+    def test_resumable_put(self):
+        source_dir = os.path.join(settings.BASE_DIR, 'testdata/upload')
+        source = os.path.join(source_dir, 'tmp1.txt')
+        part = os.path.join(source_dir, '.tmp1.txt.part')
+        self.create_temp_txt(source, 'x' * 100000)
+        with open(part, 'w') as f:
+            f.write('x' * 40000)
+
+        class LocalFile(io.FileIO):
+            def set_pipelined(self, pipelined=True):
+                pass
+
+        class LocalSFTP(object):
+            def stat(self, path):
+                return os.stat(path)
+
+            def open(self, path, mode):
+                return LocalFile(path, mode.replace('b', ''))
+        def local_digest(path, size):
+            with open(path, 'rb') as f:
+                return hashlib.sha256(f.read(size)).hexdigest()
+
+        digest, offset = resumable_put(LocalSFTP(), source, part, chunk_size=1000, remote_digest=local_digest)
+        self.assertEquals(offset, 40000)
+        self.assertEquals(digest, content_hash(path=source))
+        self.assertEquals(content_hash(path=part), digest)
+        with open(part, 'w') as f:
+            f.write('y' * 40000)  # left by an earlier file with the same name
+        digest, offset = resumable_put(LocalSFTP(), source, part, chunk_size=1000, remote_digest=local_digest)
+        self.assertEquals(offset, 0)
+        self.assertEquals(content_hash(path=part), content_hash(path=source))
+        for path in [source, part]:
+            os.remove(path)
+
+    def test_compression_policy(self):
+        source_dir = os.path.join(settings.BASE_DIR, 'testdata/upload')
+        path = os.path.join(source_dir, 'tmp1.dat')
+        policy = CompressionPolicy()
+        self.assertFalse(policy.compress(path, b'application/pdf'))
+        self.assertTrue(policy.compress(path, 'text/plain'))
+        with open(path, 'wb') as f:
+            f.write(b'a' * 10000)
+        self.assertTrue(policy.compress(path, 'application/octet-stream'))
+        with open(path, 'wb') as f:
+            f.write(os.urandom(10000))
+        self.assertFalse(policy.compress(path, 'application/octet-stream'))
+        os.remove(path)
+
+    def test_remote_folder_batch(self):
+        source_dir = os.path.join(settings.BASE_DIR, 'testdata/upload')
+        destination_dir = '~/' + os.path.join(settings.BASE_DIR.split(os.path.expanduser('~/'))[1], 'testdata/outbox')
+        archive_dir = os.path.join(settings.BASE_DIR, 'testdata/archive')
+        RemoteFolderEventHandler.folder_handler = BaseFolderHandler()
+        event_handler = RemoteFolderEventHandler(
+            source_dir=source_dir,
+            destination_dir=destination_dir,
+            archive_dir=archive_dir,
+            mime_types=['text/plain'],
+            file_patterns=['*.txt'],
+            remote_user=pwd.getpwuid(os.getuid()).pw_name,
+            batch_window=60
+        )
+        filenames = ['tmp1.txt', 'tmp2.txt']
+        for filename in filenames:
+            self.create_temp_txt(os.path.join(source_dir, filename), filename)
+        with SSHClient() as event_handler.ssh:
+            event_handler.connect()
+            for filename in filenames:
+                event_handler.on_created(watchdog.events.FileCreatedEvent(os.path.join(source_dir, filename)))
+            self.assertFalse(History.objects.filter(filename__in=filenames).exists())
+            event_handler.send_batches(force=True)
+        self.assertEquals(History.objects.filter(filename__in=filenames).count(), 2)
+        for filename in filenames:
+            self.assertFalse(os.path.exists(os.path.join(source_dir, filename)))
+            os.remove(os.path.join(event_handler.destination_dir, filename))
+        filename = 'tmp3.txt'
+        self.create_temp_txt(os.path.join(source_dir, filename))
+        folder_selection = type('FolderSelection', (object, ), {'path': event_handler.destination_dir})
+        item = (filename, folder_selection, 'text/plain', None)
+        for _ in range(event_handler.batch_retries):
+            event_handler.requeue_batch([item], unconfirmed=True)
+            self.assertIn(filename, event_handler.batches[event_handler.destination_dir]['files'])
+            event_handler.batches = {}
+        event_handler.requeue_batch([item], unconfirmed=True)
+        self.assertEquals(event_handler.batches, {})
+        self.assertEquals(event_handler.pending_state.files[filename]['stage'], FAILED)
+        os.remove(os.path.join(source_dir, filename))
+        RemoteFolderEventHandler.folder_handler = BaseLookupFolderHandler()
+
+    def test_ssh_pool(self):
+        pool = SSHPool(max_channels=2, idle_timeout=0)
+        owner = LogReader(BaseLineReader, None, pwd.getpwuid(os.getuid()).pw_name, None)
+        with pool.lease(owner) as ssh1:
+            with pool.lease(owner) as ssh2:
+                self.assertIs(ssh1, ssh2)
+                with pool.lease(owner) as ssh3:
+                    self.assertIsNot(ssh1, ssh3)
+                    self.assertEquals(pool.evict_idle(), 0)
+        with pool.lease(owner) as ssh4:
+            self.assertIn(ssh4, [ssh1, ssh3])
+        self.assertEquals(pool.evict_idle(), 2)
+        self.assertEquals(sum(len(connections) for connections in pool.connections.values()), 0)
+        connection = pool.acquire(owner)
+        self.assertIs(pool.acquire(owner), connection)
+        replacement = pool.replace(connection, owner)
+        self.assertIsNot(replacement, connection)
+        self.assertTrue(connection.is_active())
+        self.assertIs(pool.replace(connection, owner), replacement)
+        self.assertIsNone(connection.ssh.get_transport())
+        self.assertEquals(replacement.leases, 2)
+        pool.close()
+
+    def test_remote_folder_leases(self):
+        source_dir = os.path.join(settings.BASE_DIR, 'testdata/upload')
+        destination_dir = '~/' + os.path.join(settings.BASE_DIR.split(os.path.expanduser('~/'))[1], 'testdata/outbox')
+        event_handler = RemoteFolderEventHandler(
+            source_dir=source_dir,
+            destination_dir=destination_dir,
+            archive_dir=os.path.join(settings.BASE_DIR, 'testdata/archive'),
+            mime_types=['text/plain'],
+            file_patterns=['*.txt'],
+            remote_user=pwd.getpwuid(os.getuid()).pw_name,
+            batch_window=60)
+        connection = ssh_pool.acquire(event_handler)
+        event_handler.connection, event_handler.ssh = connection, connection.ssh
+        leases = []
+        barrier = threading.Barrier(2, timeout=5)
+
+        def leased_job():
+            with event_handler.leased():
+                event_handler.thread_ssh()
+                barrier.wait()
+                leases.append(connection.leases)
+                barrier.wait()
+
+        scheduler = TransferScheduler(workers=2)
+        for destination in ['one', 'two']:
+            scheduler.submit(leased_job, destination=destination)
+        self.assertTrue(scheduler.join(5))
+        scheduler.stop()
+        self.assertEquals(leases, [3, 3])  # the observer's and one per worker
+        self.assertEquals(connection.leases, 1)
+
+        def send_batch(destination_dir, items):
+            event_handler.thread_ssh()
+            leases.append(connection.leases)
+
+        event_handler.send_batch = send_batch
+        event_handler.batches = {destination_dir: {'opened': time.time(), 'files': {'tmp1.txt': (None, None, None)}}}
+        event_handler.send_batches(force=True)
+        self.assertEquals(leases[-1], 2)
+        self.assertEquals(connection.leases, 1)
+        other = ssh_pool.acquire(event_handler)
+        self.assertIs(other, connection)
+        event_handler.reconnect(event_handler.ssh, force=True)
+        self.assertIsNot(event_handler.connection, connection)
+        self.assertIs(event_handler.ssh, event_handler.connection.ssh)
+        self.assertTrue(other.is_active())
+        self.assertEquals(other.leases, 1)
+        ssh_pool.release(other)
+        self.assertFalse(other.is_active())
+        ssh_pool.release(event_handler.connection)
+        ssh_pool.close()
+
+    def test_circuit_breaker(self):
+        circuit_breaker = CircuitBreaker(failure_threshold=2, reset_timeout=0.2)
+        circuit_breaker.record_failure()
+        self.assertTrue(circuit_breaker.allow())
+        circuit_breaker.record_failure()
+        self.assertEquals(circuit_breaker.state, 'open')
+        self.assertFalse(circuit_breaker.allow())
+        time.sleep(0.2)
+        self.assertEquals(circuit_breaker.state, 'half-open')
+        self.assertTrue(circuit_breaker.allow())
+        self.assertFalse(circuit_breaker.allow())
+        circuit_breaker.record_failure()
+        circuit_breaker.end_trial()
+        self.assertFalse(circuit_breaker.allow())
+        time.sleep(0.2)
+        circuit_breaker.record_success()
+        self.assertEquals(circuit_breaker.state, 'closed')
+        for attempt in range(10):
+            self.assertLessEqual(backoff(attempt, cap=60), 60)
+
+    def test_remote_folder_parked(self):
+        source_dir = os.path.join(settings.BASE_DIR, 'testdata/upload')
+        destination_dir = '~/' + os.path.join(settings.BASE_DIR.split(os.path.expanduser('~/'))[1], 'testdata/outbox')
+        archive_dir = os.path.join(settings.BASE_DIR, 'testdata/archive')
+        RemoteFolderEventHandler.folder_handler = BaseFolderHandler()
+        event_handler = RemoteFolderEventHandler(
+            source_dir=source_dir,
+            destination_dir=destination_dir,
+            archive_dir=archive_dir,
+            mime_types=['text/plain'],
+            file_patterns=['*.txt'],
+            remote_user=pwd.getpwuid(os.getuid()).pw_name,
+            circuit_breaker=CircuitBreaker(failure_threshold=1, reset_timeout=60)
+        )
+        filename = 'tmp1.txt'
+        self.create_temp_txt(os.path.join(source_dir, filename))
+        with SSHClient() as event_handler.ssh:
+            event_handler.connect()
+            event_handler.circuit_breaker.record_failure()
+            event_handler.on_created(watchdog.events.FileCreatedEvent(os.path.join(source_dir, filename)))
+            self.assertIn(filename, event_handler.parked)
+            self.assertFalse(History.objects.filter(filename=filename).exists())
+            event_handler.circuit_breaker.record_success()
+            event_handler.on_tick()
+        self.assertEquals(event_handler.parked, {})
+        self.assertTrue(History.objects.filter(filename=filename).exists())
+        os.remove(os.path.join(event_handler.destination_dir, filename))
+        RemoteFolderEventHandler.folder_handler = BaseLookupFolderHandler()
+
+    def test_remote_folder_half_open_probe(self):
+        source_dir = os.path.join(settings.BASE_DIR, 'testdata/upload')
+        destination_dir = '~/' + os.path.join(settings.BASE_DIR.split(os.path.expanduser('~/'))[1], 'testdata/outbox')
+        archive_dir = os.path.join(settings.BASE_DIR, 'testdata/archive')
+        RemoteFolderEventHandler.folder_handler = BaseFolderHandler()
+        event_handler = RemoteFolderEventHandler(
+            source_dir=source_dir,
+            destination_dir=destination_dir,
+            archive_dir=archive_dir,
+            mime_types=['text/plain'],
+            file_patterns=['*.txt'],
+            remote_user=pwd.getpwuid(os.getuid()).pw_name,
+            circuit_breaker=CircuitBreaker(failure_threshold=1, reset_timeout=0.2)
+        )
+        filename = 'tmp1.txt'
+        self.create_temp_txt(os.path.join(source_dir, filename))
+        with SSHClient() as event_handler.ssh:
+            event_handler.connect()
+            event_handler.circuit_breaker.record_failure()  # e.g. on the compressed connection
+            event_handler.on_created(watchdog.events.FileCreatedEvent(os.path.join(source_dir, filename)))
+            self.assertIn(filename, event_handler.parked)
+            event_handler.on_tick()
+            self.assertIn(filename, event_handler.parked)
+            time.sleep(0.2)
+            self.assertEquals(event_handler.circuit_breaker.state, 'half-open')
+            self.assertTrue(event_handler.is_healthy(event_handler.ssh))
+            event_handler.on_tick()
+        self.assertEquals(event_handler.circuit_breaker.state, 'closed')
+        self.assertEquals(event_handler.parked, {})
+        self.assertTrue(History.objects.filter(filename=filename).exists())
+        os.remove(os.path.join(event_handler.destination_dir, filename))
+        RemoteFolderEventHandler.folder_handler = BaseLookupFolderHandler()
+
+    def test_fan_out(self):
+        source_dir = os.path.join(settings.BASE_DIR, 'testdata/upload')
+        base_dir = '~/' + os.path.join(settings.BASE_DIR.split(os.path.expanduser('~/'))[1], 'testdata')
+        archive_dir = os.path.join(settings.BASE_DIR, 'testdata/archive')
+        RemoteFolderEventHandler.folder_handler = BaseFolderHandler()
+        event_handler = FanOutEventHandler(
+            destinations=[
+                {'name': 'one', 'destination_dir': os.path.join(base_dir, 'outbox')},
+                {'name': 'two', 'destination_dir': os.path.join(base_dir, 'outbox2')}],
+            source_dir=source_dir,
+            archive_dir=archive_dir,
+            mime_types=['text/plain'],
+            file_patterns=['*.txt'],
+            remote_user=pwd.getpwuid(os.getuid()).pw_name,
+            mkdir_destination=True)
+        filename = 'tmp1.txt'
+        self.create_temp_txt(os.path.join(source_dir, filename))
+        event_handler.connect()
+        event_handler.on_created(watchdog.events.FileCreatedEvent(os.path.join(source_dir, filename)))
+        event_handler.close()
+        self.assertEquals(
+            sorted(History.objects.filter(filename=filename).values_list('remote_path', flat=True)),
+            [os.path.join(settings.BASE_DIR, 'testdata/outbox'), os.path.join(settings.BASE_DIR, 'testdata/outbox2')])
+        self.assertFalse(os.path.exists(os.path.join(source_dir, filename)))
+        for folder in ['outbox', 'outbox2']:
+            os.remove(os.path.join(settings.BASE_DIR, 'testdata', folder, filename))
+        RemoteFolderEventHandler.folder_handler = BaseLookupFolderHandler()
+
+    def test_fan_out_same_path_on_two_hosts(self):
+        source_dir = os.path.join(settings.BASE_DIR, 'testdata/upload')
+        destination_dir = '~/' + os.path.join(settings.BASE_DIR.split(os.path.expanduser('~/'))[1], 'testdata/outbox')
+        archive_dir = os.path.join(settings.BASE_DIR, 'testdata/archive')
+        RemoteFolderEventHandler.folder_handler = BaseFolderHandler()
+        event_handler = FanOutEventHandler(
+            destinations=[
+                {'name': 'one', 'hostname': 'localhost', 'destination_dir': destination_dir},
+                {'name': 'two', 'hostname': '127.0.0.1', 'destination_dir': destination_dir}],
+            source_dir=source_dir,
+            archive_dir=archive_dir,
+            mime_types=['text/plain'],
+            file_patterns=['*.txt'],
+            remote_user=pwd.getpwuid(os.getuid()).pw_name,
+            trusted_host=True)
+        filename = 'tmp1.txt'
+        path = os.path.join(source_dir, filename)
+        self.create_temp_txt(path)
+        file_hash = content_hash(path=path)
+        remote_path = os.path.join(settings.BASE_DIR, 'testdata/outbox')
+        for remote_hostname in ['localhost', 'remote.example.com']:
+            History.objects.create(
+                hostname='localhost', remote_hostname=remote_hostname, path=source_dir, remote_path=remote_path,
+                filename=filename, filesize=1, filetimestamp=timezone.now(), mime_type='text/plain',
+                content_hash=file_hash, status='sent', sent_datetime=timezone.now(), user='erikvw',
+                archive='archive/old.txt')
+        pending = event_handler.select_destinations(filename, 'text/plain', file_hash)
+        self.assertEquals([destination.name for destination, _ in pending], ['two'])
+        self.assertEquals(event_handler.deliveries[filename], {'one': remote_path})
+        event_handler.archive_delivered(filename, file_hash)
+        self.assertEquals(
+            History.objects.get(remote_hostname='remote.example.com').archive.name, 'archive/old.txt')
+        self.assertNotEquals(History.objects.get(remote_hostname='localhost').archive.name, 'archive/old.txt')
+        event_handler.close()
+        RemoteFolderEventHandler.folder_handler = BaseLookupFolderHandler()
+
+    def test_transfer_scheduler(self):
+        started = threading.Event()
+        release = threading.Event()
+        sent = []
+
+        def blocking_job():
+            started.set()
+            release.wait(5)
+
+        scheduler = TransferScheduler(workers=1, priorities={'cdc1': 0, 'bhs': 1})
+        scheduler.submit(blocking_job, priority_class='bhs', destination='one')
+        started.wait(5)
+        for n, priority_class in enumerate(['bhs', 'cdc2', 'bhs', 'cdc1']):
+            scheduler.submit(sent.append, ('{}-{}'.format(priority_class, n), ),
+                             priority_class=priority_class, destination='one')
+        self.assertEquals(scheduler.queue_depth(), {'bhs': 2, 'cdc1': 1, 'cdc2': 1})
+        self.assertTrue(scheduler.submit(sent.append, ('tmp1.txt', ), destination='one', key='tmp1.txt'))
+        self.assertFalse(scheduler.submit(sent.append, ('tmp1.txt', ), destination='one', key='tmp1.txt'))
+        release.set()
+        self.assertTrue(scheduler.join(5))
+        scheduler.stop()
+        self.assertEquals(sent, ['cdc1-3', 'bhs-0', 'bhs-2', 'cdc2-1', 'tmp1.txt'])
+
+    def test_token_bucket(self):
+        bucket = TokenBucket(100000)
+        reader = HashingReader(io.BytesIO(b'x' * 250000), bandwidth=bucket)
+        started = time.time()
+        while reader.read(10000):
+            pass
+        self.assertGreaterEqual(time.time() - started, 1.4)
+        self.assertEquals(reader.bytes_read, 250000)
@@ -0,0 +1,148 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2015 Erik van Widenfelt
+# All rights reserved.
+#
+# This software is licensed as described in the file COPYING, which
+# you should have received as part of this distribution.
+#
+
+import hashlib
+import os
+import shlex
+import threading
+
+from .models import History, TX_VERIFIED, TX_MISMATCH
+
+
+class TransferError(Exception):
+    pass
+
+
+class HashingReader(object):
+    """Wraps a file object and calculates the sha256 of the bytes as they are read,
+    so a transfer gets the digest of what was sent without a second read.
+
+    If `bandwidth` (a :class:`TokenBucket`) is set, reads are throttled to its rate."""
+
+    def __init__(self, fileobj, bandwidth=None):
+        self.fileobj = fileobj
+        self.bandwidth = bandwidth
+        self.hash = hashlib.sha256()
+        self.bytes_read = 0
+
+    def read(self, size=-1):
+        data = self.fileobj.read(size)
+        self.hash.update(data)
+        self.bytes_read += len(data)
+        if self.bandwidth and data:
+            self.bandwidth.consume(len(data))
+        return data
+
+    def hexdigest(self):
+        return self.hash.hexdigest()
+
+
+def resumable_put(sftp, local_path, remote_path, size=None, chunk_size=None, bandwidth=None, remote_digest=None):
+    """Writes local_path to remote_path over SFTP, resuming from the size of
+    remote_path if it exists, e.g. left by a dropped connection.
+
+    Resumes only if `remote_digest`, a callable of (remote_path, size) that returns the sha256
+    of the first size bytes of remote_path, matches the local prefix, so the partial file of
+    an earlier file with the same name, e.g. a reissued result, is written again from byte zero.
+
+    The local prefix already on the remote host is read again only to update the hash
+    and is not throttled by `bandwidth`.
+    Returns a tuple of (sha256 hex digest, offset resumed from)."""
+    chunk_size = chunk_size or 32768
+    size = os.path.getsize(local_path) if size is None else size
+    try:
+        offset = sftp.stat(remote_path).st_size
+    except IOError:
+        offset = 0
+    if offset > size or not remote_digest:
+        offset = 0
+    with open(local_path, 'rb') as f:
+        reader = HashingReader(f)
+        while reader.bytes_read < offset:
+            if not reader.read(min(chunk_size, offset - reader.bytes_read)):
+                break
+        if offset and remote_digest(remote_path, offset) != reader.hexdigest():
+            f.seek(0)
+            reader, offset = HashingReader(f), 0
+        reader.bandwidth = bandwidth
+        with sftp.open(remote_path, 'r+b' if offset else 'wb') as remote_file:
+            remote_file.seek(offset)
+            remote_file.set_pipelined(True)
+            for chunk in iter(lambda: reader.read(chunk_size), b''):
+                remote_file.write(chunk)
+    return reader.hexdigest(), offset
+
+
+def remote_prefix_hash(ssh, remote_path, size):
+    """Returns the sha256 of the first size bytes of remote_path on the remote host."""
+    _, stdout, _ = ssh.exec_command('head -c {} -- {} | sha256sum'.format(int(size), shlex.quote(remote_path)))
+    return stdout.read().decode().split(' ')[0].strip()
+
+
+class TransferVerifier(object):
+    """Collects sent files per remote folder and verifies them in batches with
+    one remote `sha256sum` per folder.
+
+    The History status of each file is updated to verified or mismatch."""
+
+    def __init__(self, batch_size=None):
+        self.batch_size = batch_size or 50
+        self.pending = {}
+        self.lock = threading.Lock()
+
+    def add(self, history):
+        """Adds a sent file. Returns True if the batch for its remote folder is full."""
+        with self.lock:
+            batch = self.pending.setdefault(history.remote_path, {})
+            batch[history.filename] = (history.pk, history.content_hash)
+            return len(batch) >= self.batch_size
+
+    def flush(self, ssh, remote_path=None):
+        """Verifies the pending files of remote_path or of all remote folders.
+
+        Returns a tuple of (verified, mismatched) filenames."""
+        with self.lock:
+            if remote_path:
+                batches = {remote_path: self.pending.pop(remote_path, {})}
+            else:
+                batches, self.pending = self.pending, {}
+        verified, mismatched = [], []
+        for path, batch in batches.items():
+            if not batch:
+                continue
+            remote_hashes = self.remote_hashes(ssh, path, list(batch))
+            verified_pks, mismatched_pks = [], []
+            for filename, (pk, content_hash) in batch.items():
+                if remote_hashes.get(filename) == content_hash:
+                    verified.append(filename)
+                    verified_pks.append(pk)
+                else:
+                    mismatched.append(filename)
+                    mismatched_pks.append(pk)
+            if verified_pks:
+                History.objects.filter(pk__in=verified_pks).update(status=TX_VERIFIED)
+            if mismatched_pks:
+                History.objects.filter(pk__in=mismatched_pks).update(status=TX_MISMATCH)
+        return verified, mismatched
+
+    def remote_hashes(self, ssh, remote_path, filenames):
+        """Returns a dictionary of {filename: sha256} of the files in remote_path from one exec.
+
+        Files missing on the remote host are not in the dictionary."""
+        command = 'cd {} && sha256sum -- {}'.format(
+            shlex.quote(remote_path), ' '.join(shlex.quote(filename) for filename in filenames))
+        _, stdout, _ = ssh.exec_command(command)
+        remote_hashes = {}
+        for line in stdout.read().decode().splitlines():
+            try:
+                digest, filename = line.split(None, 1)
+            except ValueError:
+                continue
+            remote_hashes[filename.lstrip('*')] = digest
+        return remote_hashes
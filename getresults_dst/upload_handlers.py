@@ -0,0 +1,132 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2015 Erik van Widenfelt
+# All rights reserved.
+#
+# This software is licensed as described in the file COPYING, which
+# you should have received as part of this distribution.
+#
+
+import hashlib
+import magic
+import os
+import tempfile
+
+from django.conf import settings
+from django.core.files.uploadedfile import UploadedFile
+from django.core.files.uploadhandler import FileUploadHandler, StopFutureHandlers
+
+
+def upload_folder():
+    return os.path.join(settings.MEDIA_ROOT, settings.GRTX_UPLOAD_FOLDER)
+
+
+def move_into_place(field_file):
+    """Links the temp file of an unsaved :class:`StreamedUploadedFile` to its name in
+    storage and removes the temp name, so the file is not copied and the observer sees it
+    once, complete. Returns True if moved.
+
+    Storage would otherwise copy it chunk by chunk, as `FileField` hands storage the
+    `FieldFile`, which has no `temporary_file_path`. See :func:`Upload.save`."""
+    if field_file._committed or not isinstance(field_file.file, StreamedUploadedFile):
+        return False
+    uploaded = field_file.file
+    name = field_file.field.generate_filename(field_file.instance, uploaded.name)
+    while True:
+        name = field_file.storage.get_available_name(name, max_length=field_file.field.max_length)
+        try:
+            os.link(uploaded.temporary_file_path(), field_file.storage.path(name))
+            break
+        except FileExistsError:
+            pass  # taken since get_available_name, try again
+    uploaded.close()
+    field_file.name = name
+    field_file._committed = True
+    return True
+
+
+class StreamedUploadedFile(UploadedFile):
+    """An uploaded file written to a hidden temp file in the upload folder.
+
+    The size, sha256 content hash and mime type are calculated as chunks are written.
+    Because the temp file is on the same filesystem as the upload folder, it is moved
+    into place without a copy, see :func:`move_into_place`, so the observer sees the file
+    once, complete. The observer ignores hidden files.
+
+    Like Django's `TemporaryUploadedFile`, the temp file is removed when closed. Django
+    closes the uploaded files of a request once the response is sent, so the temp file
+    of an upload the form rejected does not stay behind in the upload folder.
+    """
+
+    mime_sample_size = 2048
+
+    def __init__(self, name, content_type, charset, content_type_extra=None, dir=None):
+        file = tempfile.NamedTemporaryFile(
+            dir=dir or upload_folder(), prefix='.upload-', suffix='.part', delete=False)
+        super(StreamedUploadedFile, self).__init__(file, name, content_type, 0, charset, content_type_extra)
+        self.hash = hashlib.sha256()
+        self.mime_sample = b''
+        self.mime_type = None
+
+    def temporary_file_path(self):
+        return self.file.name
+
+    def write_chunk(self, data):
+        self.file.write(data)
+        self.hash.update(data)
+        self.size += len(data)
+        if len(self.mime_sample) < self.mime_sample_size:
+            self.mime_sample += data[:self.mime_sample_size - len(self.mime_sample)]
+
+    def complete(self):
+        self.file.flush()
+        self.file.seek(0)
+        try:
+            os.chmod(self.file.name, settings.FILE_UPLOAD_PERMISSIONS)
+        except (AttributeError, TypeError):
+            pass
+        mime_type = magic.from_buffer(self.mime_sample, mime=True)
+        self.mime_type = mime_type.decode() if isinstance(mime_type, bytes) else mime_type
+
+    @property
+    def content_hash(self):
+        return self.hash.hexdigest()
+
+    def close(self):
+        """Closes and removes the temp file, if it was not moved into place."""
+        try:
+            self.file.close()
+            os.remove(self.file.name)
+        except OSError:
+            pass
+
+    discard = close
+
+
+class UploadFolderFileHandler(FileUploadHandler):
+    """An upload handler that streams uploaded files straight into the upload folder.
+
+    Add to settings before the default handlers:
+
+        FILE_UPLOAD_HANDLERS = (
+            'getresults_dst.upload_handlers.UploadFolderFileHandler',
+            'django.core.files.uploadhandler.MemoryFileUploadHandler',
+            'django.core.files.uploadhandler.TemporaryFileUploadHandler')
+    """
+
+    def new_file(self, *args, **kwargs):
+        super(UploadFolderFileHandler, self).new_file(*args, **kwargs)
+        self.file = StreamedUploadedFile(
+            self.file_name, self.content_type, self.charset, self.content_type_extra)
+        raise StopFutureHandlers()
+
+    def receive_data_chunk(self, raw_data, start):
+        self.file.write_chunk(raw_data)
+
+    def file_complete(self, file_size):
+        self.file.complete()
+        return self.file
+
+    def upload_interrupted(self):
+        if getattr(self, 'file', None):
+            self.file.discard()
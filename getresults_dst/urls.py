@@ -31,16 +31,22 @@ from django.contrib import admin
 
 from edc_bootstrap.views import LoginView, LogoutView, HomeView
 from getresults_dst.views import (
-    UploadView, SentHistoryView, PendingView, AcknowledgmentView, LogReaderView, RemoteFolderView)
+    UploadView, BulkUploadView, SentHistoryView, PendingView, PendingStateView, AcknowledgmentView, LogReaderView,
+    RemoteFolderView, DeliverySummaryView, ExportView, ArchiveView)
 
 admin.autodiscover()
 
 urlpatterns = [
     url(r'^upload/$', UploadView.as_view(), name='upload_url'),
+    url(r'^upload/bulk/$', BulkUploadView.as_view(), name='bulk_upload_url'),
     url(r'^history/$', SentHistoryView.as_view(), name='sent_history_url'),
     url(r'^pending/$', PendingView.as_view(), name='pending_url'),
+    url(r'^pending\.json$', PendingStateView.as_view(), name='pending_state_url'),
     url(r'^acknowledgment/$', AcknowledgmentView.as_view(), name='ack_url'),
     url(r'^log/$', LogReaderView.as_view(), name='log_url'),
+    url(r'^summary/$', DeliverySummaryView.as_view(), name='summary_url'),
+    url(r'^export/(?P<name>\w+)\.(?P<fmt>csv|jsonl)(?P<gz>\.gz)?$', ExportView.as_view(), name='export_url'),
+    url(r'^archive/(?P<pk>\d+)/$', ArchiveView.as_view(), name='archive_url'),
     url(r'^remotefolder/$', RemoteFolderView.as_view(), name='remote_folder_url'),
     url(r'^login/', LoginView.as_view(), name='login_url'),
     url(r'^logout/', LogoutView.as_view(url='/'), name='logout_url'),
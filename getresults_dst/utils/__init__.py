@@ -1 +1,3 @@
+from .content_hash import content_hash
 from .load_remote_folders_from_csv import load_remote_folders_from_csv
+from .sync_pending_files import sync_pending_files
@@ -0,0 +1,22 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2015 Erik van Widenfelt
+# All rights reserved.
+#
+# This software is licensed as described in the file COPYING, which
+# you should have received as part of this distribution.
+#
+
+import hashlib
+
+
+def content_hash(fileobj=None, path=None, chunk_size=None):
+    """Returns the sha256 hex digest of the content of an open file or a path, read in chunks."""
+    chunk_size = chunk_size or 64 * 2 ** 10
+    if path:
+        with open(path, 'rb') as f:
+            return content_hash(f, chunk_size=chunk_size)
+    digest = hashlib.sha256()
+    for chunk in iter(lambda: fileobj.read(chunk_size), b''):
+        digest.update(chunk)
+    return digest.hexdigest()
@@ -11,33 +11,48 @@ import csv
 import os
 
 from django.conf import settings
+from django.db import transaction
+from django.db.models import Case, CharField, Value, When
 
 from ..models import RemoteFolder
 
 
 def load_remote_folders_from_csv(csv_filename=None):
+    """Adds or updates RemoteFolder from a CSV file of base_path, folder, folder_tag, label.
+
+    Rows are matched to existing RemoteFolder by (base_path, folder, label). Changes are
+    applied in bulk in one transaction.
+
+    Returns a tuple of (records, added, updated, unchanged)."""
     csv_filename = csv_filename or os.path.join(settings.BASE_DIR, 'getresults/remote_folders.csv')
+    rows = {}
+    records = 0
     with open(csv_filename, 'r') as f:
         reader = csv.reader(f, quotechar="'")
-        header = next(reader)
-        header = [h.lower() for h in header]
-        updated = 0
-        added = 0
-        for index, row in enumerate(reader):
-            r = dict(zip(header, row))
-            try:
-                RemoteFolder.objects.get(
-                    base_path=r['base_path'].strip().lower(),
-                    folder=r['folder'].strip().lower(),
-                    label=r['label'].strip().lower()
-                )
-                updated += 1
-            except RemoteFolder.DoesNotExist:
-                RemoteFolder.objects.create(
-                    base_path=r['base_path'].strip().lower(),
-                    folder=r['folder'].strip().lower(),
-                    folder_tag=r['folder_tag'].strip().lower(),
-                    label=r['label'].strip().lower()
-                )
-                added += 1
-    return index + 1, added, updated
+        header = [h.lower() for h in next(reader)]
+        for row in reader:
+            r = {k: v.strip().lower() for k, v in zip(header, row)}
+            rows[(r['base_path'], r['folder'], r['label'])] = r['folder_tag']
+            records += 1
+    existing = {
+        (base_path, folder, label): (pk, folder_tag)
+        for pk, base_path, folder, label, folder_tag in RemoteFolder.objects.values_list(
+            'pk', 'base_path', 'folder', 'label', 'folder_tag')}
+    new = []
+    changed = {}
+    for (base_path, folder, label), folder_tag in rows.items():
+        try:
+            pk, existing_folder_tag = existing[(base_path, folder, label)]
+        except KeyError:
+            new.append(RemoteFolder(base_path=base_path, folder=folder, folder_tag=folder_tag, label=label))
+        else:
+            if folder_tag != existing_folder_tag:
+                changed[pk] = folder_tag
+    with transaction.atomic():
+        if changed:
+            RemoteFolder.objects.filter(pk__in=changed).update(
+                folder_tag=Case(
+                    *[When(pk=pk, then=Value(folder_tag)) for pk, folder_tag in changed.items()],
+                    output_field=CharField()))
+        RemoteFolder.objects.bulk_create(new)
+    return records, len(new), len(changed), len(rows) - len(new) - len(changed)
@@ -0,0 +1,73 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2015 Erik van Widenfelt
+# All rights reserved.
+#
+# This software is licensed as described in the file COPYING, which
+# you should have received as part of this distribution.
+#
+
+import os
+import pytz
+
+from datetime import datetime
+
+from django.conf import settings
+from django.db import IntegrityError, transaction
+from django.utils import timezone
+
+from ..models import Pending
+
+tz = pytz.timezone(settings.TIME_ZONE)
+
+
+def sync_pending_files(upload_path=None, retries=None):
+    """Brings model Pending up to date with the files in the upload folder.
+
+    Hidden files, e.g. uploads still being streamed, are not pending.
+
+    Compares the folder to the existing rows by (filename, filesize, mtime) and
+    only inserts, deletes and updates the rows that differ, in one transaction.
+    Changed rows are updated by replacing them in the same bulk delete and insert.
+    Rows are read with `select_for_update`, so the observer and the admin action do not
+    both apply the same diff, and extra rows of a filename are deleted. If a concurrent
+    sync inserted a file first, the sync is retried up to `retries` times. (Default: 1)
+
+    Returns a tuple of (added, deleted, updated)."""
+    upload_path = upload_path or os.path.join(settings.MEDIA_ROOT, settings.GRTX_UPLOAD_FOLDER)
+    retries = 1 if retries is None else retries
+    files = {}
+    for entry in os.scandir(upload_path):
+        if entry.is_file() and not entry.name.startswith('.'):
+            stat = entry.stat()
+            files[entry.name] = (stat.st_size, tz.localize(datetime.fromtimestamp(int(stat.st_mtime))))
+    while True:
+        try:
+            with transaction.atomic():
+                return apply_pending_diff(files)
+        except IntegrityError:
+            if not retries:
+                raise
+            retries -= 1
+
+
+def apply_pending_diff(files):
+    existing = {}
+    duplicates = []
+    for pk, filename, filesize, filetimestamp in Pending.objects.select_for_update().order_by(
+            'filename', 'pk').values_list('pk', 'filename', 'filesize', 'filetimestamp'):
+        if filename in existing:
+            duplicates.append(pk)
+        else:
+            existing[filename] = (pk, (filesize, filetimestamp.replace(microsecond=0)))
+    deleted = [pk for filename, (pk, _) in existing.items() if filename not in files]
+    changed = set(pk for filename, (pk, fileinfo) in existing.items()
+                  if filename in files and files[filename] != fileinfo)
+    now = timezone.now()
+    new = [
+        Pending(filename=filename, filesize=filesize, filetimestamp=filetimestamp, last_updated=now)
+        for filename, (filesize, filetimestamp) in files.items()
+        if filename not in existing or existing[filename][0] in changed]
+    Pending.objects.filter(pk__in=deleted + duplicates + list(changed)).delete()
+    Pending.objects.bulk_create(new)
+    return len(new) - len(changed), len(deleted) + len(duplicates), len(changed)
@@ -1,13 +1,30 @@
 
+import hashlib
 import json
-from django.db import models
+import time
+
+from datetime import datetime, timedelta
+
+from django.core.cache import cache
+from django.db import connection, models
+from django.db.models import Q, Sum
+from django.db.models.query import QuerySet
+from django.http import Http404, JsonResponse, StreamingHttpResponse
+from django.shortcuts import get_object_or_404
+from django.utils import timezone
+from django.views.generic import FormView, TemplateView, View
 from braces.views import LoginRequiredMixin
 from datatableview import helpers
 from datatableview import Datatable
 from edc_bootstrap.views import EdcContextMixin
 from edc_bootstrap.views import EdcDatatableView, EdcEditableDatatableView
 
-from .models import Upload, History, Pending
+from .archive import ArchiveError, read_archived
+from .bulk_upload import BulkUpload, BulkUploadError
+from .exports import EXPORTS, FORMATS, CSV, export_stream
+from .forms import BulkUploadForm
+from .models import Upload, History, Pending, DeliveryRollup
+from .pending_state import read_pending_state
 from django.http.response import HttpResponse
 from datatableview.columns import Column, DateColumn, DateTimeColumn, BooleanColumn, TextColumn
 from getresults_dst.models import Acknowledgment, LogReaderHistory, RemoteFolder
@@ -18,6 +35,84 @@ class MyDatatable(Datatable):
         structure_template = "edc_bootstrap/bootstrap_structure.html"
 
 
+class KeysetDatatable(Datatable):
+    """A datatable that pages by seeking (keyset pagination) on an indexed column.
+
+    When sorted on `keyset_field` only, each page is fetched with
+    WHERE (keyset_field, pk) < (last row of the previous page) instead of OFFSET, so
+    page N costs the same as page 1. The last row of each page served is cached
+    against the offset of the next page. Pages requested without a cached boundary,
+    e.g. a jump to the last page, fall back to OFFSET once.
+
+    Counts on large tables are approximate, see :func:`approximate_count`.
+    """
+
+    keyset_field = None
+    keyset_cache_timeout = 600
+    approximate_count_threshold = 100000
+
+    def uses_keyset(self):
+        return (self.keyset_field and isinstance(self._records, QuerySet) and
+                self.config['page_length'] != -1 and
+                list(self.config['ordering'] or []) == ['-{}'.format(self.keyset_field)])
+
+    def keyset_cache_key(self, start_offset):
+        key = repr((self.__class__.__name__, sorted(self.config['search']),
+                    sorted(self.config['column_searches'].items()), start_offset))
+        return 'getresults_dst.keyset.{}'.format(hashlib.md5(key.encode()).hexdigest())
+
+    def _get_current_page(self):
+        if not self.uses_keyset():
+            return super(KeysetDatatable, self)._get_current_page()
+        start_offset = self.config['start_offset']
+        page_length = self.config['page_length']
+        records = self._records.order_by('-{}'.format(self.keyset_field), '-pk')
+        boundary = cache.get(self.keyset_cache_key(start_offset)) if start_offset else None
+        if boundary:
+            value, pk = boundary
+            records = records.filter(
+                Q(**{'{}__lt'.format(self.keyset_field): value}) |
+                Q(**{self.keyset_field: value, 'pk__lt': pk}))
+            object_list = list(records[:page_length])
+        else:
+            object_list = list(records[start_offset:start_offset + page_length])
+        if object_list:
+            last = object_list[-1]
+            cache.set(
+                self.keyset_cache_key(start_offset + len(object_list)),
+                (getattr(last, self.keyset_field), last.pk),
+                self.keyset_cache_timeout)
+        return object_list
+
+    def count_objects(self, base_objects, filtered_objects):
+        if not isinstance(base_objects, QuerySet) or base_objects.query.where:
+            return super(KeysetDatatable, self).count_objects(base_objects, filtered_objects)
+        num_total = approximate_count(base_objects.model, self.approximate_count_threshold)
+        if len(self.config['search']) > 0 or len(self.config['column_searches']) > 0:
+            num_filtered = filtered_objects.count()
+        else:
+            num_filtered = num_total
+        return num_total, num_filtered
+
+
+def approximate_count(model, threshold=None):
+    """Returns the planner's row estimate for the model's table on postgres if it is
+    above threshold, otherwise an exact count, cached for a minute."""
+    threshold = threshold or 0
+    if connection.vendor == 'postgresql':
+        with connection.cursor() as cursor:
+            cursor.execute('SELECT reltuples::bigint FROM pg_class WHERE relname = %s', [model._meta.db_table])
+            row = cursor.fetchone()
+        if row and row[0] > threshold:
+            return row[0]
+    cache_key = 'getresults_dst.count.{}'.format(model._meta.db_table)
+    count = cache.get(cache_key)
+    if count is None:
+        count = model.objects.count()
+        cache.set(cache_key, count, 60)
+    return count
+
+
 class MyBooleanColumn(BooleanColumn):
     model_field_class = models.BooleanField
     handles_field_classes = [models.BooleanField, models.NullBooleanField]
@@ -101,7 +196,27 @@ class UploadView(LoginRequiredMixin, EdcContextMixin, EdcDatatableView):
 #         return HttpResponse(data, content_type="application/json")
 
 
-class SentHistoryDatatable(Datatable):
+class BulkUploadView(LoginRequiredMixin, EdcContextMixin, FormView):
+    """Accepts many files or a zip or tar archive in one submission.
+
+    The batch is checked for duplicates and the Upload rows created in bulk."""
+    template_name = 'bulk_upload.html'
+    form_class = BulkUploadForm
+
+    def form_valid(self, form):
+        try:
+            uploads, rejected = BulkUpload(user=self.request.user).process(
+                self.request.FILES.getlist('files'))
+        except BulkUploadError as e:
+            form.add_error('files', str(e))
+            return self.form_invalid(form)
+        return self.render_to_response(self.get_context_data(
+            form=self.form_class(), uploads=uploads, rejected=rejected))
+
+
+class SentHistoryDatatable(KeysetDatatable):
+
+    keyset_field = 'sent_datetime'
 
     filetimestamp = DateTimeColumn(
         'File Timestamp',
@@ -131,18 +246,53 @@ class SentHistoryView(LoginRequiredMixin, EdcContextMixin, EdcDatatableView):
     datatable_class = SentHistoryDatatable
 
 
-class PendingDatatable(Datatable):
-    class Meta:
-        structure_template = "edc_bootstrap/bootstrap_structure.html"
-
-
-class PendingView(LoginRequiredMixin, EdcContextMixin, EdcDatatableView):
-    model = Pending
-    ordering = ['-id']
-    datatable_class = PendingDatatable
-
-
-class AcknowledgmentDatatable(Datatable):
+class PendingView(LoginRequiredMixin, EdcContextMixin, TemplateView):
+    """Lists pending files as published by the observer.
+
+    Falls back to the Pending snapshot if the observer has not
+    published recently, e.g. it is not running."""
+    template_name = 'pending.html'
+
+    def get_context_data(self, **kwargs):
+        context = super(PendingView, self).get_context_data(**kwargs)
+        state = read_pending_state()
+        if state:
+            now = time.time()
+            pending_files = [
+                {'filename': item['filename'],
+                 'stage': item['stage'],
+                 'age': timedelta(seconds=int(now - item['since']))}
+                for item in state['files']]
+            published = datetime.fromtimestamp(state['published'], tz=timezone.utc)
+        else:
+            now = timezone.now()
+            pending_files = [
+                {'filename': pending.filename,
+                 'stage': 'pending',
+                 'age': now - pending.filetimestamp}
+                for pending in Pending.objects.all()]
+            published = None
+        context.update(
+            pending_files=pending_files,
+            published=published,
+            queue_depth=sorted(state.get('queue_depth', {}).items()) if state else None,
+            hostname=state['hostname'] if state else None)
+        return context
+
+
+class PendingStateView(LoginRequiredMixin, View):
+    """Returns the state published by the observer as JSON."""
+
+    def get(self, request, *args, **kwargs):
+        state = read_pending_state()
+        if not state:
+            return JsonResponse({'error': 'observer state not available'}, status=503)
+        return JsonResponse(state)
+
+
+class AcknowledgmentDatatable(KeysetDatatable):
+
+    keyset_field = 'ack_datetime'
 
     ack_datetime = DateTimeColumn(
         'Ack date',
@@ -182,3 +332,76 @@ class RemoteFolderView(LoginRequiredMixin, EdcContextMixin, EdcDatatableView):
     ordering = ['folder']
     hidden_columns = ['id']
     datatable_class = RemoteFolderDatabale
+
+
+class DeliverySummaryView(LoginRequiredMixin, EdcContextMixin, TemplateView):
+    """Summarizes files sent and acknowledged per remote folder from the daily rollups only.
+
+    The median time to ack is reported as the bucket it falls in."""
+    template_name = 'delivery_summary.html'
+    default_days = 30
+
+    def get_context_data(self, **kwargs):
+        context = super(DeliverySummaryView, self).get_context_data(**kwargs)
+        try:
+            days = int(self.request.GET.get('days', self.default_days))
+        except ValueError:
+            days = self.default_days
+        since = timezone.localtime(timezone.now()).date() - timedelta(days=days)
+        rows = DeliveryRollup.objects.filter(day__gte=since).values(
+            'label', 'remote_folder').annotate(
+            sent=Sum('sent'), acknowledged=Sum('acknowledged'), ack_seconds=Sum('ack_seconds'),
+            ack_within_hour=Sum('ack_within_hour'), ack_within_day=Sum('ack_within_day'),
+            ack_within_week=Sum('ack_within_week')).order_by('label', 'remote_folder')
+        summary = []
+        for row in rows:
+            acknowledged = row['acknowledged'] or 0
+            row['ack_rate'] = 100.0 * acknowledged / row['sent'] if row['sent'] else None
+            row['mean_time_to_ack'] = (
+                timedelta(seconds=int(row['ack_seconds'] / acknowledged)) if acknowledged else None)
+            row['median_time_to_ack'] = self.median_bucket(row)
+            summary.append(row)
+        context.update(summary=summary, days=days, since=since)
+        return context
+
+    def median_bucket(self, row):
+        half = (row['acknowledged'] or 0) / 2.0
+        if not half:
+            return None
+        for name, label in [('ack_within_hour', '< 1 hour'), ('ack_within_day', '< 1 day'),
+                            ('ack_within_week', '< 1 week')]:
+            if row[name] >= half:
+                return label
+        return '> 1 week'
+
+
+class ExportView(LoginRequiredMixin, View):
+    """Streams a full export of History or Acknowledgment as CSV or JSONL, optionally gzipped.
+
+    For example, /export/history.csv or /export/acknowledgment.jsonl.gz"""
+
+    def get(self, request, *args, **kwargs):
+        name, fmt, compress = kwargs.get('name'), kwargs.get('fmt'), bool(kwargs.get('gz'))
+        if name not in EXPORTS or fmt not in FORMATS:
+            raise Http404('Unknown export')
+        filename = '{}.{}{}'.format(name, fmt, '.gz' if compress else '')
+        response = StreamingHttpResponse(
+            export_stream(name, fmt, compress=compress),
+            content_type='application/gzip' if compress else (
+                'text/csv' if fmt == CSV else 'application/x-ndjson'))
+        response['Content-Disposition'] = 'attachment; filename="{}"'.format(filename)
+        return response
+
+
+class ArchiveView(LoginRequiredMixin, View):
+    """Returns the archived copy of a sent file, whether a single file or in a bundle."""
+
+    def get(self, request, *args, **kwargs):
+        history = get_object_or_404(History, pk=kwargs.get('pk'))
+        try:
+            content = read_archived(history.archive.name)
+        except ArchiveError:
+            raise Http404('Archived file not found')
+        response = HttpResponse(content, content_type=history.mime_type)
+        response['Content-Disposition'] = 'inline; filename="{}"'.format(history.filename)
+        return response
@@ -30,8 +30,8 @@ setup(
         'pytz>=2015.4',
         'python-magic>=0.4.6',
         'watchdog>=0.8.3',
-        'paramiko>=1.15.2',
-        'scp>=0.10.2',
+        'paramiko>=2.2.0',
+        'scp>=0.13.0',
         'reportlab>=3.2.0',
     ],
     classifiers=[